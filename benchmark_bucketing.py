@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+   File Name：     benchmark_bucketing
+   Description :  对比定长TFRecord与变长分桶(varlen_records)两种输入的CPU训练吞吐(examples/sec)
+   date：          2026/10/18
+
+"""
+
+import argparse
+import csv
+import os
+import tempfile
+import time
+
+import featurization
+import modeling
+import record_io
+import tokenization
+import tensorflow as tf
+
+
+def read_examples(data_file):
+    """Reads a `label\ttext` file with a header line, like dat/train.tsv."""
+    examples = []
+    with tf.gfile.Open(data_file, 'r') as f:
+        reader = csv.reader(f, delimiter='\t', quotechar=None)
+        for (i, line) in enumerate(reader):
+            if i == 0 or len(line) < 2:
+                continue
+            examples.append(featurization.InputExample(
+                guid='train-%d' % i, text_a=line[1], label=line[0]))
+    return examples
+
+
+def measure(bert_config, manifest, label_list, args, bucket_boundaries):
+    """Runs `args.steps` training steps and returns (examples/sec, mean batch length)."""
+    varlen = manifest['varlen']
+    with tf.Graph().as_default():
+        # The same input pipeline as file_based_input_fn_builder for training.
+        d = record_io.input_dataset(
+            manifest['files'], args.max_seq_length, args.batch_size,
+            is_training=True, drop_remainder=True,
+            compression_type=manifest['compression_type'], varlen=varlen,
+            bucket_boundaries=bucket_boundaries)
+        features = d.make_one_shot_iterator().get_next()
+
+        model = modeling.BertModel(
+            config=bert_config,
+            is_training=True,
+            input_ids=features['input_ids'],
+            input_mask=features['input_mask'],
+            token_type_ids=features['segment_ids'])
+        logits = tf.layers.dense(model.get_pooled_output(), len(label_list))
+        loss = tf.losses.sparse_softmax_cross_entropy(features['label_ids'], logits)
+        train_op = tf.train.GradientDescentOptimizer(1e-5).minimize(loss)
+        batch_length = tf.shape(features['input_ids'])[1]
+
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            for _ in range(args.warmup_steps):
+                sess.run(train_op)
+            lengths = []
+            start_time = time.time()
+            for _ in range(args.steps):
+                _, length = sess.run([train_op, batch_length])
+                lengths.append(length)
+            elapsed = time.time() - start_time
+    return args.steps * args.batch_size / elapsed, sum(lengths) / float(len(lengths))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare CPU training throughput of fixed-length and length-bucketed (varlen) records')
+    parser.add_argument('-data_file', type=str, default='dat/train.tsv',
+                        help='label\\ttext file with a header line')
+    parser.add_argument('-vocab_file', type=str, required=True)
+    parser.add_argument('-bert_config_file', type=str, required=True)
+    parser.add_argument('-max_seq_length', type=int, default=128)
+    parser.add_argument('-batch_size', type=int, default=32)
+    parser.add_argument('-steps', type=int, default=20,
+                        help='number of timed training steps per mode')
+    parser.add_argument('-warmup_steps', type=int, default=3)
+    parser.add_argument('-bucket_boundaries', type=int, nargs='+', default=None,
+                        help='default: 16 32 64 ... below max_seq_length')
+    parser.add_argument('-output_dir', type=str, default=None,
+                        help='where the records are written, default: a temporary directory')
+    args = parser.parse_args()
+
+    tf.logging.set_verbosity(tf.logging.WARN)
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''  # CPU only
+    output_dir = args.output_dir or tempfile.mkdtemp()
+    bert_config = modeling.BertConfig.from_json_file(args.bert_config_file)
+    tokenizer = tokenization.FullTokenizer(
+        vocab_file=args.vocab_file, do_lower_case=True)
+    examples = read_examples(args.data_file)
+    label_list = sorted(set(example.label for example in examples))
+
+    results = []
+    for name, varlen in [('fixed', False), ('bucketed', True)]:
+        manifest = record_io.write_sharded_records(
+            examples, label_list, args.max_seq_length, tokenizer,
+            os.path.join(output_dir, 'benchmark_%s.tf_record' % name),
+            varlen=varlen)
+        examples_per_sec, mean_length = measure(
+            bert_config, manifest, label_list, args, args.bucket_boundaries)
+        results.append(examples_per_sec)
+        print('%-9s %8.1f examples/sec  mean batch length %5.1f' % (
+            name, examples_per_sec, mean_length))
+    print('speedup of bucketed over fixed: %.2fx' % (results[1] / results[0]))
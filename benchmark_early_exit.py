@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+   File Name：     benchmark_early_exit
+   Description :  在dat/dev.tsv上扫描提前退出(early exit)图的熵阈值，输出各阈值下的准确率、平均层数和延迟曲线
+   date：          2026/10/18
+
+"""
+
+import argparse
+import csv
+import json
+import os
+import time
+
+import featurization
+import numpy as np
+import tokenization
+import tensorflow as tf
+
+
+def read_examples(data_file):
+    """Reads a `label\ttext` file with a header line, like dat/dev.tsv."""
+    examples = []
+    with tf.gfile.Open(data_file, 'r') as f:
+        reader = csv.reader(f, delimiter='\t', quotechar=None)
+        for (i, line) in enumerate(reader):
+            if i == 0 or len(line) < 2:
+                continue
+            examples.append(featurization.InputExample(
+                guid='dev-%d' % i, text_a=line[1], label=line[0]))
+    return examples
+
+
+def run_threshold(sess, tensors, arrays, threshold, batch_size):
+    """Returns (probabilities, layers run per example, milliseconds per example)."""
+    probabilities = []
+    exit_layers = []
+    elapsed = 0.0
+    for start in range(0, len(arrays['input_ids']), batch_size):
+        feed_dict = {tensors['input_ids']: arrays['input_ids'][start:start + batch_size],
+                     tensors['input_mask']: arrays['input_mask'][start:start + batch_size],
+                     tensors['threshold']: threshold}
+        start_time = time.time()
+        batch_probabilities, exit_layer = sess.run([tensors['pred_prob'], tensors['exit_layer']], feed_dict)
+        elapsed += time.time() - start_time
+        probabilities.append(batch_probabilities)
+        exit_layers.extend([exit_layer] * len(batch_probabilities))
+    num_examples = len(arrays['input_ids'])
+    return np.concatenate(probabilities), np.array(exit_layers), elapsed * 1000.0 / num_examples
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Latency/accuracy curve of an early-exit graph over entropy thresholds')
+    parser.add_argument('-model_pb', type=str, required=True,
+                        help='classification_model_early_exit_<threshold>.pb written by freeze_graph.py -exit_entropy_threshold')
+    parser.add_argument('-vocab_file', type=str, required=True)
+    parser.add_argument('-data_file', type=str, default='dat/dev.tsv',
+                        help='label\\ttext file with a header line')
+    parser.add_argument('-thresholds', type=float, nargs='+',
+                        default=[0.0, 0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.8],
+                        help='normalized entropy thresholds, 0 runs every layer')
+    parser.add_argument('-batch_size', type=int, default=1,
+                        help='a batch exits only when all of its examples are confident')
+    parser.add_argument('-warmup_steps', type=int, default=5)
+    parser.add_argument('-output_file', type=str, default=None,
+                        help='default: early_exit_curve.json next to model_pb')
+    args = parser.parse_args()
+
+    model_dir = os.path.dirname(args.model_pb)
+    metadata = featurization.load_run_metadata(model_dir)
+    if not metadata or 'max_seq_length' not in metadata:
+        raise ValueError('Can\'t found %s with the labels and max_seq_length of the model'
+                         % os.path.join(model_dir, featurization.RUN_METADATA_FILE))
+    tokenizer = tokenization.FullTokenizer(
+        vocab_file=args.vocab_file, do_lower_case=metadata.get('do_lower_case', True))
+    examples = read_examples(args.data_file)
+    arrays = featurization.convert_examples_to_arrays(
+        examples, metadata['labels'], metadata['max_seq_length'], tokenizer)
+
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(args.model_pb, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    with tf.Graph().as_default() as graph:
+        tf.import_graph_def(graph_def, name='')
+        tensors = {
+            'input_ids': graph.get_tensor_by_name('input_ids:0'),
+            'input_mask': graph.get_tensor_by_name('input_mask:0'),
+            'threshold': graph.get_tensor_by_name('exit_entropy_threshold:0'),
+            'pred_prob': graph.get_tensor_by_name('pred_prob:0'),
+            'exit_layer': graph.get_tensor_by_name('exit_layer:0'),
+        }
+        with tf.Session() as sess:
+            warmup_arrays = {name: column[:args.batch_size * args.warmup_steps] for name, column in arrays.items()}
+            run_threshold(sess, tensors, warmup_arrays, 0.0, args.batch_size)
+
+            curve = []
+            for threshold in args.thresholds:
+                probabilities, exit_layers, latency_ms = run_threshold(
+                    sess, tensors, arrays, threshold, args.batch_size)
+                curve.append({
+                    'threshold': threshold,
+                    'accuracy': float((probabilities.argmax(axis=-1) == arrays['label_ids']).mean()),
+                    'mean_layers': float(exit_layers.mean()),
+                    'latency_ms_per_example': latency_ms,
+                    'exit_layer_counts': {str(layer): int(count) for layer, count in
+                                          zip(*np.unique(exit_layers, return_counts=True))},
+                })
+
+    output_file = args.output_file or os.path.join(model_dir, 'early_exit_curve.json')
+    with tf.gfile.GFile(output_file, 'w') as f:
+        f.write(json.dumps({'num_examples': len(examples), 'batch_size': args.batch_size, 'curve': curve}, indent=2))
+
+    print('%9s %8s %11s %10s' % ('threshold', 'accuracy', 'mean layers', 'ms/example'))
+    for point in curve:
+        print('%9.3f %8.4f %11.2f %10.2f' % (
+            point['threshold'], point['accuracy'], point['mean_layers'], point['latency_ms_per_example']))
+    print('curve written to %s' % output_file)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+   File Name：     benchmark_fused_qkv
+   Description :  对比attention中query/key/value三次矩阵乘与融合为一次矩阵乘(fused_qkv)的推理延迟
+   date：          2026/10/18
+
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import modeling
+import numpy as np
+import tensorflow as tf
+
+
+def build_model(bert_config, max_seq_length, fused_qkv):
+    input_ids = tf.placeholder(tf.int32, (None, max_seq_length), 'input_ids')
+    input_mask = tf.placeholder(tf.int32, (None, max_seq_length), 'input_mask')
+    model = modeling.BertModel(
+        config=bert_config,
+        is_training=False,
+        input_ids=input_ids,
+        input_mask=input_mask,
+        use_one_hot_embeddings=False,
+        fused_qkv=fused_qkv)
+    return input_ids, input_mask, model.get_pooled_output()
+
+
+def write_random_checkpoint(bert_config, max_seq_length, output_dir):
+    """没有指定init_checkpoint时，用随机初始化的(未融合)权重代替"""
+    with tf.Graph().as_default():
+        build_model(bert_config, max_seq_length, fused_qkv=False)
+        saver = tf.train.Saver()
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            return saver.save(sess, os.path.join(output_dir, 'random.ckpt'), write_meta_graph=False)
+
+
+def measure(bert_config, checkpoint, feeds, args, fused_qkv):
+    """返回 {batch_size: 平均每个batch的毫秒数} 和各batch的pooled_output"""
+    latencies = {}
+    outputs = {}
+    with tf.Graph().as_default():
+        input_ids, input_mask, pooled_output = build_model(bert_config, args.max_seq_length, fused_qkv)
+        saver = tf.train.Saver()
+        with tf.Session() as sess:
+            saver.restore(sess, checkpoint)
+            for batch_size, (ids, mask) in sorted(feeds.items()):
+                feed_dict = {input_ids: ids, input_mask: mask}
+                for _ in range(args.warmup_steps):
+                    outputs[batch_size] = sess.run(pooled_output, feed_dict)
+                start_time = time.time()
+                for _ in range(args.steps):
+                    sess.run(pooled_output, feed_dict)
+                latencies[batch_size] = (time.time() - start_time) * 1000.0 / args.steps
+    return latencies, outputs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare inference latency of separate and fused query/key/value projections')
+    parser.add_argument('-bert_config_file', type=str, required=True,
+                        help='e.g. ./chinese_roberta_zh_l12/bert_config.json')
+    parser.add_argument('-init_checkpoint', type=str, default=None,
+                        help='unfused checkpoint, default: random weights')
+    parser.add_argument('-max_seq_length', type=int, default=128)
+    parser.add_argument('-batch_sizes', type=int, nargs='+', default=[1, 32])
+    parser.add_argument('-steps', type=int, default=50,
+                        help='number of timed runs per batch size')
+    parser.add_argument('-warmup_steps', type=int, default=5)
+    args = parser.parse_args()
+
+    tf.logging.set_verbosity(tf.logging.WARN)
+    bert_config = modeling.BertConfig.from_json_file(args.bert_config_file)
+    output_dir = tempfile.mkdtemp()
+    checkpoint = args.init_checkpoint or write_random_checkpoint(bert_config, args.max_seq_length, output_dir)
+    fused_checkpoint = modeling.fuse_qkv_checkpoint(checkpoint, os.path.join(output_dir, 'fused_qkv.ckpt'))
+
+    rng = np.random.RandomState(12345)
+    feeds = {}
+    for batch_size in args.batch_sizes:
+        ids = rng.randint(1, bert_config.vocab_size, (batch_size, args.max_seq_length)).astype(np.int32)
+        feeds[batch_size] = (ids, np.ones_like(ids))
+
+    separate, separate_outputs = measure(bert_config, checkpoint, feeds, args, fused_qkv=False)
+    fused, fused_outputs = measure(bert_config, fused_checkpoint, feeds, args, fused_qkv=True)
+
+    print('%d layers, hidden %d, max_seq_length %d' % (
+        bert_config.num_hidden_layers, bert_config.hidden_size, args.max_seq_length))
+    for batch_size in sorted(feeds):
+        max_diff = np.abs(separate_outputs[batch_size] - fused_outputs[batch_size]).max()
+        print('batch %3d  separate %8.2f ms  fused %8.2f ms  speedup %.2fx  max abs diff %.2e' % (
+            batch_size, separate[batch_size], fused[batch_size],
+            separate[batch_size] / fused[batch_size], max_diff))
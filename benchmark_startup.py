@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+   File Name：     benchmark_startup
+   Description :  测量分词器的启动耗时与内存占用（是否导入TensorFlow）
+   date：          2026/10/18
+
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+
+# Runs in a fresh interpreter, so every measurement starts from a cold import.
+_CHILD_CODE = """
+import json, resource, sys, time
+start_time = time.time()
+if %(import_tf)r:
+    import tensorflow
+import tokenization
+import_time = time.time() - start_time
+tokenizer = tokenization.FullTokenizer(vocab_file=%(vocab_file)r,
+                                       do_lower_case=True)
+tokenizer.tokenize(u'手机很好用，物流也很快')
+total_time = time.time() - start_time
+print(json.dumps({
+    'import_time': import_time,
+    'startup_time': total_time,
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (
+        1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0),
+    'tensorflow_loaded': 'tensorflow' in sys.modules,
+}))
+"""
+
+
+def measure(vocab_file, import_tf, repeats):
+    runs = []
+    for _ in range(repeats):
+        code = _CHILD_CODE % {'import_tf': import_tf, 'vocab_file': vocab_file}
+        output = subprocess.check_output([sys.executable, '-c', code])
+        runs.append(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+    runs.sort(key=lambda run: run['startup_time'])
+    # Report the median run.
+    return runs[len(runs) // 2]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Measure tokenizer import time and RSS with and without TensorFlow')
+    parser.add_argument('-vocab_file', type=str, required=True,
+                        help='vocab.txt (or a vocab compiled by compile_vocab.py)')
+    parser.add_argument('-repeats', type=int, default=5,
+                        help='number of cold starts per configuration')
+    args = parser.parse_args()
+
+    for name, import_tf in [('with tensorflow', True),
+                            ('tokenization only', False)]:
+        try:
+            result = measure(args.vocab_file, import_tf, args.repeats)
+        except subprocess.CalledProcessError:
+            print('%-18s failed (is tensorflow installed?)' % name)
+            continue
+        print('%-18s import %.3fs  startup %.3fs  max rss %.1f MB  tf loaded: %s' % (
+            name, result['import_time'], result['startup_time'],
+            result['max_rss_mb'], result['tensorflow_loaded']))
@@ -7,7 +7,6 @@ import collections
 import tensorflow as tf
 import numpy as np
 import time
-import six
 
 parser = argparse.ArgumentParser(
     description='BERT model saved model case/batch test program, exit with q')
@@ -58,14 +57,20 @@ class SquadExample(object):
                  orig_answer_text=None,
                  start_position=None,
                  end_position=None,
-                 is_impossible=False):
+                 is_impossible=False,
+                 paragraph_text=None,
+                 doc_offsets=None):
         self.qas_id = qas_id
         self.question_text = question_text
+        # doc_tokens是整段的word piece，doc_offsets[i]为第i个word piece在
+        # paragraph_text中的字符区间(start, end)
         self.doc_tokens = doc_tokens
         self.orig_answer_text = orig_answer_text
         self.start_position = start_position
         self.end_position = end_position
         self.is_impossible = is_impossible
+        self.paragraph_text = paragraph_text
+        self.doc_offsets = doc_offsets
 
     def __str__(self):
         return self.__repr__()
@@ -166,17 +171,9 @@ def convert_examples_to_features(examples, tokenizer, max_seq_length,
         if len(query_tokens) > max_query_length:
             query_tokens = query_tokens[0:max_query_length]
 
-        # 将原文变成token之后，token和原始文本index的对应关系
-        tok_to_orig_index = []
-        # 将原文变成token之后，原始文本和token的index的对应关系
-        orig_to_tok_index = []
-        all_doc_tokens = []
-        for (i, token) in enumerate(example.doc_tokens):
-            orig_to_tok_index.append(len(all_doc_tokens))
-            sub_tokens = tokenizer.tokenize(token)
-            for sub_token in sub_tokens:
-                tok_to_orig_index.append(i)
-                all_doc_tokens.append(sub_token)
+        # read_squad_examples已经对整段做了word piece切分，这里无需再逐词分词；
+        # token_to_orig_map直接记录word piece在doc_tokens中的下标
+        all_doc_tokens = example.doc_tokens
 
         tok_start_position = None
         tok_end_position = None
@@ -218,8 +215,7 @@ def convert_examples_to_features(examples, tokenizer, max_seq_length,
             for i in range(doc_span.length):
                 split_token_index = doc_span.start + i
                 # len(tokens)为[CLS]+query_tokens+[SEP]的大小，应该是doc_tokens第i个token
-                token_to_orig_map[len(
-                    tokens)] = tok_to_orig_index[split_token_index]
+                token_to_orig_map[len(tokens)] = split_token_index
 
                 is_max_context = _check_is_max_context(doc_spans, doc_span_index,
                                                        split_token_index)
@@ -317,9 +313,11 @@ def read_squad_examples(input_data, tokenizer):
         for paragraph in entry["paragraphs"]:
             paragraph_text = " ".join(tokenization.whitespace_tokenize(
                 clean_text(paragraph["context"])))
+            # 整段只分词一次，同时得到每个word piece在原文中的位置
+            doc_tokens, doc_offsets = tokenizer.tokenize_with_offsets(
+                paragraph_text)
 
             for qa in paragraph["qas"]:
-                doc_tokens = tokenizer.basic_tokenizer.tokenize(paragraph_text)
                 qas_id = qa["id"]
                 question_text = qa["question"]
                 start_position = None
@@ -333,112 +331,13 @@ def read_squad_examples(input_data, tokenizer):
                     doc_tokens=doc_tokens,
                     orig_answer_text=orig_answer_text,
                     start_position=start_position,
-                    end_position=end_position)
+                    end_position=end_position,
+                    paragraph_text=paragraph_text,
+                    doc_offsets=doc_offsets)
                 examples.append(example)
     return examples
 
 
-def get_final_text(pred_text, orig_text, do_lower_case, verbose_logging=False):
-    """Project the tokenized prediction back to the original text."""
-
-    # When we created the data, we kept track of the alignment between original
-    # (whitespace tokenized) tokens and our WordPiece tokenized tokens. So
-    # now `orig_text` contains the span of our original text corresponding to the
-    # span that we predicted.
-    #
-    # However, `orig_text` may contain extra characters that we don't want in
-    # our prediction.
-    #
-    # For example, let's say:
-    #   pred_text = steve smith
-    #   orig_text = Steve Smith's
-    #
-    # We don't want to return `orig_text` because it contains the extra "'s".
-    #
-    # We don't want to return `pred_text` because it's already been normalized
-    # (the SQuAD eval script also does punctuation stripping/lower casing but
-    # our tokenizer does additional normalization like stripping accent
-    # characters).
-    #
-    # What we really want to return is "Steve Smith".
-    #
-    # Therefore, we have to apply a semi-complicated alignment heruistic between
-    # `pred_text` and `orig_text` to get a character-to-charcter alignment. This
-    # can fail in certain cases in which case we just return `orig_text`.
-
-    def _strip_spaces(text):
-        ns_chars = []
-        ns_to_s_map = collections.OrderedDict()
-        for (i, c) in enumerate(text):
-            if c == " ":
-                continue
-            ns_to_s_map[len(ns_chars)] = i
-            ns_chars.append(c)
-        ns_text = "".join(ns_chars)
-        return (ns_text, ns_to_s_map)
-
-    # We first tokenize `orig_text`, strip whitespace from the result
-    # and `pred_text`, and check if they are the same length. If they are
-    # NOT the same length, the heuristic has failed. If they are the same
-    # length, we assume the characters are one-to-one aligned.
-
-    #################################################
-    """
-    原本
-    """
-    # tokenizer = tokenization.BasicTokenizer(do_lower_case=do_lower_case)
-    # tok_text = "".join(tokenizer.tokenize(orig_text))
-    """
-    更新的版本 20200416
-    """
-    tokenizer = tokenization.FullTokenizer(vocab_file=args_in_use.vocab_file,
-                                           do_lower_case=True)
-    tok_text = "".join(tokenizer.tokenize(orig_text))
-    # De-tokenize WordPieces that have been split off.
-    tok_text = tok_text.replace(" ##", "")
-    tok_text = tok_text.replace("##", "")
-    ####################################################
-
-    start_position = tok_text.find(pred_text)
-    if start_position == -1:
-        print(f'{pred_text} not in {tok_text}') #UNK 的情况
-        return orig_text
-    end_position = start_position + len(pred_text) - 1
-
-    (orig_ns_text, orig_ns_to_s_map) = _strip_spaces(orig_text)
-    (tok_ns_text, tok_ns_to_s_map) = _strip_spaces(tok_text)
-
-    if len(orig_ns_text) != len(tok_ns_text):
-        return orig_text
-
-    # We then project the characters in `pred_text` back to `orig_text` using
-    # the character-to-character alignment.
-    tok_s_to_ns_map = {}
-    for (i, tok_index) in six.iteritems(tok_ns_to_s_map):
-        tok_s_to_ns_map[tok_index] = i
-
-    orig_start_position = None
-    if start_position in tok_s_to_ns_map:
-        ns_start_position = tok_s_to_ns_map[start_position]
-        if ns_start_position in orig_ns_to_s_map:
-            orig_start_position = orig_ns_to_s_map[ns_start_position]
-
-    if orig_start_position is None:
-        return orig_text
-
-    orig_end_position = None
-    if end_position in tok_s_to_ns_map:
-        ns_end_position = tok_s_to_ns_map[end_position]
-        if ns_end_position in orig_ns_to_s_map:
-            orig_end_position = orig_ns_to_s_map[ns_end_position]
-
-    if orig_end_position is None:
-        return orig_text
-
-    output_text = orig_text[orig_start_position:(orig_end_position + 1)]
-    return output_text
-
-
 def _compute_softmax(scores):
     """Compute softmax probability over raw logits."""
     if not scores:
@@ -544,22 +443,13 @@ def get_predictions(all_examples, all_features, all_results, n_best_size,
                 break
             feature = features[pred.feature_index]
 
-            tok_tokens = feature.tokens[pred.start_index:(pred.end_index + 1)]
             orig_doc_start = feature.token_to_orig_map[pred.start_index]
             orig_doc_end = feature.token_to_orig_map[pred.end_index]
-            orig_tokens = example.doc_tokens[orig_doc_start:(orig_doc_end + 1)]
-            tok_text = "".join(tok_tokens)
-
-            # De-tokenize WordPieces that have been split off.
-            tok_text = tok_text.replace(" ##", "")
-            tok_text = tok_text.replace("##", "")
-
-            # Clean whitespace
-            tok_text = tok_text.strip()
-            tok_text = " ".join(tok_text.split())
-            orig_text = "".join(orig_tokens)
-
-            final_text = get_final_text(tok_text, orig_text, do_lower_case)
+            # 直接按word piece的字符位置从原文中截取答案，保留原文的大小写，
+            # 不需要再重新分词并对齐预测文本和原文
+            start_char = example.doc_offsets[orig_doc_start][0]
+            end_char = example.doc_offsets[orig_doc_end][1]
+            final_text = example.paragraph_text[start_char:end_char]
             if final_text in seen_predictions:
                 continue
 
@@ -174,6 +174,38 @@ class FullTokenizer(object): # what bert uses
 
     return split_tokens
 
+  def tokenize_with_offsets(self, text):
+    """Tokenizes `text` and returns the character span of every word piece.
+
+    This is a single pass over `text`, so a whole paragraph can be tokenized
+    at once instead of word by word while still knowing where every word
+    piece came from.
+
+    Returns:
+      A tuple (tokens, offsets). `offsets[i]` is the (start, end) span such
+      that `text[start:end]` is the original text of `tokens[i]`. An "[UNK]"
+      spans the whole word it replaces.
+    """
+    text = convert_to_unicode(text)
+    unk_token = self.wordpiece_tokenizer.unk_token
+    tokens = []
+    offsets = []
+    for (word, positions) in self.basic_tokenizer.tokenize_with_offsets(text):
+      sub_tokens = self.wordpiece_tokenizer.tokenize(word)
+      if sub_tokens == [unk_token]:
+        tokens.append(unk_token)
+        offsets.append((positions[0], positions[-1] + 1))
+        continue
+      start = 0
+      for sub_token in sub_tokens:
+        length = len(sub_token)
+        if start > 0 and sub_token.startswith("##"):
+          length -= 2
+        tokens.append(sub_token)
+        offsets.append((positions[start], positions[start + length - 1] + 1))
+        start += length
+    return tokens, offsets
+
   def convert_tokens_to_ids(self, tokens):
     return convert_by_vocab(self.vocab, tokens)
 
@@ -215,6 +247,54 @@ class BasicTokenizer(object):# tokenize by space
     output_tokens = whitespace_tokenize(" ".join(split_tokens))
     return output_tokens
 
+  def tokenize_with_offsets(self, text):
+    """Tokenizes a piece of text, keeping the position of every character.
+
+    Cleaning, CJK splitting, lower casing, accent stripping and punctuation
+    splitting are done character by character in one pass, which gives the
+    same tokens as `tokenize` (except for context dependent lower casing
+    such as the Greek final sigma).
+
+    Returns:
+      A list of (token, positions) tuples, where `positions[j]` is the index in
+      `text` of the character that produced `token[j]`.
+    """
+    text = convert_to_unicode(text)
+    output = []
+    chars = []
+    positions = []
+
+    def flush():
+      if chars:
+        output.append(("".join(chars), list(positions)))
+        del chars[:]
+        del positions[:]
+
+    for (i, char) in enumerate(text):
+      cp = ord(char)
+      if cp == 0 or cp == 0xfffd or _is_control(char):
+        continue
+      # `whitespace_tokenize` splits on anything `str.split` considers space.
+      if _is_whitespace(char) or char.isspace():
+        flush()
+        continue
+      is_chinese_char = self._is_chinese_char(cp)
+      if is_chinese_char:
+        flush()
+      if self.do_lower_case:
+        char = self._run_strip_accents(char.lower())
+      for c in char:
+        if _is_punctuation(c):
+          flush()
+          output.append((c, [i]))
+        else:
+          chars.append(c)
+          positions.append(i)
+      if is_chinese_char:
+        flush()
+    flush()
+    return output
+
   def _run_strip_accents(self, text):
     """
     Strips accents from a piece of text.
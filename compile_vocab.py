@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+   File Name：     compile_vocab
+   Description :  将vocab.txt编译为可mmap加载的二进制词表，FullTokenizer可直接使用
+   date：          2026/10/18
+
+"""
+
+import argparse
+import time
+
+import tokenization
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compile a vocab.txt into the binary, memory-mappable vocab format')
+    parser.add_argument('-vocab_file', type=str, required=True,
+                        help='the vocab.txt the model was trained with')
+    parser.add_argument('-output_file', type=str, required=True,
+                        help='path of the compiled vocab, e.g. vocab.bin')
+    args = parser.parse_args()
+
+    tokenization.convert_vocab_to_binary(args.vocab_file, args.output_file)
+
+    start_time = time.time()
+    text_vocab = tokenization.load_vocab(args.vocab_file)
+    text_time = time.time() - start_time
+    start_time = time.time()
+    binary_vocab = tokenization.load_vocab(args.output_file)
+    binary_time = time.time() - start_time
+
+    for token, index in text_vocab.items():
+        assert binary_vocab[token] == index, token
+    assert len(binary_vocab) == len(text_vocab)
+    print('compiled %d tokens to %s' % (len(binary_vocab), args.output_file))
+    print('load time: text %.4fs, binary %.4fs' % (text_time, binary_time))
@@ -0,0 +1,239 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A memory-mapped columnar store of classification features.
+
+An alternative to TFRecord files of `tf.train.Example`s: a store is a
+directory of .npy columns that are memory-mapped and sliced, with no proto
+parsing. Only the token ids are stored per position, as int16 when the vocab
+fits; "input_mask" and "segment_ids" are rebuilt from the sequence lengths:
+
+  input_ids.npy        [num_examples, max_seq_length] int16 or int32
+  lengths.npy          [num_examples] uint8 or int16, real tokens per example
+  lengths_a.npy        [num_examples] uint8 or int16, tokens of segment 0
+  label_ids.npy        [num_examples] int32
+  is_real_example.npy  [num_examples] uint8
+  store.json           num_examples, max_seq_length, vocab_hash
+
+`FeatureStore.arrays` reads batches as NumPy arrays (for the inference
+scripts) and `FeatureStore.dataset` as a `tf.data.Dataset`.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import json
+import os
+
+import featurization
+import numpy as np
+import six
+import tokenization
+
+STORE_METADATA_FILE = "store.json"
+
+_COLUMNS = ["input_ids", "lengths", "lengths_a", "label_ids",
+            "is_real_example"]
+
+
+def _column_dtypes(vocab_size, max_seq_length):
+  id_dtype = np.int16 if vocab_size <= np.iinfo(np.int16).max + 1 else np.int32
+  length_dtype = np.uint8 if max_seq_length <= np.iinfo(np.uint8).max else (
+      np.int16)
+  return {
+      "input_ids": id_dtype,
+      "lengths": length_dtype,
+      "lengths_a": length_dtype,
+      "label_ids": np.int32,
+      "is_real_example": np.uint8,
+  }
+
+
+def write_feature_store(examples, label_list, max_seq_length, tokenizer,
+                        store_dir, num_workers=1, chunk_size=10000):
+  """Converts `examples` into features and writes them as a feature store.
+
+  Args:
+    examples: A list of `InputExample`s and `PaddingInputExample`s, or a
+      `featurization.ExampleStream`, which is read once to count and once to
+      convert.
+    label_list: The labels of the task, in label id order.
+    max_seq_length: Length of the rows, including "[CLS]" and "[SEP]".
+    tokenizer: A `FullTokenizer`.
+    store_dir: Directory of the store; created if needed.
+    num_workers: Number of processes used to encode the texts.
+    chunk_size: Number of examples converted at a time.
+
+  Returns:
+    The written `FeatureStore`.
+  """
+  if isinstance(examples, list):
+    num_examples = len(examples)
+  else:
+    num_examples = sum(1 for _ in examples)
+
+  if not os.path.isdir(store_dir):
+    os.makedirs(store_dir)
+  # Drop the metadata of an older store first, so that an interrupted rewrite
+  # leaves a store that fails to open rather than stale metadata over partly
+  # written columns.
+  metadata_file = os.path.join(store_dir, STORE_METADATA_FILE)
+  if os.path.exists(metadata_file):
+    os.remove(metadata_file)
+  dtypes = _column_dtypes(len(tokenizer.vocab), max_seq_length)
+  columns = {}
+  for name in _COLUMNS:
+    shape = (num_examples, max_seq_length) if name == "input_ids" else (
+        num_examples,)
+    columns[name] = np.lib.format.open_memmap(
+        os.path.join(store_dir, name + ".npy"), mode="w+", dtype=dtypes[name],
+        shape=shape)
+
+  examples = iter(examples)
+  start = 0
+  while start < num_examples:
+    chunk = [example for (_, example) in zip(range(chunk_size), examples)]
+    arrays = featurization.convert_examples_to_arrays(
+        chunk, label_list, max_seq_length, tokenizer, num_workers=num_workers)
+    end = start + len(chunk)
+    lengths = arrays["input_mask"].sum(axis=1)
+    columns["input_ids"][start:end] = arrays["input_ids"]
+    columns["lengths"][start:end] = lengths
+    columns["lengths_a"][start:end] = lengths - arrays["segment_ids"].sum(
+        axis=1)
+    columns["label_ids"][start:end] = arrays["label_ids"]
+    columns["is_real_example"][start:end] = arrays["is_real_example"]
+    start = end
+
+  for column in columns.values():
+    column.flush()
+  del columns
+
+  metadata = collections.OrderedDict()
+  metadata["num_examples"] = num_examples
+  metadata["max_seq_length"] = max_seq_length
+  metadata["vocab_hash"] = featurization.vocab_hash(tokenizer.vocab)
+  # Written last: a store without its metadata file is incomplete.
+  with tokenization.open_file(metadata_file, "w") as writer:
+    writer.write(six.text_type(json.dumps(metadata, indent=2)))
+  return FeatureStore(store_dir)
+
+
+class FeatureStore(object):
+  """A feature store written by `write_feature_store`, memory-mapped."""
+
+  def __init__(self, store_dir):
+    with tokenization.open_file(
+        os.path.join(store_dir, STORE_METADATA_FILE)) as reader:
+      self.metadata = json.loads(reader.read())
+    self.store_dir = store_dir
+    self.max_seq_length = self.metadata["max_seq_length"]
+    self.columns = collections.OrderedDict(
+        (name, np.load(os.path.join(store_dir, name + ".npy"), mmap_mode="r"))
+        for name in _COLUMNS)
+
+  def __len__(self):
+    return self.metadata["num_examples"]
+
+  def arrays(self, index, trim_padding=False):
+    """Returns the features of the examples at `index` as NumPy arrays.
+
+    Args:
+      index: A slice or an array of example indices.
+      trim_padding: Whether to cut the rows to the longest example read,
+        instead of `max_seq_length`.
+
+    Returns:
+      An OrderedDict like `featurization.convert_examples_to_arrays`.
+    """
+    lengths = self.columns["lengths"][index].astype(np.int32)
+    lengths_a = self.columns["lengths_a"][index].astype(np.int32)
+    seq_length = self.max_seq_length
+    if trim_padding:
+      seq_length = max(1, int(lengths.max())) if len(lengths) else 1
+    positions = np.arange(seq_length, dtype=np.int32)
+
+    arrays = collections.OrderedDict()
+    arrays["input_ids"] = self.columns["input_ids"][index, :seq_length].astype(
+        np.int32)
+    arrays["input_mask"] = (positions < lengths[:, None]).astype(np.int32)
+    arrays["segment_ids"] = arrays["input_mask"] * (
+        positions >= lengths_a[:, None])
+    arrays["label_ids"] = self.columns["label_ids"][index].astype(np.int32)
+    arrays["is_real_example"] = self.columns["is_real_example"][index].astype(
+        np.int32)
+    return arrays
+
+  def batches(self, batch_size, trim_padding=False):
+    """Yields the features of consecutive batches of `batch_size` examples."""
+    for start in range(0, len(self), batch_size):
+      yield self.arrays(slice(start, start + batch_size), trim_padding)
+
+  def dataset(self, batch_size, is_training, drop_remainder):
+    """Returns a `tf.data.Dataset` of feature batches read from the store.
+
+    The generator only reads the stored columns; "input_mask" and
+    "segment_ids" are rebuilt from the lengths in the graph. For training the
+    examples are repeated and reshuffled every epoch. As the store is read in
+    a `tf.py_func`, this is not TPU compatible.
+    """
+    import tensorflow as tf  # pylint: disable=g-import-not-at-top
+
+    num_examples = len(self)
+    columns = self.columns
+    seq_length = self.max_seq_length
+
+    def generate_batches():
+      while True:
+        if is_training:
+          order = np.random.permutation(num_examples)
+        for start in range(0, num_examples, batch_size):
+          if drop_remainder and start + batch_size > num_examples:
+            break
+          if is_training:
+            # Rows of a shuffled batch are read in file order.
+            index = np.sort(order[start:start + batch_size])
+          else:
+            index = slice(start, start + batch_size)
+          yield {name: np.asarray(columns[name][index]) for name in _COLUMNS}
+        if not is_training:
+          break
+
+    batch_dim = batch_size if drop_remainder else None
+    output_shapes = {name: [batch_dim] for name in _COLUMNS}
+    output_shapes["input_ids"] = [batch_dim, seq_length]
+    d = tf.data.Dataset.from_generator(
+        generate_batches,
+        output_types={
+            name: tf.as_dtype(column.dtype)
+            for (name, column) in columns.items()
+        },
+        output_shapes=output_shapes)
+
+    def expand(batch):
+      lengths = tf.to_int32(batch["lengths"])
+      lengths_a = tf.to_int32(batch["lengths_a"])
+      input_mask = tf.sequence_mask(lengths, seq_length, dtype=tf.int32)
+      return {
+          "input_ids": tf.to_int32(batch["input_ids"]),
+          "input_mask": input_mask,
+          "segment_ids": input_mask - tf.sequence_mask(
+              lengths_a, seq_length, dtype=tf.int32),
+          "label_ids": batch["label_ids"],
+          "is_real_example": tf.to_int32(batch["is_real_example"]),
+      }
+
+    return d.map(expand).prefetch(2)
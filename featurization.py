@@ -0,0 +1,437 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Shared conversion of classification examples into BERT input features.
+
+The training runners, the export scripts and the serving clients all import
+this module, so a request is featurized exactly like the examples the model
+was trained on. It also reads and writes the run metadata (label order,
+sequence length and vocab) that a trained model is served with.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import hashlib
+import json
+import os
+import pickle
+
+import numpy as np
+import six
+import tokenization
+
+# Written once per run next to the checkpoints, and read by freeze_graph.py and
+# the inference scripts.
+RUN_METADATA_FILE = "run_metadata.json"
+
+# Label to id map of older runs, still written for existing deployments.
+LABEL2ID_FILE = "label2id.pkl"
+
+
+class InputExample(object):
+  """A single training/test example for simple sequence classification."""
+
+  def __init__(self, guid, text_a, text_b=None, label=None):
+    """Constructs a InputExample.
+
+    Args:
+      guid: Unique id for the example.
+      text_a: string. The untokenized text of the first sequence. For single
+        sequence tasks, only this sequence must be specified.
+      text_b: (Optional) string. The untokenized text of the second sequence.
+        Only must be specified for sequence pair tasks.
+      label: (Optional) string. The label of the example. This should be
+        specified for train and dev examples, but not for test examples.
+    """
+    self.guid = guid
+    self.text_a = text_a
+    self.text_b = text_b
+    self.label = label
+
+
+class PaddingInputExample(object):
+  """Fake example so the num input examples is a multiple of the batch size.
+
+  When running eval/predict on the TPU, we need to pad the number of examples
+  to be a multiple of the batch size, because the TPU requires a fixed batch
+  size. The alternative is to drop the last batch, which is bad because it means
+  the entire output data won't be generated.
+
+  We use this class instead of `None` because treating `None` as padding
+  battches could cause silent errors.
+  """
+
+
+class InputFeatures(object):
+  """A single set of features of data."""
+
+  def __init__(self,
+               input_ids,
+               input_mask,
+               segment_ids,
+               label_id,
+               is_real_example=True):
+    self.input_ids = input_ids
+    self.input_mask = input_mask
+    self.segment_ids = segment_ids
+    self.label_id = label_id
+    self.is_real_example = is_real_example
+
+
+class ExampleStream(object):
+  """Examples produced lazily, e.g. streamed from a file, one pass at a time.
+
+  Every iteration calls `generator_fn(*args)` again, so the examples can be
+  read in several passes, and by several worker processes if `generator_fn`
+  and `args` can be pickled, without ever holding all of them in memory.
+  """
+
+  def __init__(self, generator_fn, *args):
+    self.generator_fn = generator_fn
+    self.args = args
+
+  def __iter__(self):
+    return iter(self.generator_fn(*self.args))
+
+
+def truncate_seq_pair(tokens_a, tokens_b, max_length):
+  """Truncates a sequence pair in place to the maximum length."""
+
+  # This is a simple heuristic which will always truncate the longer sequence
+  # one token at a time. This makes more sense than truncating an equal percent
+  # of tokens from each, since if one sequence is very short then each token
+  # that's truncated likely contains more information than a longer sequence.
+  len_a, len_b = tokenization.truncate_seq_pair_lengths(
+      len(tokens_a), len(tokens_b), max_length)
+  del tokens_a[len_a:]
+  del tokens_b[len_b:]
+
+
+def _label_id(example, label_map):
+  """Returns the label id of `example`, 0 for examples without a label."""
+  if example.label is None:
+    return 0
+  return label_map[example.label]
+
+
+def convert_single_example(example, label_list, max_seq_length, tokenizer):
+  """Converts a single `InputExample` into a single `InputFeatures`.
+
+  Examples without a label (e.g. at serving time) get `label_id` 0.
+  """
+  arrays = convert_examples_to_arrays([example], label_list, max_seq_length,
+                                      tokenizer)
+  return InputFeatures(
+      input_ids=arrays["input_ids"][0].tolist(),
+      input_mask=arrays["input_mask"][0].tolist(),
+      segment_ids=arrays["segment_ids"][0].tolist(),
+      label_id=int(arrays["label_ids"][0]),
+      is_real_example=bool(arrays["is_real_example"][0]))
+
+
+def convert_examples_to_arrays(examples, label_list, max_seq_length, tokenizer,
+                               num_workers=1, pool=None):
+  """Converts a batch of `InputExample`s into contiguous NumPy arrays.
+
+  Produces the same features as calling `convert_single_example` on every
+  example, but encodes all texts in one `FullTokenizer.encode_batch` call and
+  writes the ids straight into preallocated arrays. `PaddingInputExample`s
+  become all-zero rows with `is_real_example` 0.
+
+  Args:
+    examples: A list of `InputExample`s and `PaddingInputExample`s.
+    label_list: The labels of the task, in label id order.
+    max_seq_length: Length of the rows, including "[CLS]" and "[SEP]".
+    tokenizer: A `FullTokenizer`.
+    num_workers: Number of processes used to encode the texts.
+    pool: Optional `tokenization.create_batch_pool` pool of `num_workers`
+      processes, reused instead of starting a new one.
+
+  Returns:
+    An OrderedDict with `np.int32` arrays "input_ids", "input_mask" and
+    "segment_ids" of shape [len(examples), max_seq_length], and "label_ids"
+    and "is_real_example" of shape [len(examples)].
+  """
+  label_map = {}
+  for (i, label) in enumerate(label_list or []):
+    label_map[label] = i
+
+  real_indices = [i for (i, example) in enumerate(examples)
+                  if not isinstance(example, PaddingInputExample)]
+  texts = [examples[i].text_a for i in real_indices]
+  pair_indices = [i for i in real_indices if examples[i].text_b]
+  texts.extend(examples[i].text_b for i in pair_indices)
+  all_ids = tokenizer.encode_batch(texts, num_workers=num_workers, pool=pool)
+
+  all_ids_a = [None] * len(examples)
+  for (i, ids) in zip(real_indices, all_ids):
+    all_ids_a[i] = ids
+  all_ids_b = [None] * len(examples)
+  for (i, ids) in zip(pair_indices, all_ids[len(real_indices):]):
+    all_ids_b[i] = ids
+
+  input_ids, input_mask, segment_ids = tokenization.build_input_arrays(
+      all_ids_a, all_ids_b, max_seq_length, tokenizer.vocab["[CLS]"],
+      tokenizer.vocab["[SEP]"])
+
+  label_ids = np.zeros(len(examples), dtype=np.int32)
+  is_real_example = np.zeros(len(examples), dtype=np.int32)
+  for i in real_indices:
+    label_ids[i] = _label_id(examples[i], label_map)
+    is_real_example[i] = 1
+
+  arrays = collections.OrderedDict()
+  arrays["input_ids"] = input_ids
+  arrays["input_mask"] = input_mask
+  arrays["segment_ids"] = segment_ids
+  arrays["label_ids"] = label_ids
+  arrays["is_real_example"] = is_real_example
+  return arrays
+
+
+def pack_arrays(arrays, max_examples_per_row):
+  """Packs the rows of `convert_examples_to_arrays` into fewer, fuller rows.
+
+  Examples are concatenated in order into a row while they fit, up to
+  `max_examples_per_row` examples per row. Every example keeps its own
+  "[CLS]" ... "[SEP]" tokens and segment ids, and its positions start again at
+  0. `modeling.BertModel` keeps the packed examples apart with `packing_ids`
+  and pools every example at its `cls_positions`. Padding examples are
+  dropped.
+
+  Args:
+    arrays: An OrderedDict as returned by `convert_examples_to_arrays`.
+    max_examples_per_row: Maximum number of examples packed into a row.
+
+  Returns:
+    An OrderedDict with `np.int32` arrays "input_ids", "input_mask",
+    "segment_ids", "position_ids" and "packing_ids" of shape
+    [num_rows, max_seq_length], and "cls_positions", "label_ids" and
+    "label_weights" of shape [num_rows, max_examples_per_row]. Unused example
+    slots have `label_weights` 0.
+  """
+  max_seq_length = arrays["input_ids"].shape[1]
+  lengths = arrays["input_mask"].sum(axis=1)
+
+  # Assigns every example a row and an offset in it.
+  placements = []
+  row = -1
+  offset = max_seq_length
+  slot = max_examples_per_row
+  for i in np.flatnonzero(arrays["is_real_example"]):
+    if offset + lengths[i] > max_seq_length or slot == max_examples_per_row:
+      row += 1
+      offset = 0
+      slot = 0
+    placements.append((i, row, offset, slot))
+    offset += lengths[i]
+    slot += 1
+  num_rows = row + 1
+
+  packed = collections.OrderedDict()
+  for name in ["input_ids", "input_mask", "segment_ids", "position_ids",
+               "packing_ids"]:
+    packed[name] = np.zeros([num_rows, max_seq_length], dtype=np.int32)
+  for name in ["cls_positions", "label_ids", "label_weights"]:
+    packed[name] = np.zeros([num_rows, max_examples_per_row], dtype=np.int32)
+
+  for (i, row, offset, slot) in placements:
+    length = lengths[i]
+    span = slice(offset, offset + length)
+    packed["input_ids"][row, span] = arrays["input_ids"][i, :length]
+    packed["input_mask"][row, span] = 1
+    packed["segment_ids"][row, span] = arrays["segment_ids"][i, :length]
+    packed["position_ids"][row, span] = np.arange(length)
+    packed["packing_ids"][row, span] = slot + 1
+    packed["cls_positions"][row, slot] = offset
+    packed["label_ids"][row, slot] = arrays["label_ids"][i]
+    packed["label_weights"][row, slot] = 1
+  return packed
+
+
+def dedup_examples(examples, tokenizer):
+  """Drops examples whose texts are featurized like an earlier example.
+
+  Texts are compared after `BasicTokenizer` normalization (cleanup, lower
+  casing, accent stripping, whitespace and punctuation splitting), which is
+  all `FullTokenizer` looks at before the word pieces, so every dropped
+  example would have been given exactly the features of the one kept. Labels
+  are not compared; this is meant for prediction.
+
+  Args:
+    examples: A list of `InputExample`s.
+    tokenizer: A `FullTokenizer`.
+
+  Returns:
+    A tuple (unique_examples, inverse): the first example of every distinct
+    text, in input order, and an `np.int64` array such that `examples[i]` is
+    featurized like `unique_examples[inverse[i]]`.
+  """
+  basic_tokenizer = tokenizer.basic_tokenizer
+  unique_index = {}
+  unique_examples = []
+  inverse = np.zeros(len(examples), dtype=np.int64)
+  for (i, example) in enumerate(examples):
+    key = " ".join(basic_tokenizer.tokenize(example.text_a))
+    if example.text_b:
+      key += "\x1f" + " ".join(basic_tokenizer.tokenize(example.text_b))
+    digest = hashlib.sha1(key.encode("utf-8")).digest()
+    index = unique_index.get(digest)
+    if index is None:
+      index = unique_index[digest] = len(unique_examples)
+      unique_examples.append(example)
+    inverse[i] = index
+  return unique_examples, inverse
+
+
+def feature_array_files(output_prefix):
+  """Returns the .npy file of every array written by `write_feature_arrays`."""
+  names = ["input_ids", "input_mask", "segment_ids", "label_ids",
+           "is_real_example"]
+  return collections.OrderedDict(
+      (name, "%s.%s.npy" % (output_prefix, name)) for name in names)
+
+
+def write_feature_arrays(examples, label_list, max_seq_length, tokenizer,
+                         output_prefix, num_workers=1, chunk_size=10000):
+  """Converts `examples` into features stored as memory-mappable .npy files.
+
+  The arrays of `convert_examples_to_arrays` are written a chunk of examples at
+  a time straight into the files, so neither the features nor (for an
+  `ExampleStream`) the examples are ever all held in memory.
+
+  Args:
+    examples: A list of `InputExample`s and `PaddingInputExample`s, or an
+      `ExampleStream`, which is read once to count and once to convert.
+    label_list: The labels of the task, in label id order.
+    max_seq_length: Length of the rows, including "[CLS]" and "[SEP]".
+    tokenizer: A `FullTokenizer`.
+    output_prefix: Path prefix of the files, see `feature_array_files`.
+    num_workers: Number of processes used to encode the texts.
+    chunk_size: Number of examples converted at a time.
+
+  Returns:
+    The written arrays, as returned by `load_feature_arrays`.
+  """
+  if isinstance(examples, list):
+    num_examples = len(examples)
+  else:
+    num_examples = sum(1 for _ in examples)
+
+  files = feature_array_files(output_prefix)
+  arrays = collections.OrderedDict()
+  for (name, path) in files.items():
+    shape = [num_examples]
+    if name in ("input_ids", "input_mask", "segment_ids"):
+      shape.append(max_seq_length)
+    arrays[name] = np.lib.format.open_memmap(
+        path, mode="w+", dtype=np.int32, shape=tuple(shape))
+
+  examples = iter(examples)
+  start = 0
+  while start < num_examples:
+    chunk = [example for (_, example) in zip(range(chunk_size), examples)]
+    chunk_arrays = convert_examples_to_arrays(
+        chunk, label_list, max_seq_length, tokenizer, num_workers=num_workers)
+    for (name, array) in arrays.items():
+      array[start:start + len(chunk)] = chunk_arrays[name]
+    start += len(chunk)
+
+  for array in arrays.values():
+    array.flush()
+  del arrays
+  return load_feature_arrays(output_prefix)
+
+
+def load_feature_arrays(output_prefix):
+  """Memory-maps the arrays written by `write_feature_arrays`, read only."""
+  return collections.OrderedDict(
+      (name, np.load(path, mmap_mode="r"))
+      for (name, path) in feature_array_files(output_prefix).items())
+
+
+def _file_exists(path):
+  if "://" in path:
+    import tensorflow as tf  # pylint: disable=g-import-not-at-top
+    return tf.gfile.Exists(path)
+  return os.path.exists(path)
+
+
+def vocab_hash(vocab):
+  """Returns a hex digest identifying the tokens and ids of `vocab`.
+
+  Only the vocab contents are hashed, so a vocab.txt and its compiled binary
+  version give the same digest.
+  """
+  sha1 = hashlib.sha1()
+  for (token, index) in sorted(vocab.items(), key=lambda item: item[1]):
+    sha1.update(("%d\t%s\n" % (index, token)).encode("utf-8"))
+  return sha1.hexdigest()
+
+
+def write_run_metadata(output_dir, label_list, max_seq_length, tokenizer):
+  """Writes the metadata a model trained in `output_dir` is served with.
+
+  Args:
+    output_dir: The model directory of the run.
+    label_list: The labels of the task, in label id order.
+    max_seq_length: The sequence length the examples were converted with.
+    tokenizer: The `FullTokenizer` the examples were converted with.
+
+  Returns:
+    The metadata dict that was written.
+  """
+  metadata = collections.OrderedDict()
+  metadata["labels"] = list(label_list)
+  metadata["max_seq_length"] = max_seq_length
+  metadata["do_lower_case"] = tokenizer.basic_tokenizer.do_lower_case
+  metadata["vocab_size"] = len(tokenizer.vocab)
+  metadata["vocab_hash"] = vocab_hash(tokenizer.vocab)
+
+  with tokenization.open_file(os.path.join(output_dir, RUN_METADATA_FILE),
+                              "w") as writer:
+    writer.write(six.text_type(json.dumps(metadata, indent=2)))
+
+  label_map = collections.OrderedDict()
+  for (i, label) in enumerate(label_list):
+    label_map[label] = i
+  with tokenization.open_file(os.path.join(output_dir, LABEL2ID_FILE),
+                              "wb") as writer:
+    pickle.dump(dict(label_map), writer)
+  return metadata
+
+
+def load_run_metadata(model_dir):
+  """Reads the run metadata written by `write_run_metadata`.
+
+  Directories of older runs that only have a label2id.pkl give a metadata dict
+  with just "labels".
+
+  Returns:
+    The metadata dict, or None if `model_dir` has neither file.
+  """
+  metadata_file = os.path.join(model_dir, RUN_METADATA_FILE)
+  if _file_exists(metadata_file):
+    with tokenization.open_file(metadata_file) as reader:
+      return json.loads(reader.read())
+
+  label2id_file = os.path.join(model_dir, LABEL2ID_FILE)
+  if _file_exists(label2id_file):
+    with tokenization.open_file(label2id_file, "rb") as reader:
+      label2id = pickle.load(reader)
+    return {"labels": sorted(label2id, key=label2id.get)}
+  return None
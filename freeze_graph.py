@@ -7,13 +7,16 @@
 
 """
 
+import math
 import os
+import re
 from termcolor import colored
 import modeling
 import logging
 import tensorflow as tf
 import argparse
-import pickle
+import tempfile
+import featurization
 
 
 def set_logger(context, verbose=False):
@@ -51,7 +54,8 @@ class NTLogger:
     def warning(self, msg, **kwargs):
         print('W:%s:%s' % (self.context, msg), flush=True)
 
-def create_classification_model(bert_config, is_training, input_ids, input_mask, segment_ids, labels, num_labels):
+def create_classification_model(bert_config, is_training, input_ids, input_mask, segment_ids, labels, num_labels,
+                                fused_qkv=False, compute_type=tf.float32):
     """
 
     :param bert_config:
@@ -62,6 +66,8 @@ def create_classification_model(bert_config, is_training, input_ids, input_mask,
     :param labels:
     :param num_labels:
     :param use_one_hot_embedding:
+    :param fused_qkv: 每层attention的query/key/value合并为一次矩阵乘(需要fuse_qkv_checkpoint转换后的ckpt)
+    :param compute_type: encoder的计算精度, tf.float32/tf.float16/tf.bfloat16
     :return:
     """
 
@@ -75,6 +81,8 @@ def create_classification_model(bert_config, is_training, input_ids, input_mask,
         input_ids=input_ids,
         input_mask=input_mask,
         token_type_ids=segment_ids,
+        fused_qkv=fused_qkv,
+        compute_type=compute_type,
     )
 
     embedding_layer = model.get_sequence_output()
@@ -120,21 +128,79 @@ def create_classification_model(bert_config, is_training, input_ids, input_mask,
     return (loss, per_example_loss, logits, probabilities)
 
 
+def find_exit_layers(checkpoint):
+    """从ckpt中找出训练了提前退出分类器的层(run_classifier_serving.py --early_exit_layers)，返回{层号: 隐层维度}"""
+    exit_layers = {}
+    for name, shape in tf.train.list_variables(checkpoint):
+        m = re.match('^exit_layer_(\\d+)/pooler/kernel$', name)
+        if m is not None:
+            exit_layers[int(m.group(1))] = shape[-1]
+    return exit_layers
+
+
+def create_early_exit_model(bert_config, input_ids, input_mask, num_labels, exit_layers, entropy_threshold,
+                            fused_qkv=False, compute_type=tf.float32):
+    """
+    构建提前退出的分类图：每个退出层(及最后一层)之后计算分类概率的归一化熵，
+    当batch中所有样本的熵都小于阈值时直接输出该层的概率，跳过后面的层
+    :param exit_layers: {层号: 隐层维度}, 见find_exit_layers
+    :param entropy_threshold: 熵阈值(0~1)的默认值，推理时可通过exit_entropy_threshold节点修改
+    :return: (probabilities, exit_layer) exit_layer为实际运行的层数
+    """
+    root_scope = tf.get_variable_scope()
+    threshold = tf.placeholder_with_default(float(entropy_threshold), [], 'exit_entropy_threshold')
+
+    def exit_fn(layer_idx, layer_output):
+        layer_number = layer_idx + 1
+        first_token_tensor = layer_output[:, 0]
+        # 与训练时的变量名保持一致
+        with tf.variable_scope(root_scope):
+            if layer_number == bert_config.num_hidden_layers:
+                with tf.variable_scope('bert/pooler'):
+                    output_layer = tf.layers.dense(
+                        first_token_tensor, bert_config.hidden_size, activation=tf.tanh, name='dense')
+                output_weights = tf.get_variable('output_weights', [num_labels, bert_config.hidden_size])
+                output_bias = tf.get_variable('output_bias', [num_labels])
+                logits = tf.nn.bias_add(tf.matmul(output_layer, output_weights, transpose_b=True), output_bias)
+            elif layer_number in exit_layers:
+                with tf.variable_scope('exit_layer_%d' % layer_number):
+                    exit_hidden = tf.layers.dense(
+                        first_token_tensor, exit_layers[layer_number], activation=tf.tanh, name='pooler')
+                    logits = tf.layers.dense(exit_hidden, num_labels, name='classifier')
+            else:
+                return None
+        probabilities = tf.nn.softmax(logits, axis=-1)
+        entropy = -tf.reduce_sum(probabilities * tf.log(probabilities + 1e-12), axis=-1) / math.log(num_labels)
+        return tf.reduce_max(entropy) < threshold, probabilities
+
+    model = modeling.BertModel(
+        config=bert_config,
+        is_training=False,
+        input_ids=input_ids,
+        input_mask=input_mask,
+        fused_qkv=fused_qkv,
+        compute_type=compute_type,
+        exit_fn=exit_fn,
+    )
+    return model.get_exit_outputs(), model.get_exit_layer()
+
+
 def init_predict_var(path):
+    """读取训练时写入的run_metadata.json(或旧的label2id.pkl)，返回num_labels、label2id、id2label和max_seq_length"""
     num_labels = 2
     label2id = None
     id2label = None
-    label2id_file = os.path.join(path, 'label2id.pkl')
-    if os.path.exists(label2id_file):
-        with open(label2id_file, 'rb') as rf:
-            label2id = pickle.load(rf)
-            id2label = {value: key for key, value in label2id.items()}
-            num_labels = len(label2id.items())
+    max_seq_length = None
+    metadata = featurization.load_run_metadata(path)
+    if metadata is not None:
+        label2id = {label: i for i, label in enumerate(metadata['labels'])}
+        id2label = {value: key for key, value in label2id.items()}
+        num_labels = len(label2id.items())
+        max_seq_length = metadata.get('max_seq_length')
         print('num_labels:%d' % num_labels)
     else:
-        print('Can\'t found %s' % label2id_file)
-    return num_labels, label2id, id2label
-
+        print('Can\'t found %s' % os.path.join(path, featurization.RUN_METADATA_FILE))
+    return num_labels, label2id, id2label, max_seq_length
 
 
 def optimize_class_model(args, logger=None):
@@ -156,26 +222,58 @@ def optimize_class_model(args, logger=None):
         else:
             tmp_dir = args.model_pb_dir
 
-        pb_file = os.path.join(tmp_dir, 'classification_model.pb')
+        early_exit = getattr(args, 'exit_entropy_threshold', None) is not None
+        # 文件名带上融合/精度/提前退出的设置，避免已存在的其他设置的pb被直接返回
+        pb_name = 'classification_model'
+        if getattr(args, 'fused_qkv', False):
+            pb_name += '_fused_qkv'
+        if getattr(args, 'precision', 'fp32') != 'fp32':
+            pb_name += '_' + args.precision
+        if early_exit:
+            # 阈值是exit_entropy_threshold节点的默认值，不同阈值导出不同的pb
+            pb_name += '_early_exit_%g' % args.exit_entropy_threshold
+        pb_file = os.path.join(tmp_dir, pb_name + '.pb')
         if os.path.exists(pb_file):
             print('pb_file exits', pb_file)
             return pb_file
         
-        #增加 从label2id.pkl中读取num_labels, 这样也可以不用指定num_labels参数； 2019/4/17
-        if not args.num_labels:
-            num_labels, label2id, id2label = init_predict_var(tmp_dir)
+        #增加 从run_metadata.json中读取num_labels和max_seq_len, 这样也可以不用指定这两个参数； 2019/4/17
+        num_labels, label2id, id2label, max_seq_len = init_predict_var(args.model_dir)
+        if args.num_labels:
+            num_labels = args.num_labels
+        if args.max_seq_len:
+            max_seq_len = args.max_seq_len
+        elif not max_seq_len:
+            max_seq_len = 128
         #---
 
         graph = tf.Graph()
         with graph.as_default():
             with tf.Session() as sess:
-                input_ids = tf.placeholder(tf.int32, (None, args.max_seq_len), 'input_ids')
-                input_mask = tf.placeholder(tf.int32, (None, args.max_seq_len), 'input_mask')
+                input_ids = tf.placeholder(tf.int32, (None, max_seq_len), 'input_ids')
+                input_mask = tf.placeholder(tf.int32, (None, max_seq_len), 'input_mask')
 
                 bert_config = modeling.BertConfig.from_json_file(os.path.join(args.bert_model_dir, 'bert_config.json'))
 
-                loss, per_example_loss, logits, probabilities = create_classification_model(bert_config=bert_config, is_training=False,
-                    input_ids=input_ids, input_mask=input_mask, segment_ids=None, labels=None, num_labels=num_labels)
+                compute_type = modeling.get_compute_type(getattr(args, 'precision', 'fp32'))
+                output_node_names = ['pred_prob']
+                if early_exit:
+                    exit_layers = find_exit_layers(tf.train.latest_checkpoint(args.model_dir))
+                    if not exit_layers:
+                        raise ValueError('no early-exit classifiers in the checkpoint, '
+                                         'train with run_classifier_serving.py --early_exit_layers')
+                    logger.info('early exit after layers %s, entropy threshold %.3f' % (
+                        sorted(exit_layers), args.exit_entropy_threshold))
+                    probabilities, exit_layer = create_early_exit_model(
+                        bert_config, input_ids, input_mask, num_labels, exit_layers, args.exit_entropy_threshold,
+                        fused_qkv=getattr(args, 'fused_qkv', False), compute_type=compute_type)
+                    tf.identity(exit_layer, 'exit_layer')
+                    output_node_names.append('exit_layer')
+                else:
+                    loss, per_example_loss, logits, probabilities = create_classification_model(bert_config=bert_config, is_training=False,
+                        input_ids=input_ids, input_mask=input_mask, segment_ids=None, labels=None, num_labels=num_labels,
+                        fused_qkv=getattr(args, 'fused_qkv', False),
+                        compute_type=compute_type)
                 
                 # pred_ids = tf.argmax(probabilities, axis=-1, output_type=tf.int32, name='pred_ids')
                 # pred_ids = tf.identity(pred_ids, 'pred_ids')
@@ -186,17 +284,31 @@ def optimize_class_model(args, logger=None):
             with tf.Session() as sess:
                 sess.run(tf.global_variables_initializer())
                 latest_checkpoint = tf.train.latest_checkpoint(args.model_dir)
+                if getattr(args, 'fused_qkv', False):
+                    # 把ckpt中每层的query/key/value权重拼接成qkv，再冻结融合后的图
+                    fused_dir = tempfile.mkdtemp()
+                    latest_checkpoint = modeling.fuse_qkv_checkpoint(
+                        latest_checkpoint, os.path.join(fused_dir, 'fused_qkv.ckpt'))
                 logger.info('loading... %s ' % latest_checkpoint )
                 saver.restore(sess,latest_checkpoint )
                 logger.info('freeze...')
                 from tensorflow.python.framework import graph_util
-                tmp_g = graph_util.convert_variables_to_constants(sess, graph.as_graph_def(), ['pred_prob'])
+                tmp_g = graph_util.convert_variables_to_constants(sess, graph.as_graph_def(), output_node_names)
+                if getattr(args, 'precision', 'fp32') != 'fp32':
+                    # 把float32权重到半精度的Cast折叠成常量，pb中直接保存半精度权重，推理时不再逐次转换
+                    from tensorflow.tools.graph_transforms import TransformGraph
+                    tmp_g = TransformGraph(tmp_g, ['input_ids', 'input_mask'], output_node_names,
+                                           ['fold_constants(ignore_errors=true)'])
                 logger.info('predict cut finished !!!')
         
         # 存储二进制模型到文件中
         logger.info('write graph to a tmp file: %s' % pb_file)
         with tf.gfile.GFile(pb_file, 'wb') as f:
             f.write(tmp_g.SerializeToString())
+        # pb文件与训练时的元数据放在一起，推理端据此得到标签和max_seq_len
+        metadata_file = os.path.join(args.model_dir, featurization.RUN_METADATA_FILE)
+        if tmp_dir != args.model_dir and tf.gfile.Exists(metadata_file):
+            tf.gfile.Copy(metadata_file, os.path.join(tmp_dir, featurization.RUN_METADATA_FILE), overwrite=True)
         return pb_file
     except Exception as e:
         logger.error('fail to optimize the graph! %s' % e, exc_info=True)
@@ -223,10 +335,19 @@ if __name__ == '__main__':
                         help='directory of a pretrained BERT model')
     parser.add_argument('-model_pb_dir', type=str, default=None,
                         help='directory of a pretrained BERT model,default = model_dir')
-    parser.add_argument('-max_seq_len', type=int, default=128,
-                        help='maximum length of a sequence,default:128')
+    parser.add_argument('-max_seq_len', type=int, default=None,
+                        help='maximum length of a sequence, default: read from run_metadata.json, else 128')
     parser.add_argument('-num_labels', type=int, default=None,
-                        help='length of all labels,default=2')
+                        help='length of all labels, default: read from run_metadata.json, else 2')
+    parser.add_argument('-fused_qkv', action='store_true', default=False,
+                        help='fuse the query/key/value projections of every layer into one matmul '
+                             '(classification_model_fused_qkv.pb)')
+    parser.add_argument('-precision', type=str, default='fp32', choices=['fp32', 'fp16', 'bf16'],
+                        help='precision of the encoder in the pb file (classification_model_bf16.pb etc.), '
+                             'bf16 for CPUs with AVX512-BF16/AMX')
+    parser.add_argument('-exit_entropy_threshold', type=float, default=None,
+                        help='build an early-exit graph (classification_model_early_exit_<threshold>.pb) from the early-exit '
+                             'classifiers in the checkpoint, exiting when the normalized entropy is below this value')
     parser.add_argument('-verbose', action='store_true', default=False,
                         help='turn on tensorflow logging for debug')
 
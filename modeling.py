@@ -23,6 +23,7 @@ import copy
 import json
 import math
 import re
+import numpy as np
 import six
 import tensorflow as tf
 
@@ -134,7 +135,13 @@ class BertModel(object):
                input_mask=None,
                token_type_ids=None,
                use_one_hot_embeddings=True,
-               scope=None):
+               scope=None,
+               position_ids=None,
+               packing_ids=None,
+               cls_positions=None,
+               fused_qkv=False,
+               compute_type=tf.float32,
+               exit_fn=None):
     """Constructor for BertModel.
 
     Args:
@@ -149,6 +156,29 @@ class BertModel(object):
         it is much faster if this is True, on the CPU or GPU, it is faster if
         this is False.
       scope: (optional) variable scope. Defaults to "bert".
+      position_ids: (optional) int32 Tensor of shape [batch_size, seq_length]
+        with the position of every token. Defaults to 0, 1, 2, ... in every
+        row. Packed rows restart the positions for every example.
+      packing_ids: (optional) int32 Tensor of shape [batch_size, seq_length].
+        For rows packing several examples: k for the tokens of the k-th
+        example (from 1), 0 for padding. Tokens then only attend to tokens of
+        the same example, and `input_mask` is not used.
+      cls_positions: (optional) int32 Tensor of shape [batch_size,
+        max_examples_per_row] with the position of the "[CLS]" token of every
+        packed example. The pooled output then has one row per position, i.e.
+        shape [batch_size * max_examples_per_row, hidden_size].
+      fused_qkv: (optional) bool. Whether every attention layer computes query,
+        key and value with one fused "qkv" projection. Such a model is loaded
+        from a checkpoint converted by `fuse_qkv_checkpoint`.
+      compute_type: (optional) tf.float32, tf.float16 or tf.bfloat16. The
+        dtype of the Transformer encoder's activations and matmuls. Variables
+        are always stored in float32 (see `get_custom_getter`), and the
+        embeddings, layer normalization, attention softmax and outputs of the
+        model stay in float32.
+      exit_fn: (optional) function `(layer_idx, layer_output) -> exit` for
+        early exiting, see `transformer_model`; `layer_output` is float32.
+        The model then only has `get_exit_outputs` and `get_exit_layer`, the
+        sequence and pooled outputs are not built.
 
     Raises:
       ValueError: The config is invalid or one of the input tensor shapes
@@ -169,7 +199,8 @@ class BertModel(object):
     if token_type_ids is None:
       token_type_ids = tf.zeros(shape=[batch_size, seq_length], dtype=tf.int32)
 
-    with tf.variable_scope(scope, default_name="bert"):
+    with tf.variable_scope(scope, default_name="bert",
+                           custom_getter=get_custom_getter(compute_type)):
       with tf.variable_scope("embeddings"):
         # Perform embedding lookup on the word ids.
         (self.embedding_output, self.embedding_table) = embedding_lookup(
@@ -192,14 +223,37 @@ class BertModel(object):
             position_embedding_name="position_embeddings",
             initializer_range=config.initializer_range,
             max_position_embeddings=config.max_position_embeddings,
-            dropout_prob=config.hidden_dropout_prob)
+            dropout_prob=config.hidden_dropout_prob,
+            position_ids=position_ids)
 
       with tf.variable_scope("encoder"):
         # This converts a 2D mask of shape [batch_size, seq_length] to a 3D
         # mask of shape [batch_size, seq_length, seq_length] which is used
         # for the attention scores.
-        attention_mask = create_attention_mask_from_input_mask(
-            input_ids, input_mask)
+        if packing_ids is not None:
+          attention_mask = create_attention_mask_from_input_mask(
+              input_ids, packing_ids, from_mask=packing_ids)
+        else:
+          attention_mask = create_attention_mask_from_input_mask(
+              input_ids, input_mask)
+
+        if exit_fn is not None:
+          (self.exit_outputs, self.exit_layer) = transformer_model(
+              input_tensor=self.embedding_output,
+              attention_mask=attention_mask,
+              hidden_size=config.hidden_size,
+              num_hidden_layers=config.num_hidden_layers,
+              num_attention_heads=config.num_attention_heads,
+              intermediate_size=config.intermediate_size,
+              intermediate_act_fn=get_activation(config.hidden_act),
+              hidden_dropout_prob=config.hidden_dropout_prob,
+              attention_probs_dropout_prob=config.attention_probs_dropout_prob,
+              initializer_range=config.initializer_range,
+              fused_qkv=fused_qkv,
+              compute_type=compute_type,
+              exit_fn=lambda layer_idx, layer_output: exit_fn(
+                  layer_idx, tf.cast(layer_output, tf.float32)))
+          return
 
         # Run the stacked transformer.
         # `sequence_output` shape = [batch_size, seq_length, hidden_size].
@@ -214,7 +268,12 @@ class BertModel(object):
             hidden_dropout_prob=config.hidden_dropout_prob,
             attention_probs_dropout_prob=config.attention_probs_dropout_prob,
             initializer_range=config.initializer_range,
-            do_return_all_layers=True)
+            do_return_all_layers=True,
+            fused_qkv=fused_qkv,
+            compute_type=compute_type)
+        self.all_encoder_layers = [
+            tf.cast(layer, tf.float32) for layer in self.all_encoder_layers
+        ]
 
       self.sequence_output = self.all_encoder_layers[-1]
       # The "pooler" converts the encoded sequence tensor of shape
@@ -225,7 +284,12 @@ class BertModel(object):
       with tf.variable_scope("pooler"):
         # We "pool" the model by simply taking the hidden state corresponding
         # to the first token. We assume that this has been pre-trained
-        first_token_tensor = tf.squeeze(self.sequence_output[:, 0:1, :], axis=1)
+        if cls_positions is not None:
+          first_token_tensor = gather_indexes(self.sequence_output,
+                                              cls_positions)
+        else:
+          first_token_tensor = tf.squeeze(self.sequence_output[:, 0:1, :],
+                                          axis=1)
         self.pooled_output = tf.layers.dense(
             first_token_tensor,
             config.hidden_size,
@@ -261,6 +325,14 @@ class BertModel(object):
   def get_embedding_table(self):
     return self.embedding_table
 
+  def get_exit_outputs(self):
+    """Gets the outputs of the exit taken, for a model built with `exit_fn`."""
+    return self.exit_outputs
+
+  def get_exit_layer(self):
+    """Gets the int32 number of encoder layers run before exiting."""
+    return self.exit_layer
+
 
 def gelu(input_tensor):
   """Gaussian Error Linear Unit.
@@ -274,8 +346,10 @@ def gelu(input_tensor):
   Returns:
     `input_tensor` with the GELU activation applied.
   """
-  cdf = 0.5 * (1.0 + tf.erf(input_tensor / tf.sqrt(2.0)))
-  return input_tensor * cdf
+  # There is no bfloat16 kernel for `tf.erf`, so the CDF is computed in float32.
+  cdf = 0.5 * (1.0 + tf.erf(tf.cast(input_tensor, tf.float32) /
+                            math.sqrt(2.0)))
+  return input_tensor * tf.cast(cdf, input_tensor.dtype)
 
 
 def get_activation(activation_string):
@@ -342,6 +416,57 @@ def get_assignment_map_from_checkpoint(tvars, init_checkpoint):
   return (assignment_map, initialized_variable_names)
 
 
+def fuse_qkv_checkpoint(init_checkpoint, output_checkpoint):
+  """Writes a copy of a checkpoint for a model built with `fused_qkv=True`.
+
+  The "query", "key" and "value" kernels and biases of every
+  "layer_N/attention/self" scope (and their optimizer slots, e.g. "adam_m")
+  are concatenated along the last axis into a single "qkv" variable. All other
+  variables are copied unchanged.
+
+  Args:
+    init_checkpoint: Path of a checkpoint of an unfused model.
+    output_checkpoint: Path prefix of the checkpoint to write.
+
+  Returns:
+    The path of the written checkpoint.
+  """
+  reader = tf.train.load_checkpoint(init_checkpoint)
+  shapes = reader.get_variable_to_shape_map()
+
+  values = collections.OrderedDict()
+  fused = {}
+  for name in sorted(shapes):
+    m = re.match("^(.*/attention/self/)(query|key|value)(/.*)$", name)
+    if m is None:
+      values[name] = reader.get_tensor(name)
+      continue
+    (prefix, part, suffix) = m.groups()
+    fused.setdefault((prefix, suffix), {})[part] = reader.get_tensor(name)
+
+  for ((prefix, suffix), parts) in sorted(fused.items()):
+    if sorted(parts) != ["key", "query", "value"]:
+      raise ValueError("Incomplete query/key/value variables under %s" %
+                       prefix)
+    values[prefix + "qkv" + suffix] = np.concatenate(
+        [parts["query"], parts["key"], parts["value"]], axis=-1)
+  tf.logging.info("Fused the query/key/value projections of %d layers",
+                  len(set(prefix for (prefix, _) in fused)))
+
+  with tf.Graph().as_default():
+    placeholders = []
+    variables = []
+    for (name, value) in values.items():
+      placeholder = tf.placeholder(tf.as_dtype(value.dtype), value.shape)
+      placeholders.append((placeholder, value))
+      variables.append(tf.Variable(placeholder, name=name))
+    saver = tf.train.Saver(variables)
+    with tf.Session() as sess:
+      sess.run(tf.global_variables_initializer(),
+               feed_dict=dict(placeholders))
+      return saver.save(sess, output_checkpoint, write_meta_graph=False)
+
+
 def dropout(input_tensor, dropout_prob):
   """Perform dropout.
 
@@ -361,9 +486,15 @@ def dropout(input_tensor, dropout_prob):
 
 
 def layer_norm(input_tensor, name=None):
-  """Run layer normalization on the last dimension of the tensor."""
-  return tf.contrib.layers.layer_norm(
-      inputs=input_tensor, begin_norm_axis=-1, begin_params_axis=-1, scope=name)
+  """Run layer normalization on the last dimension of the tensor.
+
+  The statistics are computed in float32, also for float16 and bfloat16
+  inputs; the output has the dtype of `input_tensor`.
+  """
+  output_tensor = tf.contrib.layers.layer_norm(
+      inputs=tf.cast(input_tensor, tf.float32), begin_norm_axis=-1,
+      begin_params_axis=-1, scope=name)
+  return tf.cast(output_tensor, input_tensor.dtype)
 
 
 def layer_norm_and_dropout(input_tensor, dropout_prob, name=None):
@@ -378,6 +509,42 @@ def create_initializer(initializer_range=0.02):
   return tf.truncated_normal_initializer(stddev=initializer_range)
 
 
+def get_compute_type(precision):
+  """Maps "fp32", "fp16" or "bf16" to the corresponding TF dtype."""
+  compute_types = {
+      "fp32": tf.float32,
+      "fp16": tf.float16,
+      "bf16": tf.bfloat16,
+  }
+  if precision not in compute_types:
+    raise ValueError("Unsupported precision: %s" % precision)
+  return compute_types[precision]
+
+
+def float32_variable_storage_getter(getter, name, shape=None, dtype=None,
+                                    initializer=None, regularizer=None,
+                                    trainable=True, *args, **kwargs):
+  """Custom getter creating trainable variables in float32.
+
+  Layers computing in float16 or bfloat16 get a cast of the float32 variable,
+  so the checkpoints and the optimizer's master weights stay in float32.
+  """
+  storage_dtype = tf.float32 if trainable else dtype
+  variable = getter(name, shape, dtype=storage_dtype, initializer=initializer,
+                    regularizer=regularizer, trainable=trainable, *args,
+                    **kwargs)
+  if trainable and dtype is not None and dtype != tf.float32:
+    variable = tf.cast(variable, dtype)
+  return variable
+
+
+def get_custom_getter(compute_type):
+  """Returns the variable custom getter for `compute_type`, or None."""
+  if compute_type in (tf.float16, tf.bfloat16):
+    return float32_variable_storage_getter
+  return None
+
+
 def embedding_lookup(input_ids,
                      vocab_size,
                      embedding_size=128,
@@ -436,7 +603,8 @@ def embedding_postprocessor(input_tensor,
                             position_embedding_name="position_embeddings",
                             initializer_range=0.02,
                             max_position_embeddings=512,
-                            dropout_prob=0.1):
+                            dropout_prob=0.1,
+                            position_ids=None):
   """Performs various post-processing on a word embedding tensor.
 
   Args:
@@ -457,6 +625,8 @@ def embedding_postprocessor(input_tensor,
       used with this model. This can be longer than the sequence length of
       input_tensor, but cannot be shorter.
     dropout_prob: float. Dropout probability applied to the final output tensor.
+    position_ids: (optional) int32 Tensor of shape [batch_size, seq_length]
+      with the position of every token. Defaults to 0, 1, 2, ... in every row.
 
   Returns:
     float tensor with same shape as `input_tensor`.
@@ -504,31 +674,41 @@ def embedding_postprocessor(input_tensor,
       # for position [0, 1, 2, ..., max_position_embeddings-1], and the current
       # sequence has positions [0, 1, 2, ... seq_length-1], so we can just
       # perform a slice.
-      position_embeddings = tf.slice(full_position_embeddings, [0, 0],
-                                     [seq_length, -1])
-      num_dims = len(output.shape.as_list())
-
-      # Only the last two dimensions are relevant (`seq_length` and `width`), so
-      # we broadcast among the first dimensions, which is typically just
-      # the batch size.
-      position_broadcast_shape = []
-      for _ in range(num_dims - 2):
-        position_broadcast_shape.append(1)
-      position_broadcast_shape.extend([seq_length, width])
-      position_embeddings = tf.reshape(position_embeddings,
-                                       position_broadcast_shape)
+      if position_ids is not None:
+        # E.g. packed rows, where every example starts again at position 0.
+        position_embeddings = tf.gather(full_position_embeddings, position_ids)
+      else:
+        position_embeddings = tf.slice(full_position_embeddings, [0, 0],
+                                       [seq_length, -1])
+        num_dims = len(output.shape.as_list())
+
+        # Only the last two dimensions are relevant (`seq_length` and
+        # `width`), so we broadcast among the first dimensions, which is
+        # typically just the batch size.
+        position_broadcast_shape = []
+        for _ in range(num_dims - 2):
+          position_broadcast_shape.append(1)
+        position_broadcast_shape.extend([seq_length, width])
+        position_embeddings = tf.reshape(position_embeddings,
+                                         position_broadcast_shape)
       output += position_embeddings
 
   output = layer_norm_and_dropout(output, dropout_prob)
   return output
 
 
-def create_attention_mask_from_input_mask(from_tensor, to_mask):
+def create_attention_mask_from_input_mask(from_tensor, to_mask,
+                                          from_mask=None):
   """Create 3D attention mask from a 2D tensor mask.
 
+  With `from_mask`, both masks hold packing ids (see `BertModel`) and the mask
+  is block diagonal: token i attends to token j only if
+  from_mask[i] == to_mask[j] != 0.
+
   Args:
     from_tensor: 2D or 3D Tensor of shape [batch_size, from_seq_length, ...].
     to_mask: int32 Tensor of shape [batch_size, to_seq_length].
+    from_mask: (optional) int32 Tensor of shape [batch_size, from_seq_length].
 
   Returns:
     float Tensor of shape [batch_size, from_seq_length, to_seq_length].
@@ -540,6 +720,14 @@ def create_attention_mask_from_input_mask(from_tensor, to_mask):
   to_shape = get_shape_list(to_mask, expected_rank=2)
   to_seq_length = to_shape[1]
 
+  if from_mask is not None:
+    same_example = tf.equal(
+        tf.reshape(from_mask, [batch_size, from_seq_length, 1]),
+        tf.reshape(to_mask, [batch_size, 1, to_seq_length]))
+    not_padding = tf.not_equal(
+        tf.reshape(to_mask, [batch_size, 1, to_seq_length]), 0)
+    return tf.cast(tf.logical_and(same_example, not_padding), tf.float32)
+
   to_mask = tf.cast(
       tf.reshape(to_mask, [batch_size, 1, to_seq_length]), tf.float32)
 
@@ -570,7 +758,8 @@ def attention_layer(from_tensor,
                     do_return_2d_tensor=False,
                     batch_size=None,
                     from_seq_length=None,
-                    to_seq_length=None):
+                    to_seq_length=None,
+                    fused_qkv=False):
   """Performs multi-headed attention from `from_tensor` to `to_tensor`.
 
   This is an implementation of multi-headed attention based on "Attention
@@ -617,6 +806,11 @@ def attention_layer(from_tensor,
       of the 3D version of the `from_tensor`.
     to_seq_length: (Optional) If the input is 2D, this might be the seq length
       of the 3D version of the `to_tensor`.
+    fused_qkv: bool. Whether to compute the query, key and value projections
+      with a single "qkv" dense layer of width 3 * N * H, whose kernel is the
+      concatenation of the "query", "key" and "value" kernels (see
+      `fuse_qkv_checkpoint`). Only for self-attention, i.e. when `from_tensor`
+      is `to_tensor`.
 
   Returns:
     float Tensor of shape [batch_size, from_seq_length,
@@ -664,29 +858,46 @@ def attention_layer(from_tensor,
   from_tensor_2d = reshape_to_matrix(from_tensor)
   to_tensor_2d = reshape_to_matrix(to_tensor)
 
-  # `query_layer` = [B*F, N*H]
-  query_layer = tf.layers.dense(
-      from_tensor_2d,
-      num_attention_heads * size_per_head,
-      activation=query_act,
-      name="query",
-      kernel_initializer=create_initializer(initializer_range))
-
-  # `key_layer` = [B*T, N*H]
-  key_layer = tf.layers.dense(
-      to_tensor_2d,
-      num_attention_heads * size_per_head,
-      activation=key_act,
-      name="key",
-      kernel_initializer=create_initializer(initializer_range))
-
-  # `value_layer` = [B*T, N*H]
-  value_layer = tf.layers.dense(
-      to_tensor_2d,
-      num_attention_heads * size_per_head,
-      activation=value_act,
-      name="value",
-      kernel_initializer=create_initializer(initializer_range))
+  if fused_qkv:
+    if from_tensor is not to_tensor:
+      raise ValueError("`fused_qkv` is only supported for self-attention.")
+    # One [B*F, 3*N*H] matmul instead of three [B*F, N*H] ones.
+    qkv_layer = tf.layers.dense(
+        from_tensor_2d,
+        3 * num_attention_heads * size_per_head,
+        name="qkv",
+        kernel_initializer=create_initializer(initializer_range))
+    query_layer, key_layer, value_layer = tf.split(qkv_layer, 3, axis=-1)
+    if query_act is not None:
+      query_layer = query_act(query_layer)
+    if key_act is not None:
+      key_layer = key_act(key_layer)
+    if value_act is not None:
+      value_layer = value_act(value_layer)
+  else:
+    # `query_layer` = [B*F, N*H]
+    query_layer = tf.layers.dense(
+        from_tensor_2d,
+        num_attention_heads * size_per_head,
+        activation=query_act,
+        name="query",
+        kernel_initializer=create_initializer(initializer_range))
+
+    # `key_layer` = [B*T, N*H]
+    key_layer = tf.layers.dense(
+        to_tensor_2d,
+        num_attention_heads * size_per_head,
+        activation=key_act,
+        name="key",
+        kernel_initializer=create_initializer(initializer_range))
+
+    # `value_layer` = [B*T, N*H]
+    value_layer = tf.layers.dense(
+        to_tensor_2d,
+        num_attention_heads * size_per_head,
+        activation=value_act,
+        name="value",
+        kernel_initializer=create_initializer(initializer_range))
 
   # `query_layer` = [B, N, F, H]
   query_layer = transpose_for_scores(query_layer, batch_size,
@@ -704,6 +915,11 @@ def attention_layer(from_tensor,
   attention_scores = tf.multiply(attention_scores,
                                  1.0 / math.sqrt(float(size_per_head)))
 
+  # The mask adder and the softmax run in float32. In float16, -10000.0 is
+  # close to the largest finite value (65504) and the softmax loses precision.
+  compute_type = attention_scores.dtype
+  attention_scores = tf.cast(attention_scores, tf.float32)
+
   if attention_mask is not None:
     # `attention_mask` = [B, 1, F, T]
     attention_mask = tf.expand_dims(attention_mask, axis=[1])
@@ -719,7 +935,7 @@ def attention_layer(from_tensor,
 
   # Normalize the attention scores to probabilities.
   # `attention_probs` = [B, N, F, T]
-  attention_probs = tf.nn.softmax(attention_scores)
+  attention_probs = tf.cast(tf.nn.softmax(attention_scores), compute_type)
 
   # This is actually dropping out entire tokens to attend to, which might
   # seem a bit unusual, but is taken from the original Transformer paper.
@@ -763,7 +979,10 @@ def transformer_model(input_tensor,
                       hidden_dropout_prob=0.1,
                       attention_probs_dropout_prob=0.1,
                       initializer_range=0.02,
-                      do_return_all_layers=False):
+                      do_return_all_layers=False,
+                      fused_qkv=False,
+                      compute_type=tf.float32,
+                      exit_fn=None):
   """Multi-headed, multi-layer Transformer from "Attention is All You Need".
 
   This is almost an exact implementation of the original Transformer encoder.
@@ -793,10 +1012,24 @@ def transformer_model(input_tensor,
       normal).
     do_return_all_layers: Whether to also return all layers or just the final
       layer.
+    fused_qkv: bool. Whether the attention layers compute query, key and value
+      with one fused projection, see `attention_layer`.
+    compute_type: The dtype the layers compute in; `input_tensor` is cast to
+      it. For tf.float16 and tf.bfloat16 the variables should be created with
+      `float32_variable_storage_getter`, as `BertModel` does.
+    exit_fn: (optional) function `(layer_idx, layer_output) -> exit`, called
+      with the [batch_size, seq_length, hidden_size] output of every layer for
+      early exiting. `exit` is None to always run the next layer, or a tuple
+      `(should_exit, exit_outputs)` of a scalar bool Tensor and a Tensor whose
+      shape is the same for all layers; when `should_exit` is True, the
+      remaining layers are skipped. The last layer must return an exit, its
+      `should_exit` is ignored.
 
   Returns:
-    float Tensor of shape [batch_size, seq_length, hidden_size], the final
-    hidden layer of the Transformer.
+    Tensor of dtype `compute_type` and shape [batch_size, seq_length,
+    hidden_size], the final hidden layer of the Transformer. With `exit_fn`,
+    a tuple `(exit_outputs, exit_layer)` instead: the `exit_outputs` of the
+    first exit taken and the int32 number of layers that were run.
 
   Raises:
     ValueError: A Tensor shape or parameter is invalid.
@@ -822,13 +1055,11 @@ def transformer_model(input_tensor,
   # forth from a 3D tensor to a 2D tensor. Re-shapes are normally free on
   # the GPU/CPU but may not be free on the TPU, so we want to minimize them to
   # help the optimizer.
-  prev_output = reshape_to_matrix(input_tensor)
+  prev_output = tf.cast(reshape_to_matrix(input_tensor), compute_type)
 
-  all_layer_outputs = []
-  for layer_idx in range(num_hidden_layers):
+  def build_layer(layer_idx, layer_input):
+    """Builds the `layer_idx`-th layer on the 2D `layer_input`."""
     with tf.variable_scope("layer_%d" % layer_idx):
-      layer_input = prev_output
-
       with tf.variable_scope("attention"):
         attention_heads = []
         with tf.variable_scope("self"):
@@ -843,7 +1074,8 @@ def transformer_model(input_tensor,
               do_return_2d_tensor=True,
               batch_size=batch_size,
               from_seq_length=seq_length,
-              to_seq_length=seq_length)
+              to_seq_length=seq_length,
+              fused_qkv=fused_qkv)
           attention_heads.append(attention_head)
 
         attention_output = None
@@ -880,8 +1112,31 @@ def transformer_model(input_tensor,
             kernel_initializer=create_initializer(initializer_range))
         layer_output = dropout(layer_output, hidden_dropout_prob)
         layer_output = layer_norm(layer_output + attention_output)
-        prev_output = layer_output
-        all_layer_outputs.append(layer_output)
+    return layer_output
+
+  def build_layers_with_exits(layer_idx, layer_input):
+    """Builds the layers from `layer_idx` on, each one behind an exit."""
+    layer_output = build_layer(layer_idx, layer_input)
+    layer_exit = exit_fn(layer_idx,
+                         reshape_from_matrix(layer_output, input_shape))
+    if layer_idx == num_hidden_layers - 1:
+      if layer_exit is None:
+        raise ValueError("`exit_fn` must return an exit for the last layer.")
+      return (layer_exit[1], tf.constant(num_hidden_layers))
+    if layer_exit is None:
+      return build_layers_with_exits(layer_idx + 1, layer_output)
+    (should_exit, exit_outputs) = layer_exit
+    return tf.cond(
+        should_exit, lambda: (exit_outputs, tf.constant(layer_idx + 1)),
+        lambda: build_layers_with_exits(layer_idx + 1, layer_output))
+
+  if exit_fn is not None:
+    return build_layers_with_exits(0, prev_output)
+
+  all_layer_outputs = []
+  for layer_idx in range(num_hidden_layers):
+    prev_output = build_layer(layer_idx, prev_output)
+    all_layer_outputs.append(prev_output)
 
   if do_return_all_layers:
     final_outputs = []
@@ -931,6 +1186,30 @@ def get_shape_list(tensor, expected_rank=None, name=None):
   return shape
 
 
+def gather_indexes(sequence_tensor, positions):
+  """Gathers the vectors at the specific positions over a minibatch.
+
+  Args:
+    sequence_tensor: float Tensor of shape [batch_size, seq_length, width].
+    positions: int32 Tensor of shape [batch_size, num_positions].
+
+  Returns:
+    float Tensor of shape [batch_size * num_positions, width].
+  """
+  sequence_shape = get_shape_list(sequence_tensor, expected_rank=3)
+  batch_size = sequence_shape[0]
+  seq_length = sequence_shape[1]
+  width = sequence_shape[2]
+
+  flat_offsets = tf.reshape(
+      tf.range(0, batch_size, dtype=tf.int32) * seq_length, [-1, 1])
+  flat_positions = tf.reshape(positions + flat_offsets, [-1])
+  flat_sequence_tensor = tf.reshape(sequence_tensor,
+                                    [batch_size * seq_length, width])
+  output_tensor = tf.gather(flat_sequence_tensor, flat_positions)
+  return output_tensor
+
+
 def reshape_to_matrix(input_tensor):
   """Reshapes a >= rank 2 tensor to a rank 2 tensor (i.e., a matrix)."""
   ndims = input_tensor.shape.ndims
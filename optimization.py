@@ -22,8 +22,17 @@ import re
 import tensorflow as tf
 
 
-def create_optimizer(loss, init_lr, num_train_steps, num_warmup_steps, use_tpu):
-  """Creates an optimizer training op."""
+def create_optimizer(loss, init_lr, num_train_steps, num_warmup_steps, use_tpu,
+                     use_loss_scaling=False, init_loss_scale=2**15,
+                     loss_scale_growth_steps=2000):
+  """Creates an optimizer training op.
+
+  With `use_loss_scaling` (for float16 training), the loss is multiplied by a
+  dynamic loss scale before computing the gradients, which are divided by it
+  again. A step whose gradients are not finite leaves the variables and the
+  global step unchanged and halves the loss scale; after
+  `loss_scale_growth_steps` finite steps in a row the loss scale is doubled.
+  """
   global_step = tf.train.get_or_create_global_step()
 
   learning_rate = tf.constant(value=init_lr, shape=[], dtype=tf.float32)
@@ -68,22 +77,55 @@ def create_optimizer(loss, init_lr, num_train_steps, num_warmup_steps, use_tpu):
     optimizer = tf.contrib.tpu.CrossShardOptimizer(optimizer)
 
   tvars = tf.trainable_variables()
-  grads = tf.gradients(loss, tvars)
+  if use_loss_scaling:
+    loss_scale = tf.get_variable(
+        "loss_scale", initializer=float(init_loss_scale), trainable=False)
+    grads = tf.gradients(loss * loss_scale, tvars)
+    grads = [grad / loss_scale if grad is not None else None for grad in grads]
+    all_finite = tf.reduce_all([
+        tf.reduce_all(tf.is_finite(grad)) for grad in grads if grad is not None
+    ])
+  else:
+    grads = tf.gradients(loss, tvars)
 
   # This is how the model was pre-trained.
   (grads, _) = tf.clip_by_global_norm(grads, clip_norm=1.0)
 
-  train_op = optimizer.apply_gradients(
-      zip(grads, tvars), global_step=global_step)
+  if use_loss_scaling:
+    train_op = optimizer.apply_gradients(
+        zip(grads, tvars), global_step=global_step, should_apply=all_finite)
+  else:
+    train_op = optimizer.apply_gradients(
+        zip(grads, tvars), global_step=global_step)
 
   # Normally the global step update is done inside of `apply_gradients`.
   # However, `AdamWeightDecayOptimizer` doesn't do this. But if you use
   # a different optimizer, you should probably take this line out.
   new_global_step = global_step + 1
+  if use_loss_scaling:
+    new_global_step = tf.where(all_finite, new_global_step, global_step)
+    train_op = tf.group(
+        train_op,
+        _update_loss_scale(loss_scale, all_finite, loss_scale_growth_steps))
   train_op = tf.group(train_op, [global_step.assign(new_global_step)])
   return train_op
 
 
+def _update_loss_scale(loss_scale, all_finite, growth_steps):
+  """Halves `loss_scale` after a non-finite step, doubles it when stable."""
+  good_steps = tf.get_variable(
+      "loss_scale_good_steps", initializer=0, dtype=tf.int32, trainable=False)
+  next_good_steps = tf.where(all_finite, good_steps + 1, 0)
+  grow = next_good_steps >= growth_steps
+  next_loss_scale = tf.where(
+      all_finite, tf.where(grow, loss_scale * 2.0, loss_scale),
+      tf.maximum(loss_scale / 2.0, 1.0))
+  next_good_steps = tf.where(grow, 0, next_good_steps)
+  tf.summary.scalar("loss_scale", loss_scale)
+  return tf.group(loss_scale.assign(next_loss_scale),
+                  good_steps.assign(next_good_steps))
+
+
 class AdamWeightDecayOptimizer(tf.train.Optimizer):
   """A basic Adam optimizer that includes "correct" L2 weight decay."""
 
@@ -105,8 +147,13 @@ class AdamWeightDecayOptimizer(tf.train.Optimizer):
     self.epsilon = epsilon
     self.exclude_from_weight_decay = exclude_from_weight_decay
 
-  def apply_gradients(self, grads_and_vars, global_step=None, name=None):
-    """See base class."""
+  def apply_gradients(self, grads_and_vars, global_step=None, name=None,
+                      should_apply=None):
+    """See base class.
+
+    `should_apply` is an optional scalar bool Tensor: when it is False, the
+    variables and their Adam slots keep their values.
+    """
     assignments = []
     for (grad, param) in grads_and_vars:
       if grad is None or param is None:
@@ -150,6 +197,11 @@ class AdamWeightDecayOptimizer(tf.train.Optimizer):
 
       next_param = param - update_with_lr
 
+      if should_apply is not None:
+        (next_param, next_m, next_v) = tf.cond(
+            should_apply, lambda: (next_param, next_m, next_v),
+            lambda: (tf.identity(param), tf.identity(m), tf.identity(v)))
+
       assignments.extend(
           [param.assign(next_param),
            m.assign(next_m),
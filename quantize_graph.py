@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+   File Name：     quantize_graph
+   Description :  对freeze_graph.py导出的classification_model.pb做训练后int8量化(动态或用dat/dev.tsv校准的静态量化)，
+                  并输出与fp32模型的准确率差异和延迟对比报告
+   date：          2026/10/18
+
+"""
+
+import argparse
+import csv
+import json
+import os
+import tempfile
+import time
+
+import featurization
+import numpy as np
+import tokenization
+import tensorflow as tf
+from tensorflow.tools.graph_transforms import TransformGraph
+
+INPUT_NAMES = ['input_ids', 'input_mask']
+OUTPUT_NAMES = ['pred_prob']
+
+# 量化全连接层(MatMul)：权重转为8bit，MatMul替换为QuantizedMatMul，其余算子保持float32
+QUANTIZE_TRANSFORMS = [
+    'add_default_attributes',
+    'fold_constants(ignore_errors=true)',
+    'quantize_weights',
+    'quantize_nodes(ignore_op=Add, ignore_op=BiasAdd, ignore_op=ConcatV2, ignore_op=Mul, ignore_op=Relu, '
+    'ignore_op=Reshape)',
+    'strip_unused_nodes',
+    'sort_by_execution_order',
+]
+# 静态量化的校准：记录每个RequantizationRange的实际取值范围，再把它们冻结为常量
+LOGGING_TRANSFORMS = ['insert_logging(op=RequantizationRange, show_name=true, message="__requant_min_max:")']
+
+
+def read_examples(data_file, max_examples=None):
+    """Reads a `label\ttext` file with a header line, like dat/dev.tsv."""
+    examples = []
+    with tf.gfile.Open(data_file, 'r') as f:
+        reader = csv.reader(f, delimiter='\t', quotechar=None)
+        for (i, line) in enumerate(reader):
+            if i == 0 or len(line) < 2:
+                continue
+            examples.append(featurization.InputExample(
+                guid='dev-%d' % i, text_a=line[1], label=line[0]))
+            if max_examples and len(examples) >= max_examples:
+                break
+    return examples
+
+
+def load_graph_def(pb_file):
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(pb_file, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    return graph_def
+
+
+class GraphRunner(object):
+    """Runs a frozen classification graph on NumPy feature arrays."""
+
+    def __init__(self, graph_def):
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        self.sess = tf.Session(graph=self.graph)
+        self.input_ids = self.graph.get_tensor_by_name('input_ids:0')
+        self.input_mask = self.graph.get_tensor_by_name('input_mask:0')
+        self.pred_prob = self.graph.get_tensor_by_name('pred_prob:0')
+
+    def predict(self, arrays, batch_size):
+        probabilities = []
+        for start in range(0, len(arrays['input_ids']), batch_size):
+            probabilities.append(self.sess.run(self.pred_prob, {
+                self.input_ids: arrays['input_ids'][start:start + batch_size],
+                self.input_mask: arrays['input_mask'][start:start + batch_size]}))
+        return np.concatenate(probabilities)
+
+    def latency(self, arrays, batch_size, steps, warmup_steps):
+        """Returns the mean milliseconds per batch of `batch_size` examples."""
+        feed_dict = {self.input_ids: arrays['input_ids'][:batch_size],
+                     self.input_mask: arrays['input_mask'][:batch_size]}
+        for _ in range(warmup_steps):
+            self.sess.run(self.pred_prob, feed_dict)
+        start_time = time.time()
+        for _ in range(steps):
+            self.sess.run(self.pred_prob, feed_dict)
+        return (time.time() - start_time) * 1000.0 / steps
+
+    def close(self):
+        self.sess.close()
+
+
+def calibrate(graph_def, arrays, batch_size):
+    """Runs the logging graph on the calibration examples and returns the logged ranges file.
+
+    The Print ops of insert_logging write to the process' stderr, which is redirected to the log file meanwhile.
+    """
+    log_file = os.path.join(tempfile.mkdtemp(), 'requant_min_max.log')
+    runner = GraphRunner(graph_def)
+    stderr_fd = os.dup(2)
+    with open(log_file, 'w') as f:
+        os.dup2(f.fileno(), 2)
+        try:
+            runner.predict(arrays, batch_size)
+        finally:
+            os.dup2(stderr_fd, 2)
+            os.close(stderr_fd)
+            runner.close()
+    return log_file
+
+
+def quantize(graph_def, mode, calibration_arrays, batch_size):
+    quantized = TransformGraph(graph_def, INPUT_NAMES, OUTPUT_NAMES, QUANTIZE_TRANSFORMS)
+    if mode == 'static':
+        logged = TransformGraph(quantized, INPUT_NAMES, OUTPUT_NAMES, LOGGING_TRANSFORMS)
+        log_file = calibrate(logged, calibration_arrays, batch_size)
+        quantized = TransformGraph(quantized, INPUT_NAMES, OUTPUT_NAMES, [
+            'freeze_requantization_ranges(min_max_log_file="%s")' % log_file,
+            'sort_by_execution_order'])
+    return quantized
+
+
+def evaluate(runner, arrays, args):
+    probabilities = runner.predict(arrays, args.batch_size)
+    return probabilities, {
+        'accuracy': float((probabilities.argmax(axis=-1) == arrays['label_ids']).mean()),
+        'latency_ms': {
+            str(batch_size): runner.latency(arrays, batch_size, args.steps, args.warmup_steps)
+            for batch_size in args.latency_batch_sizes
+        },
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Post-training int8 quantization of the frozen classification graph')
+    parser.add_argument('-model_pb', type=str, required=True,
+                        help='classification_model.pb written by freeze_graph.py')
+    parser.add_argument('-vocab_file', type=str, required=True)
+    parser.add_argument('-output_pb', type=str, default=None,
+                        help='default: classification_model_int8.pb next to model_pb')
+    parser.add_argument('-mode', type=str, default='static', choices=['dynamic', 'static'],
+                        help='dynamic: activation ranges computed at run time, '
+                             'static: activation ranges calibrated on calibration_size dev examples')
+    parser.add_argument('-data_file', type=str, default='dat/dev.tsv',
+                        help='label\\ttext file with a header line')
+    parser.add_argument('-calibration_size', type=int, default=200,
+                        help='number of leading examples of data_file used for calibration')
+    parser.add_argument('-eval_size', type=int, default=None,
+                        help='number of examples of data_file used for the accuracy report, default: all')
+    parser.add_argument('-batch_size', type=int, default=32)
+    parser.add_argument('-latency_batch_sizes', type=int, nargs='+', default=[1, 32])
+    parser.add_argument('-steps', type=int, default=50,
+                        help='number of timed runs per batch size')
+    parser.add_argument('-warmup_steps', type=int, default=5)
+    parser.add_argument('-report_file', type=str, default=None,
+                        help='default: quantization_report.json next to output_pb')
+    args = parser.parse_args()
+
+    model_dir = os.path.dirname(args.model_pb)
+    output_pb = args.output_pb or os.path.join(model_dir, 'classification_model_int8.pb')
+    report_file = args.report_file or os.path.join(os.path.dirname(output_pb), 'quantization_report.json')
+
+    metadata = featurization.load_run_metadata(model_dir)
+    if not metadata or 'max_seq_length' not in metadata:
+        raise ValueError('Can\'t found %s with the labels and max_seq_length of the model'
+                         % os.path.join(model_dir, featurization.RUN_METADATA_FILE))
+    tokenizer = tokenization.FullTokenizer(
+        vocab_file=args.vocab_file, do_lower_case=metadata.get('do_lower_case', True))
+    if metadata.get('vocab_hash') not in (None, featurization.vocab_hash(tokenizer.vocab)):
+        raise ValueError('%s is not the vocab the model was trained with' % args.vocab_file)
+
+    label_list = metadata['labels']
+    examples = read_examples(args.data_file, args.eval_size)
+    arrays = featurization.convert_examples_to_arrays(
+        examples, label_list, metadata['max_seq_length'], tokenizer)
+    calibration_arrays = {name: column[:args.calibration_size] for name, column in arrays.items()}
+
+    graph_def = load_graph_def(args.model_pb)
+    quantized_graph_def = quantize(graph_def, args.mode, calibration_arrays, args.batch_size)
+    with tf.gfile.GFile(output_pb, 'wb') as f:
+        f.write(quantized_graph_def.SerializeToString())
+    print('int8 graph written to %s' % output_pb)
+
+    runner = GraphRunner(graph_def)
+    fp32_probabilities, fp32_report = evaluate(runner, arrays, args)
+    runner.close()
+    runner = GraphRunner(quantized_graph_def)
+    int8_probabilities, int8_report = evaluate(runner, arrays, args)
+    runner.close()
+
+    fp32_report['size_mb'] = tf.gfile.Stat(args.model_pb).length / 2.0 ** 20
+    int8_report['size_mb'] = tf.gfile.Stat(output_pb).length / 2.0 ** 20
+    report = {
+        'mode': args.mode,
+        'num_examples': len(examples),
+        'calibration_size': min(args.calibration_size, len(examples)) if args.mode == 'static' else 0,
+        'fp32': fp32_report,
+        'int8': int8_report,
+        'accuracy_delta': int8_report['accuracy'] - fp32_report['accuracy'],
+        'prediction_agreement': float(
+            (fp32_probabilities.argmax(axis=-1) == int8_probabilities.argmax(axis=-1)).mean()),
+        'max_probability_diff': float(np.abs(fp32_probabilities - int8_probabilities).max()),
+    }
+    with tf.gfile.GFile(report_file, 'w') as f:
+        f.write(json.dumps(report, indent=2))
+
+    print('%-5s %8s %9s %s' % ('', 'accuracy', 'size(MB)', '  '.join(
+        'batch %d(ms)' % batch_size for batch_size in args.latency_batch_sizes)))
+    for name, model_report in [('fp32', fp32_report), ('int8', int8_report)]:
+        print('%-5s %8.4f %9.1f %s' % (name, model_report['accuracy'], model_report['size_mb'], '  '.join(
+            '%12.2f' % model_report['latency_ms'][str(batch_size)] for batch_size in args.latency_batch_sizes)))
+    print('accuracy delta %+.4f, prediction agreement %.4f, report written to %s' % (
+        report['accuracy_delta'], report['prediction_agreement'], report_file))
@@ -0,0 +1,598 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Writing and reading (sharded) TFRecord files of classification features.
+
+A record set named e.g. "train.tf_record" is written either as that single
+file or as "train-00000-of-00004.tf_record", ... shards, and is described by a
+"train.manifest.json" listing the files, their record counts and their
+compression. The manifest also records a key hashing everything the features
+depend on, so an unchanged record set is reused instead of being rebuilt.
+
+Records are either padded to `max_seq_length`, or written "varlen": only the
+real tokens of every example are stored, and the reader pads each batch to its
+longest example, batching training examples of similar length together. For
+training, several short examples can also be packed into every record (see
+`featurization.pack_arrays`).
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+
+import featurization
+import numpy as np
+import tokenization
+import tensorflow as tf
+
+# Bump when the layout of the written features changes, to invalidate caches.
+_RECORD_FORMAT_VERSION = 1
+
+_COMPRESSION_TYPES = {
+    "": tf.python_io.TFRecordCompressionType.NONE,
+    "GZIP": tf.python_io.TFRecordCompressionType.GZIP,
+    "ZLIB": tf.python_io.TFRecordCompressionType.ZLIB,
+}
+
+
+def log_example(example, tokenizer, input_ids, input_mask, segment_ids,
+                label_id):
+  """Logs the features of one example, for eyeballing the conversion."""
+  tokens = tokenizer.convert_ids_to_tokens(
+      [x for (x, m) in zip(input_ids, input_mask) if m])
+  tf.logging.info("*** Example ***")
+  tf.logging.info("guid: %s" % (example.guid))
+  tf.logging.info("tokens: %s" % " ".join(
+      [tokenization.printable_text(x) for x in tokens]))
+  tf.logging.info("input_ids: %s" % " ".join([str(x) for x in input_ids]))
+  tf.logging.info("input_mask: %s" % " ".join([str(x) for x in input_mask]))
+  tf.logging.info("segment_ids: %s" % " ".join([str(x) for x in segment_ids]))
+  tf.logging.info("label: %s (id = %d)" % (example.label, label_id))
+
+
+def manifest_file(output_file):
+  """Returns the path of the manifest of the record set `output_file`."""
+  return os.path.splitext(output_file)[0] + ".manifest.json"
+
+
+def shard_files(output_file, num_shards):
+  """Returns the file names of `output_file` written as `num_shards` shards."""
+  if num_shards == 1:
+    return [output_file]
+  base, ext = os.path.splitext(output_file)
+  return ["%s-%05d-of-%05d%s" % (base, i, num_shards, ext)
+          for i in range(num_shards)]
+
+
+def write_records(examples, label_list, max_seq_length, tokenizer, output_file,
+                  num_workers=1, compression_type="", shard_index=0,
+                  num_shards=1, varlen=False, examples_per_row=0,
+                  teacher_probabilities=None):
+  """Converts `examples` into features and writes them to one TFRecord file.
+
+  `examples` may be any iterable, e.g. a `featurization.ExampleStream`; only
+  every `num_shards`-th example, starting at `shard_index`, is written. With
+  `varlen`, "input_ids" and "segment_ids" hold only the real tokens and
+  "input_mask" is not written. With `examples_per_row` above 1, up to that
+  many examples are packed into every record, which then has the features of
+  `featurization.pack_arrays`. `teacher_probabilities`, a float array with a
+  row per example (of all shards), is written as the "teacher_probs" feature
+  for distillation.
+
+  Returns:
+    The number of records written.
+  """
+  options = tf.python_io.TFRecordOptions(_COMPRESSION_TYPES[compression_type])
+  writer = tf.python_io.TFRecordWriter(output_file, options=options)
+
+  def create_int_feature(values):
+    f = tf.train.Feature(int64_list=tf.train.Int64List(value=list(values)))
+    return f
+
+  def create_float_feature(values):
+    f = tf.train.Feature(float_list=tf.train.FloatList(value=list(values)))
+    return f
+
+  if teacher_probabilities is not None:
+    teacher_probabilities = teacher_probabilities[shard_index::num_shards]
+
+  # Examples are featurized a chunk at a time into NumPy arrays, which keeps
+  # memory bounded while still encoding many texts per `encode_batch` call.
+  chunk_size = 10000 * max(1, num_workers)
+  examples = itertools.islice(examples, shard_index, None, num_shards)
+  start = 0
+  num_records = 0
+  # One pool of tokenizer processes serves every chunk.
+  pool = None
+  if num_workers > 1:
+    pool = tokenization.create_batch_pool(tokenizer, num_workers)
+  try:
+    while True:
+      chunk = list(itertools.islice(examples, chunk_size))
+      if not chunk:
+        break
+      tf.logging.info("Writing example %d" % start)
+      arrays = featurization.convert_examples_to_arrays(
+          chunk, label_list, max_seq_length, tokenizer,
+          num_workers=num_workers, pool=pool)
+      # Padding examples keep one (all-zero) token, so no sequence is empty.
+      lengths = arrays["input_mask"].sum(axis=1).clip(min=1).tolist()
+      input_ids = arrays["input_ids"].tolist()
+      input_mask = arrays["input_mask"].tolist()
+      segment_ids = arrays["segment_ids"].tolist()
+      label_ids = arrays["label_ids"].tolist()
+      is_real_example = arrays["is_real_example"].tolist()
+      if teacher_probabilities is not None:
+        teacher_probs = teacher_probabilities[start:start + len(chunk)].tolist()
+        if len(teacher_probs) != len(chunk):
+          raise ValueError("Fewer teacher probabilities than examples.")
+
+      for i in range(min(len(chunk), 5 - start)):
+        if is_real_example[i]:
+          log_example(chunk[i], tokenizer, input_ids[i], input_mask[i],
+                      segment_ids[i], label_ids[i])
+
+      if examples_per_row > 1:
+        packed = featurization.pack_arrays(arrays, examples_per_row)
+        tf.logging.info("Packed %d examples into %d records" %
+                        (sum(is_real_example), len(packed["input_ids"])))
+        columns = [packed[name].tolist() for name in packed]
+        for values in zip(*columns):
+          features = collections.OrderedDict()
+          for (name, row) in zip(packed, values):
+            features[name] = create_int_feature(row)
+          tf_example = tf.train.Example(
+              features=tf.train.Features(feature=features))
+          writer.write(tf_example.SerializeToString())
+        num_records += len(packed["input_ids"])
+        start += len(chunk)
+        continue
+
+      for i in range(len(chunk)):
+        features = collections.OrderedDict()
+        if varlen:
+          features["input_ids"] = create_int_feature(input_ids[i][:lengths[i]])
+          features["segment_ids"] = create_int_feature(
+              segment_ids[i][:lengths[i]])
+        else:
+          features["input_ids"] = create_int_feature(input_ids[i])
+          features["input_mask"] = create_int_feature(input_mask[i])
+          features["segment_ids"] = create_int_feature(segment_ids[i])
+        features["label_ids"] = create_int_feature([label_ids[i]])
+        features["is_real_example"] = create_int_feature([is_real_example[i]])
+        if teacher_probabilities is not None:
+          features["teacher_probs"] = create_float_feature(teacher_probs[i])
+
+        tf_example = tf.train.Example(
+            features=tf.train.Features(feature=features))
+        writer.write(tf_example.SerializeToString())
+      num_records += len(chunk)
+      start += len(chunk)
+  finally:
+    if pool is not None:
+      pool.close()
+      pool.join()
+  writer.close()
+  return num_records
+
+
+def feature_cache_key(examples, label_list, max_seq_length, tokenizer,
+                      num_shards=1, compression_type="", varlen=False,
+                      examples_per_row=0, teacher_probabilities=None):
+  """Returns a hex digest of everything the written record set depends on.
+
+  That is the text and label of every example (so in effect the contents of
+  the input files), the vocab contents, `do_lower_case`, `max_seq_length`,
+  the label list, the record layout and the teacher probabilities.
+  """
+  config = collections.OrderedDict()
+  config["version"] = _RECORD_FORMAT_VERSION
+  config["labels"] = list(label_list)
+  config["max_seq_length"] = max_seq_length
+  config["do_lower_case"] = tokenizer.basic_tokenizer.do_lower_case
+  config["vocab_hash"] = featurization.vocab_hash(tokenizer.vocab)
+  config["num_shards"] = num_shards
+  config["compression_type"] = compression_type
+  config["varlen"] = varlen
+  config["examples_per_row"] = examples_per_row
+  config["teacher_probabilities"] = None
+  if teacher_probabilities is not None:
+    config["teacher_probabilities"] = hashlib.sha1(
+        np.ascontiguousarray(teacher_probabilities, np.float32)).hexdigest()
+
+  sha1 = hashlib.sha1(json.dumps(config).encode("utf-8"))
+  for example in examples:
+    if isinstance(example, featurization.PaddingInputExample):
+      sha1.update(b"\x00")
+      continue
+    fields = (example.text_a, example.text_b or "", example.label or "")
+    sha1.update(("\x01%s\x1f%s\x1f%s" % fields).encode("utf-8"))
+  return sha1.hexdigest()
+
+
+def _write_shard(args):
+  return write_records(*args)
+
+
+def write_sharded_records(examples, label_list, max_seq_length, tokenizer,
+                          output_file, num_shards=1, num_workers=1,
+                          compression_type="", reuse_cached=True,
+                          varlen=False, examples_per_row=0,
+                          teacher_probabilities=None):
+  """Writes `examples` as `num_shards` TFRecord shards plus a manifest.
+
+  With more than one shard, example i goes to shard i % num_shards and every
+  shard is written by its own worker process. `record_dataset` reads the
+  shards back in the original example order when not training.
+
+  If the record set was already written from the same inputs (see
+  `feature_cache_key`), it is reused as is. Otherwise the shards are written
+  under temporary names and renamed, and the manifest is written last, so an
+  interrupted rebuild never leaves a manifest pointing at partial files.
+
+  Args:
+    examples: A list of `InputExample`s and `PaddingInputExample`s, or a
+      `featurization.ExampleStream`, which is read once to compute the cache
+      key and once more (by every worker) to write the shards. A stream must
+      be picklable to be written in more than one shard.
+    label_list: The labels of the task, in label id order.
+    max_seq_length: Length of the features, including "[CLS]" and "[SEP]".
+    tokenizer: A `FullTokenizer`.
+    output_file: Name of the record set, e.g. ".../train.tf_record".
+    num_shards: Number of shards. A single shard is written to `output_file`
+      itself.
+    num_workers: Number of processes used to tokenize when writing a single
+      shard.
+    compression_type: "", "GZIP" or "ZLIB".
+    reuse_cached: Whether to reuse an up to date record set.
+    varlen: Whether to write unpadded sequences, see `write_records`.
+    examples_per_row: Maximum number of examples packed into a record, see
+      `write_records`. 0 or 1 for no packing.
+    teacher_probabilities: (optional) float array [num_examples, num_labels]
+      of a teacher model's probabilities, written with every record.
+
+  Returns:
+    The manifest, as returned by `load_manifest`.
+  """
+  if compression_type not in _COMPRESSION_TYPES:
+    raise ValueError("Unsupported compression type: %s" % compression_type)
+  if varlen and examples_per_row > 1:
+    raise ValueError("Packed records are always padded, not varlen.")
+  if teacher_probabilities is not None and examples_per_row > 1:
+    raise ValueError("Teacher probabilities can't be written to packed "
+                     "records.")
+
+  cache_key = feature_cache_key(examples, label_list, max_seq_length,
+                                tokenizer, num_shards, compression_type,
+                                varlen, examples_per_row,
+                                teacher_probabilities)
+  manifest = load_manifest(output_file)
+  if (reuse_cached and manifest is not None and
+      manifest.get("cache_key") == cache_key and
+      all(tf.gfile.Exists(f) for f in manifest["files"])):
+    tf.logging.info("Reusing %d cached records of %s" %
+                    (manifest["num_records"], output_file))
+    return manifest
+
+  # Drop the old manifest first: from here on the record set is incomplete.
+  if manifest is not None:
+    tf.gfile.Remove(manifest_file(output_file))
+
+  files = shard_files(output_file, num_shards)
+  tmp_suffix = ".tmp-%s" % cache_key[:8]
+  tmp_files = [f + tmp_suffix for f in files]
+  if num_shards == 1:
+    counts = [write_records(examples, label_list, max_seq_length, tokenizer,
+                            tmp_files[0], num_workers, compression_type,
+                            varlen=varlen, examples_per_row=examples_per_row,
+                            teacher_probabilities=teacher_probabilities)]
+  else:
+    if isinstance(examples, list):
+      # Only send every worker its own shard of an in-memory list.
+      tasks = [(examples[i::num_shards], label_list, max_seq_length, tokenizer,
+                tmp_files[i], 1, compression_type, 0, 1, varlen,
+                examples_per_row,
+                None if teacher_probabilities is None else
+                teacher_probabilities[i::num_shards])
+               for i in range(num_shards)]
+    else:
+      tasks = [(examples, label_list, max_seq_length, tokenizer, tmp_files[i],
+                1, compression_type, i, num_shards, varlen, examples_per_row,
+                teacher_probabilities)
+               for i in range(num_shards)]
+    # Workers are spawned rather than forked: TensorFlow's thread pools may
+    # already be running (e.g. when converting eval data after training), and
+    # a forked child can deadlock on a lock held by one of those threads.
+    pool = multiprocessing.get_context("spawn").Pool(
+        min(num_shards, multiprocessing.cpu_count()))
+    try:
+      counts = pool.map(_write_shard, tasks, chunksize=1)
+    finally:
+      pool.close()
+      pool.join()
+  for (tmp_file, shard_file, count) in zip(tmp_files, files, counts):
+    tf.gfile.Rename(tmp_file, shard_file, overwrite=True)
+    tf.logging.info("Wrote %d records to %s" % (count, shard_file))
+
+  manifest = collections.OrderedDict()
+  manifest["files"] = [os.path.basename(f) for f in files]
+  manifest["counts"] = counts
+  manifest["num_records"] = sum(counts)
+  manifest["compression_type"] = compression_type
+  manifest["max_seq_length"] = max_seq_length
+  manifest["varlen"] = varlen
+  manifest["examples_per_row"] = examples_per_row
+  manifest["num_teacher_labels"] = (
+      0 if teacher_probabilities is None else teacher_probabilities.shape[1])
+  manifest["cache_key"] = cache_key
+  path = manifest_file(output_file)
+  with tf.gfile.GFile(path + tmp_suffix, "w") as writer:
+    writer.write(json.dumps(manifest, indent=2))
+  tf.gfile.Rename(path + tmp_suffix, path, overwrite=True)
+  return load_manifest(output_file)
+
+
+def load_manifest(output_file):
+  """Reads the manifest of the record set `output_file`.
+
+  Returns:
+    The manifest dict, with "files" resolved to full paths, or None if the
+    record set has not been written.
+  """
+  path = manifest_file(output_file)
+  if not tf.gfile.Exists(path):
+    return None
+  with tf.gfile.GFile(path, "r") as reader:
+    manifest = json.loads(reader.read())
+  output_dir = os.path.dirname(output_file)
+  manifest["files"] = [os.path.join(output_dir, f) for f in manifest["files"]]
+  return manifest
+
+
+def record_dataset(input_files, is_training, compression_type="",
+                   shuffle_files=True):
+  """Returns a dataset of the serialized records in `input_files`.
+
+  For training the files are repeated, shuffled (if `shuffle_files`) and read
+  with a sloppy parallel interleave. Otherwise all files are interleaved one
+  record at a time, which gives back the example order of
+  `write_sharded_records`.
+  """
+  if len(input_files) == 1:
+    d = tf.data.TFRecordDataset(input_files[0],
+                                compression_type=compression_type)
+    if is_training:
+      d = d.repeat()
+    return d
+
+  d = tf.data.Dataset.from_tensor_slices(tf.constant(input_files))
+  if is_training:
+    d = d.repeat()
+    if shuffle_files:
+      d = d.shuffle(buffer_size=len(input_files))
+    cycle_length = min(len(input_files), multiprocessing.cpu_count())
+  else:
+    cycle_length = len(input_files)
+
+  d = d.apply(
+      tf.contrib.data.parallel_interleave(
+          lambda input_file: tf.data.TFRecordDataset(
+              input_file, compression_type=compression_type),
+          sloppy=is_training,
+          cycle_length=cycle_length))
+  return d
+
+
+def feature_spec(seq_length, varlen=False, examples_per_row=0,
+                 num_teacher_labels=0):
+  """Returns the `tf.parse_example` features of the written records."""
+  name_to_features = _record_feature_spec(seq_length, varlen,
+                                          examples_per_row)
+  if num_teacher_labels:
+    name_to_features["teacher_probs"] = tf.FixedLenFeature(
+        [num_teacher_labels], tf.float32)
+  return name_to_features
+
+
+def _record_feature_spec(seq_length, varlen, examples_per_row):
+  if examples_per_row > 1:
+    name_to_features = {
+        name: tf.FixedLenFeature([seq_length], tf.int64)
+        for name in ["input_ids", "input_mask", "segment_ids", "position_ids",
+                     "packing_ids"]
+    }
+    for name in ["cls_positions", "label_ids", "label_weights"]:
+      name_to_features[name] = tf.FixedLenFeature([examples_per_row], tf.int64)
+    return name_to_features
+  if varlen:
+    return {
+        "input_ids": tf.VarLenFeature(tf.int64),
+        "segment_ids": tf.VarLenFeature(tf.int64),
+        "label_ids": tf.FixedLenFeature([], tf.int64),
+        "is_real_example": tf.FixedLenFeature([], tf.int64),
+    }
+  return {
+      "input_ids": tf.FixedLenFeature([seq_length], tf.int64),
+      "input_mask": tf.FixedLenFeature([seq_length], tf.int64),
+      "segment_ids": tf.FixedLenFeature([seq_length], tf.int64),
+      "label_ids": tf.FixedLenFeature([], tf.int64),
+      "is_real_example": tf.FixedLenFeature([], tf.int64),
+  }
+
+
+def _to_int32_features(example):
+  """Densifies varlen features and casts all features to tf.int32."""
+  # Every stored token of a varlen record is a real one, so the mask is 1
+  # wherever "input_ids" has a value (and 0 where a batch pads it).
+  if "input_mask" not in example:
+    ids = example["input_ids"]
+    example["input_mask"] = tf.sparse_tensor_to_dense(
+        tf.SparseTensor(ids.indices, tf.ones_like(ids.values), ids.dense_shape))
+
+  # tf.Example only supports tf.int64, but the TPU only supports tf.int32.
+  # So cast all int64 to int32.
+  for name in list(example.keys()):
+    t = example[name]
+    if isinstance(t, tf.SparseTensor):
+      t = tf.sparse_tensor_to_dense(t)
+    if t.dtype == tf.int64:
+      t = tf.to_int32(t)
+    example[name] = t
+  return example
+
+
+def decode_record(record, name_to_features):
+  """Decodes a record to a TensorFlow example."""
+  return _to_int32_features(tf.parse_single_example(record, name_to_features))
+
+
+def decode_records(records, name_to_features):
+  """Decodes a batch of records at once with `tf.parse_example`.
+
+  Varlen features are padded to the longest example of the batch.
+  """
+  return _to_int32_features(tf.parse_example(records, name_to_features))
+
+
+def default_bucket_boundaries(max_seq_length):
+  """Returns the bucket boundaries 16, 32, 64, ... below `max_seq_length`."""
+  boundaries = []
+  boundary = 16
+  while boundary < max_seq_length:
+    boundaries.append(boundary)
+    boundary *= 2
+  return boundaries
+
+
+def bucket_varlen_examples(d, batch_size, seq_length, bucket_boundaries=None):
+  """Batches decoded varlen examples of similar length together.
+
+  Every batch is padded to its longest example, so the model mostly sees
+  [batch_size, L] inputs with L well below `seq_length`.
+  """
+  if not bucket_boundaries:
+    bucket_boundaries = default_bucket_boundaries(seq_length)
+  # Bucket i holds the lengths in [bucket_boundaries[i-1], bucket_boundaries[i]).
+  # The training dataset repeats, so every batch is full.
+  padded_shapes = {
+      "input_ids": [None],
+      "input_mask": [None],
+      "segment_ids": [None],
+      "label_ids": [],
+      "is_real_example": [],
+  }
+  if "teacher_probs" in d.output_shapes:
+    padded_shapes["teacher_probs"] = d.output_shapes["teacher_probs"]
+  return d.apply(
+      tf.contrib.data.bucket_by_sequence_length(
+          element_length_func=lambda example: tf.shape(example["input_ids"])[0],
+          bucket_boundaries=bucket_boundaries,
+          bucket_batch_sizes=[batch_size] * (len(bucket_boundaries) + 1),
+          padded_shapes=padded_shapes))
+
+
+class InputPipelineOptions(
+    collections.namedtuple("InputPipelineOptions", [
+        "shuffle_files", "shuffle_buffer_size", "parse_batched",
+        "num_parallel_calls", "prefetch_batches"
+    ])):
+  """How `input_dataset` reads, shuffles and decodes the records.
+
+  Attributes:
+    shuffle_files: Whether to shuffle the order of the shards for training.
+    shuffle_buffer_size: Number of records in the training shuffle buffer.
+    parse_batched: Whether to batch the serialized records first and decode
+      every batch with one `tf.parse_example` call, instead of calling
+      `tf.parse_single_example` per record. Not used for bucketed batches,
+      which need the length of every record before batching.
+    num_parallel_calls: Number of records or batches decoded in parallel, None
+      to decode one at a time.
+    prefetch_batches: Number of batches prepared ahead of the model, 0 for no
+      prefetching.
+  """
+
+# The input pipeline of the original BERT run_classifier.py.
+DEFAULT_INPUT_PIPELINE = InputPipelineOptions(
+    shuffle_files=True, shuffle_buffer_size=100, parse_batched=False,
+    num_parallel_calls=None, prefetch_batches=0)
+
+
+def input_dataset(input_files, seq_length, batch_size, is_training,
+                  drop_remainder, compression_type="", varlen=False,
+                  bucket_boundaries=None, options=DEFAULT_INPUT_PIPELINE,
+                  examples_per_row=0, num_teacher_labels=0):
+  """Returns the dataset of feature batches read from `input_files`.
+
+  Args:
+    input_files: The TFRecord files of a record set.
+    seq_length: The `max_seq_length` the records were written with.
+    batch_size: Number of examples per batch.
+    is_training: Whether to repeat, shuffle and (for varlen records) bucket
+      the records. Otherwise batches are in record order.
+    drop_remainder: Whether to drop a last partial batch.
+    compression_type: The compression of the files.
+    varlen: Whether the records were written with `varlen`. Batches are then
+      padded to their longest example only.
+    bucket_boundaries: Sequence length bucket boundaries for varlen training,
+      see `default_bucket_boundaries`.
+    options: An `InputPipelineOptions`.
+    examples_per_row: The `examples_per_row` the records were packed with.
+    num_teacher_labels: The number of labels of the "teacher_probs" feature,
+      0 if the records have none.
+
+  Returns:
+    A `tf.data.Dataset` of dicts of int32 "input_ids", "input_mask",
+    "segment_ids", "label_ids" and "is_real_example" batches, or of the
+    features of `featurization.pack_arrays` for packed records. Records with
+    teacher probabilities also have a float32 "teacher_probs" batch.
+  """
+  name_to_features = feature_spec(seq_length, varlen, examples_per_row,
+                                  num_teacher_labels)
+  num_parallel_calls = options.num_parallel_calls
+
+  # For training, we want a lot of parallel reading and shuffling.
+  # For eval, we want no shuffling and parallel reading doesn't matter.
+  d = record_dataset(input_files, is_training, compression_type,
+                     shuffle_files=options.shuffle_files)
+  if is_training:
+    d = d.shuffle(buffer_size=options.shuffle_buffer_size)
+
+  if varlen and is_training:
+    d = d.map(lambda record: decode_record(record, name_to_features),
+              num_parallel_calls=num_parallel_calls)
+    d = bucket_varlen_examples(d, batch_size, seq_length, bucket_boundaries)
+  elif options.parse_batched or varlen:
+    # Varlen eval/predict records are always parsed a batch at a time, which
+    # pads them to the longest example of the batch.
+    d = d.batch(batch_size, drop_remainder=drop_remainder)
+    d = d.map(lambda records: decode_records(records, name_to_features),
+              num_parallel_calls=num_parallel_calls)
+  else:
+    d = d.apply(
+        tf.contrib.data.map_and_batch(
+            lambda record: decode_record(record, name_to_features),
+            batch_size=batch_size,
+            num_parallel_calls=num_parallel_calls,
+            drop_remainder=drop_remainder))
+
+  if options.prefetch_batches:
+    d = d.prefetch(options.prefetch_batches)
+  return d
@@ -20,12 +20,16 @@ from __future__ import print_function
 
 import collections
 import csv
+import multiprocessing
 import os
+import numpy as np
+import feature_store
+import featurization
 import modeling
 import optimization
+import record_io
 import tokenization
 import tensorflow as tf
-import pickle
 
 flags = tf.flags
 
@@ -80,6 +84,34 @@ flags.DEFINE_bool(
     "do_predict", False,
     "Whether to run the model in inference mode on the test set.")
 
+flags.DEFINE_bool(
+    "predict_from_arrays", False,
+    "Whether to predict from memory-mapped NumPy feature arrays written to "
+    "output_dir instead of TFRecord files. Not supported on TPU.")
+
+flags.DEFINE_bool(
+    "use_feature_store", False,
+    "Whether to write the train/eval/predict features as memory-mapped "
+    "columnar feature stores (see feature_store.py) in output_dir and read "
+    "them from there, instead of TFRecord files. Not supported on TPU.")
+
+flags.DEFINE_bool(
+    "predict_sorted_by_length", False,
+    "Whether to predict in bulk: the examples are written as with "
+    "`predict_from_arrays`, sorted by length and predicted in batches of "
+    "`bulk_predict_batch_size` trimmed to their longest example. Results are "
+    "still written in input order. Not supported on TPU.")
+
+flags.DEFINE_integer(
+    "bulk_predict_batch_size", 256,
+    "Batch size of `predict_sorted_by_length`.")
+
+flags.DEFINE_bool(
+    "dedup_predict_examples", False,
+    "Whether to predict every distinct test text only once and copy its "
+    "probabilities to all of its rows in test_results.tsv. Texts are compared "
+    "after BasicTokenizer normalization.")
+
 flags.DEFINE_bool(
     "do_export", False,
     "Whether to export the model.")
@@ -108,6 +140,125 @@ flags.DEFINE_integer("iterations_per_loop", 1000,
 
 flags.DEFINE_bool("use_tpu", False, "Whether to use TPU or GPU/CPU.")
 
+flags.DEFINE_bool(
+    "reuse_cached_features", True,
+    "Whether to reuse TFRecord files written by an earlier run from the same "
+    "examples, vocab, do_lower_case, max_seq_length and labels instead of "
+    "converting the examples again.")
+
+flags.DEFINE_integer(
+    "num_record_shards", 1,
+    "Number of TFRecord shards the features are written to, each by its own "
+    "worker process. 1 writes a single file in the main process.")
+
+flags.DEFINE_string(
+    "record_compression", "",
+    "Compression of the TFRecord files: empty for none, GZIP or ZLIB.")
+
+flags.DEFINE_bool(
+    "varlen_records", False,
+    "Whether to write the features unpadded and batch them by length: "
+    "training batches are bucketed by sequence length, and every batch is "
+    "only padded to its longest example. Not supported on TPU.")
+
+flags.DEFINE_integer(
+    "pack_examples_per_row", 0,
+    "Pack up to this many training examples into every max_seq_length row, "
+    "each with its own positions, attention block and [CLS] output. 0 or 1 "
+    "writes one example per row. Eval and predict are not packed.")
+
+flags.DEFINE_list(
+    "bucket_boundaries", None,
+    "Comma separated sequence length boundaries of the `varlen_records` "
+    "training buckets. Default: 16,32,64,... below max_seq_length.")
+
+flags.DEFINE_bool(
+    "shuffle_record_files", True,
+    "Whether to shuffle the order of the TFRecord shards in every training "
+    "epoch, on top of shuffling the records.")
+
+flags.DEFINE_integer(
+    "shuffle_buffer_size", 10000,
+    "Number of training records in the record-level shuffle buffer.")
+
+flags.DEFINE_bool(
+    "parse_batched", True,
+    "Whether to decode the records a batch at a time with one "
+    "`tf.parse_example` call instead of one `tf.parse_single_example` per "
+    "record. Bucketed `varlen_records` training batches are always decoded "
+    "per record.")
+
+flags.DEFINE_integer(
+    "input_num_parallel_calls", None,
+    "Number of records or batches decoded in parallel. Default: the number of "
+    "CPU cores.")
+
+flags.DEFINE_integer(
+    "prefetch_batches", 2,
+    "Number of input batches prepared ahead of the model, 0 for none.")
+
+flags.DEFINE_string(
+    "precision", "fp32",
+    "Precision of the Transformer encoder: \"fp32\", \"fp16\" (with dynamic "
+    "loss scaling for training) or \"bf16\". Variables and checkpoints stay "
+    "in float32.")
+
+flags.DEFINE_list(
+    "early_exit_layers", None,
+    "Encoder layers (from 1) after which a small early-exit classifier is "
+    "trained along with the final one, e.g. 2,4,6,8,10. freeze_graph.py "
+    "builds a graph that stops at the first confident exit.")
+
+flags.DEFINE_string(
+    "early_exit_training", "joint",
+    "How the early-exit classifiers are trained: \"joint\" averages their "
+    "losses on the labels with the final loss; \"distill\" trains them on "
+    "the final classifier's probabilities, without gradients into the "
+    "encoder.")
+
+flags.DEFINE_string(
+    "teacher_bert_config_file", None,
+    "The config json file of the teacher model, for distillation from "
+    "`teacher_checkpoint`.")
+
+flags.DEFINE_string(
+    "teacher_checkpoint", None,
+    "Checkpoint (or output_dir) of a classifier fine-tuned on the same task by "
+    "this script, used as the teacher when training a smaller student "
+    "(`bert_config_file`). The teacher runs frozen alongside the student.")
+
+flags.DEFINE_string(
+    "teacher_probabilities_file", None,
+    "Instead of `teacher_checkpoint`: the train_results.tsv of a teacher "
+    "`do_predict` run with `predict_split=train`, one line of probabilities "
+    "per training example. Not supported with `use_feature_store`.")
+
+flags.DEFINE_float(
+    "distill_temperature", 2.0,
+    "Softmax temperature of the teacher and student logits in the soft loss.")
+
+flags.DEFINE_float(
+    "distill_alpha", 0.5,
+    "Weight of the soft loss on the teacher's outputs; the loss on the labels "
+    "gets 1 - distill_alpha.")
+
+flags.DEFINE_float(
+    "distill_hidden_weight", 0.0,
+    "Weight of the mean squared error between student and teacher hidden "
+    "states (student layer i matched to an evenly spaced teacher layer). "
+    "Needs `teacher_checkpoint`. 0 disables it.")
+
+flags.DEFINE_string(
+    "predict_split", "test",
+    "Examples predicted by `do_predict`: \"test\", or \"train\" to "
+    "precompute a teacher's probabilities for `teacher_probabilities_file`. "
+    "They are written to <split>_results.tsv.")
+
+flags.DEFINE_integer(
+    "tokenize_num_workers", 1,
+    "Number of processes used to tokenize examples when converting them to "
+    "features. 1 tokenizes in the main process.")
+
 tf.flags.DEFINE_string(
     "tpu_name", None,
     "The Cloud TPU to use for training. This should be either the name "
@@ -133,56 +284,28 @@ flags.DEFINE_integer(
     "Only used if `use_tpu` is True. Total number of TPU cores to use.")
 
 
-class InputExample(object):
-  """A single training/test example for simple sequence classification."""
-
-  def __init__(self, guid, text_a, text_b=None, label=None):
-    """Constructs a InputExample.
-
-    Args:
-      guid: Unique id for the example.
-      text_a: string. The untokenized text of the first sequence. For single
-        sequence tasks, only this sequence must be specified.
-      text_b: (Optional) string. The untokenized text of the second sequence.
-        Only must be specified for sequence pair tasks.
-      label: (Optional) string. The label of the example. This should be
-        specified for train and dev examples, but not for test examples.
-    """
-    self.guid = guid
-    self.text_a = text_a
-    self.text_b = text_b
-    self.label = label
-
+InputExample = featurization.InputExample
+PaddingInputExample = featurization.PaddingInputExample
+InputFeatures = featurization.InputFeatures
 
-class PaddingInputExample(object):
-  """Fake example so the num input examples is a multiple of the batch size.
 
-  When running eval/predict on the TPU, we need to pad the number of examples
-  to be a multiple of the batch size, because the TPU requires a fixed batch
-  size. The alternative is to drop the last batch, which is bad because it means
-  the entire output data won't be generated.
+class DistillOptions(
+    collections.namedtuple("DistillOptions", [
+        "teacher_config", "teacher_checkpoint", "temperature", "alpha",
+        "hidden_weight"
+    ])):
+  """How a student classifier is trained on a teacher's outputs.
 
-  We use this class instead of `None` because treating `None` as padding
-  battches could cause silent errors.
+  Fields:
+    teacher_config: The teacher's `BertConfig`, or None when the teacher's
+      probabilities are read with the records.
+    teacher_checkpoint: The checkpoint the teacher is loaded from, or None.
+    temperature: Softmax temperature of the soft loss.
+    alpha: Weight of the soft loss; the loss on the labels gets 1 - alpha.
+    hidden_weight: Weight of the hidden state matching loss, 0 for none.
   """
 
 
-class InputFeatures(object):
-  """A single set of features of data."""
-
-  def __init__(self,
-               input_ids,
-               input_mask,
-               segment_ids,
-               label_id,
-               is_real_example=True):
-    self.input_ids = input_ids
-    self.input_mask = input_mask
-    self.segment_ids = segment_ids
-    self.label_id = label_id
-    self.is_real_example = is_real_example
-
-
 class DataProcessor(object):
   """Base class for data converters for sequence classification data sets."""
 
@@ -190,6 +313,15 @@ class DataProcessor(object):
     """Gets a collection of `InputExample`s for the train set."""
     raise NotImplementedError()
 
+  def get_train_example_stream(self, data_dir):
+    """Gets the train set as an iterable that can be read more than once.
+
+    Processors of large data sets return a `featurization.ExampleStream`, so
+    that the examples are streamed from disk instead of held in memory. By
+    default this is just `get_train_examples`.
+    """
+    return self.get_train_examples(data_dir)
+
   def get_dev_examples(self, data_dir):
     """Gets a collection of `InputExample`s for the dev set."""
     raise NotImplementedError()
@@ -205,12 +337,19 @@ class DataProcessor(object):
   @classmethod
   def _read_tsv(cls, input_file, quotechar=None):
     """Reads a tab separated value file."""
+    return list(cls._iter_tsv(input_file, quotechar))
+
+  @classmethod
+  def _iter_tsv(cls, input_file, quotechar=None):
+    """Yields the lines of a tab separated value file one at a time."""
     with tf.gfile.Open(input_file, "r") as f:
       reader = csv.reader(f, delimiter="\t", quotechar=quotechar)
-      lines = []
       for line in reader:
-        lines.append(line)
-      return lines
+        yield line
+
+  def _stream_examples(self, input_file, set_type):
+    """Yields the examples of `input_file`, see `get_train_example_stream`."""
+    return self._create_examples(self._iter_tsv(input_file), set_type)
 
 class XnliProcessor(DataProcessor):
   """Processor for the XNLI data set."""
@@ -305,18 +444,21 @@ class MnliProcessor(DataProcessor):
 class SetimentProcessor(DataProcessor):
   def get_train_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "train.tsv")), "train")
+    return list(self.get_train_example_stream(data_dir))
+
+  def get_train_example_stream(self, data_dir):
+    """See base class."""
+    return featurization.ExampleStream(
+        self._stream_examples, os.path.join(data_dir, "train.tsv"), "train")
 
   def get_dev_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "dev.tsv")), "dev")
+    return list(self._stream_examples(os.path.join(data_dir, "dev.tsv"), "dev"))
 
   def get_test_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, "test.tsv")), "test")
+    return list(
+        self._stream_examples(os.path.join(data_dir, "test.tsv"), "test"))
 
   def get_labels(self):
     """See base class."""
@@ -329,8 +471,7 @@ class SetimentProcessor(DataProcessor):
     return ["-1", "0", "1"]
 
   def _create_examples(self, lines, set_type):
-    """Creates examples for the training and dev sets."""
-    examples = []
+    """Yields examples for the training and dev sets."""
     for (i, line) in enumerate(lines):
       if i == 0: 
         continue
@@ -344,15 +485,12 @@ class SetimentProcessor(DataProcessor):
         label = "0"
       else:
         label = tokenization.convert_to_unicode(line[0])
-      examples.append(
-          InputExample(guid=guid, text_a=text_a, label=label))
+      yield InputExample(guid=guid, text_a=text_a, label=label)
 
     # output_label2id_file = os.path.join(FLAGS.output_dir, "label2id.pkl")
     # if not os.path.exists(output_label2id_file):
     #     with open(output_label2id_file, 'wb') as w:
     #         pickle.dump(label_map, w)
-
-    return examples
 #-----------------------------------------
 
 class MrpcProcessor(DataProcessor):
@@ -435,228 +573,95 @@ class ColaProcessor(DataProcessor):
           InputExample(guid=guid, text_a=text_a, text_b=None, label=label))
     return examples
 
-##
 def convert_single_example(ex_index, example, label_list, max_seq_length,
                            tokenizer):
   """Converts a single `InputExample` into a single `InputFeatures`."""
-
-  if isinstance(example, PaddingInputExample):
-    return InputFeatures(
-        input_ids=[0] * max_seq_length,
-        input_mask=[0] * max_seq_length,
-        segment_ids=[0] * max_seq_length,
-        label_id=0,
-        is_real_example=False)
-
-  label_map = {}
-  for (i, label) in enumerate(label_list):
-    label_map[label] = i
-  
-  #--- save label2id.pkl ---
-  #在这里输出label2id.pkl , add by stephen 2019-10-12
-  #用于服务端bert-base部署
-  output_label2id_file = os.path.join(FLAGS.output_dir, "label2id.pkl")
-  if not os.path.exists(output_label2id_file):
-    with open(output_label2id_file,'wb') as w:
-      pickle.dump(label_map,w)
-
-  #--- Add end ---
-
-
-  tokens_a = tokenizer.tokenize(example.text_a)
-  tokens_b = None
-  if example.text_b:
-    tokens_b = tokenizer.tokenize(example.text_b)
-
-  if tokens_b:
-    # Modifies `tokens_a` and `tokens_b` in place so that the total
-    # length is less than the specified length.
-    # Account for [CLS], [SEP], [SEP] with "- 3"
-    _truncate_seq_pair(tokens_a, tokens_b, max_seq_length - 3)
-  else:
-    # Account for [CLS] and [SEP] with "- 2"
-    if len(tokens_a) > max_seq_length - 2:
-      tokens_a = tokens_a[0:(max_seq_length - 2)]
-
-  # The convention in BERT is:
-  # (a) For sequence pairs:
-  #  tokens:   [CLS] is this jack ##son ##ville ? [SEP] no it is not . [SEP]
-  #  type_ids: 0     0  0    0    0     0       0 0     1  1  1  1   1 1
-  # (b) For single sequences:
-  #  tokens:   [CLS] the dog is hairy . [SEP]
-  #  type_ids: 0     0   0   0  0     0 0
-  #
-  # Where "type_ids" are used to indicate whether this is the first
-  # sequence or the second sequence. The embedding vectors for `type=0` and
-  # `type=1` were learned during pre-training and are added to the wordpiece
-  # embedding vector (and position vector). This is not *strictly* necessary
-  # since the [SEP] token unambiguously separates the sequences, but it makes
-  # it easier for the model to learn the concept of sequences.
-  #
-  # For classification tasks, the first vector (corresponding to [CLS]) is
-  # used as the "sentence vector". Note that this only makes sense because
-  # the entire model is fine-tuned.
-  tokens = []
-  segment_ids = []
-  tokens.append("[CLS]")
-  segment_ids.append(0)
-  for token in tokens_a:
-    tokens.append(token)
-    segment_ids.append(0)
-  tokens.append("[SEP]")
-  segment_ids.append(0)
-
-  if tokens_b:
-    for token in tokens_b:
-      tokens.append(token)
-      segment_ids.append(1)
-    tokens.append("[SEP]")
-    segment_ids.append(1)
-
-  input_ids = tokenizer.convert_tokens_to_ids(tokens)
-
-  # The mask has 1 for real tokens and 0 for padding tokens. Only real
-  # tokens are attended to.
-  input_mask = [1] * len(input_ids)
-
-  # Zero-pad up to the sequence length.
-  while len(input_ids) < max_seq_length:
-    input_ids.append(0)
-    input_mask.append(0)
-    segment_ids.append(0)
-
-  assert len(input_ids) == max_seq_length
-  assert len(input_mask) == max_seq_length
-  assert len(segment_ids) == max_seq_length
-
-  #debug xmxoxo 2019/3/13
-  #print(ex_index,example.text_a)
-  
-  label_id = label_map[example.label]
-  if ex_index < 5:
-    tf.logging.info("*** Example ***")
-    tf.logging.info("guid: %s" % (example.guid))
-    tf.logging.info("tokens: %s" % " ".join(
-        [tokenization.printable_text(x) for x in tokens]))
-    tf.logging.info("input_ids: %s" % " ".join([str(x) for x in input_ids]))
-    tf.logging.info("input_mask: %s" % " ".join([str(x) for x in input_mask]))
-    tf.logging.info("segment_ids: %s" % " ".join([str(x) for x in segment_ids]))
-    tf.logging.info("label: %s (id = %d)" % (example.label, label_id))
-
-  feature = InputFeatures(
-      input_ids=input_ids,
-      input_mask=input_mask,
-      segment_ids=segment_ids,
-      label_id=label_id,
-      is_real_example=True)
+  feature = featurization.convert_single_example(
+      example, label_list, max_seq_length, tokenizer)
+  if ex_index < 5 and feature.is_real_example:
+    record_io.log_example(example, tokenizer, feature.input_ids,
+                          feature.input_mask, feature.segment_ids,
+                          feature.label_id)
   return feature
 
 
 def file_based_convert_examples_to_features(
-    examples, label_list, max_seq_length, tokenizer, output_file):
-  """Convert a set of `InputExample`s to a TFRecord file."""
-
-  writer = tf.python_io.TFRecordWriter(output_file)
+    examples, label_list, max_seq_length, tokenizer, output_file,
+    num_workers=1, num_shards=1, compression_type="", reuse_cached=True,
+    varlen=False, examples_per_row=0, teacher_probabilities=None):
+  """Convert a set of `InputExample`s to (sharded) TFRecord files.
 
-  for (ex_index, example) in enumerate(examples):
-    if ex_index % 10000 == 0:
-      tf.logging.info("Writing example %d of %d" % (ex_index, len(examples)))
-
-    feature = convert_single_example(ex_index, example, label_list,
-                                     max_seq_length, tokenizer)
-
-    def create_int_feature(values):
-      f = tf.train.Feature(int64_list=tf.train.Int64List(value=list(values)))
-      return f
-
-    features = collections.OrderedDict()
-    features["input_ids"] = create_int_feature(feature.input_ids)
-    features["input_mask"] = create_int_feature(feature.input_mask)
-    features["segment_ids"] = create_int_feature(feature.segment_ids)
-    features["label_ids"] = create_int_feature([feature.label_id])
-    features["is_real_example"] = create_int_feature(
-        [int(feature.is_real_example)])
-
-    tf_example = tf.train.Example(features=tf.train.Features(feature=features))
-    writer.write(tf_example.SerializeToString())
-  writer.close()
+  Files already written from the same inputs are reused. Returns the manifest
+  of the files, see `record_io.load_manifest`.
+  """
+  return record_io.write_sharded_records(
+      examples, label_list, max_seq_length, tokenizer, output_file,
+      num_shards=num_shards, num_workers=num_workers,
+      compression_type=compression_type, reuse_cached=reuse_cached,
+      varlen=varlen, examples_per_row=examples_per_row,
+      teacher_probabilities=teacher_probabilities)
 
 
 def file_based_input_fn_builder(input_file, seq_length, is_training,
-                                drop_remainder):
-  """Creates an `input_fn` closure to be passed to TPUEstimator."""
-
-  name_to_features = {
-      "input_ids": tf.FixedLenFeature([seq_length], tf.int64),
-      "input_mask": tf.FixedLenFeature([seq_length], tf.int64),
-      "segment_ids": tf.FixedLenFeature([seq_length], tf.int64),
-      "label_ids": tf.FixedLenFeature([], tf.int64),
-      "is_real_example": tf.FixedLenFeature([], tf.int64),
-  }
-
-  def _decode_record(record, name_to_features):
-    """Decodes a record to a TensorFlow example."""
-    example = tf.parse_single_example(record, name_to_features)
-
-    # tf.Example only supports tf.int64, but the TPU only supports tf.int32.
-    # So cast all int64 to int32.
-    for name in list(example.keys()):
-      t = example[name]
-      if t.dtype == tf.int64:
-        t = tf.to_int32(t)
-      example[name] = t
-
-    return example
+                                drop_remainder, compression_type="",
+                                varlen=False, bucket_boundaries=None,
+                                pipeline_options=None, examples_per_row=0,
+                                num_teacher_labels=0):
+  """Creates an `input_fn` closure to be passed to TPUEstimator.
+
+  `input_file` is a TFRecord file or a list of shards. The batches are read by
+  `record_io.input_dataset`, configured by the `record_io.InputPipelineOptions`
+  `pipeline_options`.
+  """
+  input_files = input_file if isinstance(input_file, list) else [input_file]
+  options = pipeline_options or record_io.DEFAULT_INPUT_PIPELINE
 
   def input_fn(params):
     """The actual input function."""
     batch_size = params["batch_size"]
-
-    # For training, we want a lot of parallel reading and shuffling.
-    # For eval, we want no shuffling and parallel reading doesn't matter.
-    d = tf.data.TFRecordDataset(input_file)
-    if is_training:
-      d = d.repeat()
-      d = d.shuffle(buffer_size=100)
-
-    d = d.apply(
-        tf.contrib.data.map_and_batch(
-            lambda record: _decode_record(record, name_to_features),
-            batch_size=batch_size,
-            drop_remainder=drop_remainder))
-
-    return d
+    return record_io.input_dataset(
+        input_files, seq_length, batch_size, is_training, drop_remainder,
+        compression_type=compression_type, varlen=varlen,
+        bucket_boundaries=bucket_boundaries, options=options,
+        examples_per_row=examples_per_row,
+        num_teacher_labels=num_teacher_labels)
 
   return input_fn
 
 
-def _truncate_seq_pair(tokens_a, tokens_b, max_length):
-  """Truncates a sequence pair in place to the maximum length."""
-
-  # This is a simple heuristic which will always truncate the longer sequence
-  # one token at a time. This makes more sense than truncating an equal percent
-  # of tokens from each, since if one sequence is very short then each token
-  # that's truncated likely contains more information than a longer sequence.
-  while True:
-    total_length = len(tokens_a) + len(tokens_b)
-    if total_length <= max_length:
-      break
-    if len(tokens_a) > len(tokens_b):
-      tokens_a.pop()
-    else:
-      tokens_b.pop()
-
-
 def create_model(bert_config, is_training, input_ids, input_mask, segment_ids,
-                 labels, num_labels, use_one_hot_embeddings):
-  """Creates a classification model."""
+                 labels, num_labels, use_one_hot_embeddings,
+                 packed_features=None, compute_type=tf.float32,
+                 exit_layers=None, exit_training="joint", teacher_outputs=None,
+                 distill_options=None):
+  """Creates a classification model.
+
+  For rows packing several examples, `packed_features` holds their
+  "position_ids", "packing_ids", "cls_positions" and "label_weights" (see
+  `featurization.pack_arrays`), and `labels` has one label per packed example.
+  Every example is then classified from its own "[CLS]" token, and the
+  outputs have one row per example slot.
+
+  For every layer number in `exit_layers`, an early-exit classifier (see
+  `create_exit_classifier`) is trained on the "[CLS]" output of that encoder
+  layer, as set by `exit_training`. The returned outputs are the final
+  classifier's.
+
+  With `teacher_outputs` (see `create_teacher_model`), the loss on the labels
+  is combined with the distillation losses of `create_distillation_loss`.
+  """
+  packed_features = packed_features or {}
   model = modeling.BertModel(
       config=bert_config,
       is_training=is_training,
       input_ids=input_ids,
       input_mask=input_mask,
       token_type_ids=segment_ids,
-      use_one_hot_embeddings=use_one_hot_embeddings)
+      use_one_hot_embeddings=use_one_hot_embeddings,
+      position_ids=packed_features.get("position_ids"),
+      packing_ids=packed_features.get("packing_ids"),
+      cls_positions=packed_features.get("cls_positions"),
+      compute_type=compute_type)
 
   # In the demo, we are doing a simple classification task on the entire
   # segment.
@@ -674,6 +679,19 @@ def create_model(bert_config, is_training, input_ids, input_mask, segment_ids,
   output_bias = tf.get_variable(
       "output_bias", [num_labels], initializer=tf.zeros_initializer())
 
+  all_exit_logits = []
+  for layer_number in exit_layers or []:
+    layer_output = model.get_all_encoder_layers()[layer_number - 1]
+    if exit_training == "distill":
+      layer_output = tf.stop_gradient(layer_output)
+    if "cls_positions" in packed_features:
+      first_token_tensor = modeling.gather_indexes(
+          layer_output, packed_features["cls_positions"])
+    else:
+      first_token_tensor = layer_output[:, 0]
+    all_exit_logits.append(create_exit_classifier(
+        first_token_tensor, num_labels, layer_number, is_training))
+
   with tf.variable_scope("loss"):
     if is_training:
       # I.e., 0.1 dropout
@@ -684,17 +702,179 @@ def create_model(bert_config, is_training, input_ids, input_mask, segment_ids,
     probabilities = tf.nn.softmax(logits, axis=-1)
     log_probs = tf.nn.log_softmax(logits, axis=-1)
 
-    one_hot_labels = tf.one_hot(labels, depth=num_labels, dtype=tf.float32)
+    one_hot_labels = tf.one_hot(
+        tf.reshape(labels, [-1]), depth=num_labels, dtype=tf.float32)
 
     per_example_loss = -tf.reduce_sum(one_hot_labels * log_probs, axis=-1)
-    loss = tf.reduce_mean(per_example_loss)
+    if "label_weights" in packed_features:
+      # Only average over the filled example slots of the packed rows.
+      label_weights = tf.to_float(
+          tf.reshape(packed_features["label_weights"], [-1]))
+    else:
+      label_weights = tf.ones_like(per_example_loss)
+    per_example_loss *= label_weights
+    loss = tf.reduce_sum(per_example_loss) / tf.maximum(
+        tf.reduce_sum(label_weights), 1.0)
+
+    if teacher_outputs is not None:
+      loss = create_distillation_loss(loss, logits, model, input_mask,
+                                      teacher_outputs, distill_options)
+
+    if all_exit_logits:
+      if exit_training == "distill":
+        exit_targets = tf.stop_gradient(probabilities)
+      else:
+        exit_targets = one_hot_labels
+      exit_losses = []
+      for exit_logits in all_exit_logits:
+        exit_per_example_loss = -tf.reduce_sum(
+            exit_targets * tf.nn.log_softmax(exit_logits, axis=-1), axis=-1)
+        exit_losses.append(
+            tf.reduce_sum(exit_per_example_loss * label_weights) /
+            tf.maximum(tf.reduce_sum(label_weights), 1.0))
+      if exit_training == "distill":
+        loss += tf.add_n(exit_losses) / len(exit_losses)
+      else:
+        loss = (loss + tf.add_n(exit_losses)) / (len(exit_losses) + 1)
 
     return (loss, per_example_loss, logits, probabilities)
 
 
+def create_teacher_model(teacher_config, input_ids, input_mask, segment_ids,
+                         num_labels):
+  """Creates the frozen teacher classifier for distillation.
+
+  The teacher has the variables of a classifier trained by this script, under
+  the variable scope "teacher" (see `teacher_assignment_map`). They are
+  created as untrainable local variables, so they are left out of the
+  student's checkpoints and are initialized from the teacher's checkpoint in
+  every session, including when training resumes.
+
+  Returns:
+    A dict of the teacher's "logits" and "hidden_layers", its encoder layer
+    outputs, with gradients stopped.
+  """
+
+  def teacher_getter(getter, *args, **kwargs):
+    kwargs["collections"] = [tf.GraphKeys.LOCAL_VARIABLES]
+    kwargs["trainable"] = False
+    return getter(*args, **kwargs)
+
+  with tf.variable_scope("teacher", custom_getter=teacher_getter):
+    teacher = modeling.BertModel(
+        config=teacher_config,
+        is_training=False,
+        input_ids=input_ids,
+        input_mask=input_mask,
+        token_type_ids=segment_ids,
+        use_one_hot_embeddings=False,
+        scope="bert")
+    output_layer = teacher.get_pooled_output()
+    hidden_size = output_layer.shape[-1].value
+    output_weights = tf.get_variable("output_weights",
+                                     [num_labels, hidden_size])
+    output_bias = tf.get_variable("output_bias", [num_labels])
+    logits = tf.nn.bias_add(
+        tf.matmul(output_layer, output_weights, transpose_b=True), output_bias)
+
+  return {
+      "logits": tf.stop_gradient(logits),
+      "hidden_layers": [
+          tf.stop_gradient(layer) for layer in teacher.get_all_encoder_layers()
+      ],
+  }
+
+
+def teacher_assignment_map(teacher_checkpoint):
+  """Maps the variables of `teacher_checkpoint` to the "teacher/" variables."""
+  teacher_variables = {
+      var.op.name: var
+      for var in tf.local_variables()
+      if var.op.name.startswith("teacher/")
+  }
+  assignment_map = collections.OrderedDict()
+  for (name, _) in tf.train.list_variables(teacher_checkpoint):
+    if "teacher/" + name in teacher_variables:
+      assignment_map[name] = teacher_variables["teacher/" + name]
+  if len(assignment_map) != len(teacher_variables):
+    raise ValueError("%s does not have all the variables of the teacher." %
+                     teacher_checkpoint)
+  return assignment_map
+
+
+def create_distillation_loss(hard_loss, logits, model, input_mask,
+                             teacher_outputs, distill_options):
+  """Combines the loss on the labels with the losses on the teacher outputs.
+
+  The soft loss is the cross entropy between the teacher's and the student's
+  probabilities at `distill_options.temperature`, scaled by the squared
+  temperature to keep its gradients comparable to the hard loss'. With a
+  `hidden_weight`, the student's encoder layers are also projected to the
+  teacher's hidden size and matched to evenly spaced teacher layers by mean
+  squared error over the real tokens.
+  """
+  temperature = distill_options.temperature
+  teacher_probs = tf.nn.softmax(teacher_outputs["logits"] / temperature)
+  student_log_probs = tf.nn.log_softmax(logits / temperature)
+  soft_loss = tf.reduce_mean(
+      -tf.reduce_sum(teacher_probs * student_log_probs, axis=-1)) * (
+          temperature**2)
+  loss = (1.0 - distill_options.alpha) * hard_loss + (
+      distill_options.alpha * soft_loss)
+
+  if distill_options.hidden_weight:
+    student_layers = model.get_all_encoder_layers()
+    teacher_layers = teacher_outputs["hidden_layers"]
+    mask = tf.to_float(tf.expand_dims(input_mask, -1))
+    teacher_hidden_size = teacher_layers[0].shape[-1].value
+    hidden_losses = []
+    for (i, student_layer) in enumerate(student_layers):
+      teacher_layer = teacher_layers[
+          (i + 1) * len(teacher_layers) // len(student_layers) - 1]
+      student_layer = tf.cast(student_layer, tf.float32)
+      if student_layer.shape[-1].value != teacher_hidden_size:
+        student_layer = tf.layers.dense(
+            student_layer,
+            teacher_hidden_size,
+            name="hidden_projection_%d" % i,
+            kernel_initializer=modeling.create_initializer(0.02))
+      hidden_losses.append(
+          tf.reduce_sum(tf.square(student_layer - teacher_layer) * mask) /
+          (tf.maximum(tf.reduce_sum(mask), 1.0) * teacher_hidden_size))
+    loss += distill_options.hidden_weight * tf.add_n(hidden_losses) / len(
+        hidden_losses)
+  return loss
+
+
+def create_exit_classifier(first_token_tensor, num_labels, layer_number,
+                           is_training, exit_hidden_size=128):
+  """Creates the early-exit classifier after encoder layer `layer_number`.
+
+  A small tanh projection of the layer's "[CLS]" output followed by a linear
+  classifier, under the variable scope "exit_layer_<layer_number>". Returns the
+  logits.
+  """
+  with tf.variable_scope("exit_layer_%d" % layer_number):
+    exit_hidden = tf.layers.dense(
+        first_token_tensor,
+        exit_hidden_size,
+        activation=tf.tanh,
+        name="pooler",
+        kernel_initializer=modeling.create_initializer(0.02))
+    if is_training:
+      exit_hidden = tf.nn.dropout(exit_hidden, keep_prob=0.9)
+    return tf.layers.dense(
+        exit_hidden,
+        num_labels,
+        name="classifier",
+        kernel_initializer=modeling.create_initializer(0.02))
+
+
 def model_fn_builder(bert_config, num_labels, init_checkpoint, learning_rate,
                      num_train_steps, num_warmup_steps, use_tpu,
-                     use_one_hot_embeddings):
+                     use_one_hot_embeddings, compute_type=tf.float32,
+                     exit_layers=None, exit_training="joint",
+                     distill_options=None):
   """Returns `model_fn` closure for TPUEstimator."""
 
   def model_fn(features, labels, mode, params):  # pylint: disable=unused-argument
@@ -716,25 +896,59 @@ def model_fn_builder(bert_config, num_labels, init_checkpoint, learning_rate,
 
     is_training = (mode == tf.estimator.ModeKeys.TRAIN)
 
+    packed_features = None
+    if "cls_positions" in features:
+      packed_features = {
+          name: features[name] for name in
+          ["position_ids", "packing_ids", "cls_positions", "label_weights"]
+      }
+      label_ids = tf.reshape(label_ids, [-1])
+      is_real_example = tf.to_float(
+          tf.reshape(features["label_weights"], [-1]))
+
+    # The teacher is only needed for training; the exported graph is the
+    # student's alone.
+    teacher_outputs = None
+    if is_training and distill_options is not None:
+      if distill_options.teacher_config is not None:
+        teacher_outputs = create_teacher_model(
+            distill_options.teacher_config, input_ids, input_mask, segment_ids,
+            num_labels)
+      else:
+        teacher_outputs = {
+            "logits": tf.log(tf.maximum(features["teacher_probs"], 1e-8)),
+            "hidden_layers": None,
+        }
+
     (total_loss, per_example_loss, logits, probabilities) = create_model(
         bert_config, is_training, input_ids, input_mask, segment_ids, label_ids,
-        num_labels, use_one_hot_embeddings)
+        num_labels, use_one_hot_embeddings, packed_features, compute_type,
+        exit_layers, exit_training, teacher_outputs, distill_options)
 
     tvars = tf.trainable_variables()
     initialized_variable_names = {}
     scaffold_fn = None
+    checkpoint_assignments = []
     if init_checkpoint:
       (assignment_map, initialized_variable_names
       ) = modeling.get_assignment_map_from_checkpoint(tvars, init_checkpoint)
+      checkpoint_assignments.append((init_checkpoint, assignment_map))
+    if teacher_outputs is not None and distill_options.teacher_checkpoint:
+      checkpoint_assignments.append(
+          (distill_options.teacher_checkpoint,
+           teacher_assignment_map(distill_options.teacher_checkpoint)))
+    if checkpoint_assignments:
       if use_tpu:
 
         def tpu_scaffold():
-          tf.train.init_from_checkpoint(init_checkpoint, assignment_map)
+          for (checkpoint, assignment_map) in checkpoint_assignments:
+            tf.train.init_from_checkpoint(checkpoint, assignment_map)
           return tf.train.Scaffold()
 
         scaffold_fn = tpu_scaffold
       else:
-        tf.train.init_from_checkpoint(init_checkpoint, assignment_map)
+        for (checkpoint, assignment_map) in checkpoint_assignments:
+          tf.train.init_from_checkpoint(checkpoint, assignment_map)
 
     tf.logging.info("**** Trainable Variables ****")
     for var in tvars:
@@ -748,7 +962,8 @@ def model_fn_builder(bert_config, num_labels, init_checkpoint, learning_rate,
     if mode == tf.estimator.ModeKeys.TRAIN:
 
       train_op = optimization.create_optimizer(
-          total_loss, learning_rate, num_train_steps, num_warmup_steps, use_tpu)
+          total_loss, learning_rate, num_train_steps, num_warmup_steps, use_tpu,
+          use_loss_scaling=(compute_type == tf.float16))
 
       output_spec = tf.contrib.tpu.TPUEstimatorSpec(
           mode=mode,
@@ -794,60 +1009,143 @@ def model_fn_builder(bert_config, num_labels, init_checkpoint, learning_rate,
   return model_fn
 
 
-# This function is not used by this file but is still used by the Colab and
-# people who depend on it.
+# Used by `predict_from_arrays`, and by the Colab and people who depend on it.
 def input_fn_builder(features, seq_length, is_training, drop_remainder):
-  """Creates an `input_fn` closure to be passed to TPUEstimator."""
+  """Creates an `input_fn` closure to be passed to TPUEstimator.
 
-  all_input_ids = []
-  all_input_mask = []
-  all_segment_ids = []
-  all_label_ids = []
+  `features` is a dict of NumPy arrays as returned by
+  `featurization.convert_examples_to_arrays`, typically memory-mapped files
+  from `featurization.write_feature_arrays`, or a list of `InputFeatures`.
+  Batches are sliced from the arrays by a generator, so the graph stays small
+  and a memory-mapped array is only paged in as it is read.
 
-  for feature in features:
-    all_input_ids.append(feature.input_ids)
-    all_input_mask.append(feature.input_mask)
-    all_segment_ids.append(feature.segment_ids)
-    all_label_ids.append(feature.label_id)
+  The generator runs in `tf.py_func`, which is not TPU compatible; use
+  `file_based_input_fn_builder` on TPU.
+  """
+  if isinstance(features, dict):
+    arrays = features
+  else:
+    arrays = {
+        "input_ids": np.array([f.input_ids for f in features], np.int32),
+        "input_mask": np.array([f.input_mask for f in features], np.int32),
+        "segment_ids": np.array([f.segment_ids for f in features], np.int32),
+        "label_ids": np.array([f.label_id for f in features], np.int32),
+    }
+  names = ["input_ids", "input_mask", "segment_ids", "label_ids"]
+  if "is_real_example" in arrays:
+    names.append("is_real_example")
+  num_examples = len(arrays["label_ids"])
 
   def input_fn(params):
     """The actual input function."""
     batch_size = params["batch_size"]
 
-    num_examples = len(features)
-
-    # This is for demo purposes and does NOT scale to large data sets. We do
-    # not use Dataset.from_generator() because that uses tf.py_func which is
-    # not TPU compatible. The right way to load data is with TFRecordReader.
-    d = tf.data.Dataset.from_tensor_slices({
-        "input_ids":
-            tf.constant(
-                all_input_ids, shape=[num_examples, seq_length],
-                dtype=tf.int32),
-        "input_mask":
-            tf.constant(
-                all_input_mask,
-                shape=[num_examples, seq_length],
-                dtype=tf.int32),
-        "segment_ids":
-            tf.constant(
-                all_segment_ids,
-                shape=[num_examples, seq_length],
-                dtype=tf.int32),
-        "label_ids":
-            tf.constant(all_label_ids, shape=[num_examples], dtype=tf.int32),
-    })
+    def generate_batches():
+      while True:
+        if is_training:
+          # Reading the rows of a shuffled batch in sorted order walks the
+          # memory map forward instead of back and forth.
+          order = np.random.permutation(num_examples)
+        for start in range(0, num_examples, batch_size):
+          if drop_remainder and start + batch_size > num_examples:
+            break
+          if is_training:
+            index = np.sort(order[start:start + batch_size])
+            yield {name: arrays[name][index] for name in names}
+          else:
+            yield {name: np.asarray(arrays[name][start:start + batch_size])
+                   for name in names}
+        if not is_training:
+          break
 
-    if is_training:
-      d = d.repeat()
-      d = d.shuffle(buffer_size=100)
+    batch_dim = batch_size if drop_remainder else None
+    output_shapes = {}
+    for name in names:
+      if arrays[name].ndim == 2:
+        output_shapes[name] = [batch_dim, seq_length]
+      else:
+        output_shapes[name] = [batch_dim]
+    d = tf.data.Dataset.from_generator(
+        generate_batches,
+        output_types={name: tf.int32 for name in names},
+        output_shapes=output_shapes)
+    return d.prefetch(2)
+
+  return input_fn
 
-    d = d.batch(batch_size=batch_size, drop_remainder=drop_remainder)
-    return d
+
+def feature_store_input_fn_builder(store, is_training, drop_remainder):
+  """Creates an `input_fn` closure reading a `feature_store.FeatureStore`."""
+
+  def input_fn(params):
+    """The actual input function."""
+    return store.dataset(params["batch_size"], is_training, drop_remainder)
 
   return input_fn
 
 
+def length_sorted_input_fn_builder(arrays, batch_size):
+  """Creates an `input_fn` predicting `arrays` in order of sequence length.
+
+  Examples of about the same length are batched together and every batch is
+  trimmed to its longest example, so little compute goes to padding. The
+  batch size is fixed here rather than taken from `params`.
+
+  Args:
+    arrays: A dict of NumPy arrays as returned by
+      `featurization.write_feature_arrays`.
+    batch_size: Number of examples per batch.
+
+  Returns:
+    A tuple (input_fn, order): the i-th prediction of `input_fn` is for
+    example `order[i]`.
+  """
+  names = ["input_ids", "input_mask", "segment_ids", "label_ids"]
+  lengths = np.asarray(arrays["input_mask"]).sum(axis=1)
+  order = np.argsort(lengths, kind="mergesort")
+  # Rows of a batch are read in file order; the batch is the same either way.
+  for start in range(0, len(order), batch_size):
+    order[start:start + batch_size].sort()
+
+  num_batches = 0
+  padded_length = 0
+  for start in range(0, len(order), batch_size):
+    index = order[start:start + batch_size]
+    num_batches += 1
+    padded_length += lengths[index].max() * len(index)
+  tf.logging.info("  Num length sorted batches = %d", num_batches)
+  tf.logging.info("  Mean padded length = %.1f (was %d)",
+                  padded_length / float(max(1, len(order))),
+                  arrays["input_ids"].shape[1])
+
+  def input_fn(params):
+    """The actual input function."""
+    del params  # The batch size is fixed by the builder.
+
+    def generate_batches():
+      for start in range(0, len(order), batch_size):
+        index = order[start:start + batch_size]
+        length = max(1, lengths[index].max())
+        batch = {}
+        for name in names:
+          rows = arrays[name][index]
+          batch[name] = rows[:, :length] if rows.ndim == 2 else rows
+        yield batch
+
+    d = tf.data.Dataset.from_generator(
+        generate_batches,
+        output_types={name: tf.int32 for name in names},
+        output_shapes={
+            "input_ids": [None, None],
+            "input_mask": [None, None],
+            "segment_ids": [None, None],
+            "label_ids": [None],
+        })
+    return d.prefetch(2)
+
+  return input_fn, order
+
+
 # This function is not used by this file but is still used by the Colab and
 # people who depend on it.
 def convert_examples_to_features(examples, label_list, max_seq_length,
@@ -881,6 +1179,9 @@ def serving_input_fn():
 
 def main(_):
   tf.logging.set_verbosity(tf.logging.INFO)
+  # No session has run yet, so tokenizer workers can be forked and share the
+  # vocab. They are spawned once training or evaluation has started threads.
+  tokenization.set_batch_start_method("fork")
 
   processors = {
       "cola": ColaProcessor,
@@ -905,6 +1206,94 @@ def main(_):
         "was only trained up to sequence length %d" %
         (FLAGS.max_seq_length, bert_config.max_position_embeddings))
 
+  if (FLAGS.use_feature_store or FLAGS.predict_from_arrays or
+      FLAGS.predict_sorted_by_length) and FLAGS.use_tpu:
+    raise ValueError(
+        "`use_feature_store`, `predict_from_arrays` and "
+        "`predict_sorted_by_length` read the features in a tf.py_func, which "
+        "is not supported on TPU.")
+
+  if FLAGS.pack_examples_per_row > 1 and (FLAGS.varlen_records or
+                                          FLAGS.use_feature_store):
+    raise ValueError(
+        "`pack_examples_per_row` packs padded TFRecord rows and cannot be "
+        "combined with `varlen_records` or `use_feature_store`.")
+
+  if FLAGS.precision == "fp16" and FLAGS.use_tpu:
+    raise ValueError("`precision=fp16` is not supported on TPU, use bf16.")
+  compute_type = modeling.get_compute_type(FLAGS.precision)
+
+  exit_layers = sorted(int(x) for x in FLAGS.early_exit_layers or [])
+  if any(not 1 <= layer_number < bert_config.num_hidden_layers
+         for layer_number in exit_layers):
+    raise ValueError(
+        "`early_exit_layers` must be between 1 and %d, the last layer is "
+        "classified by the final classifier." %
+        (bert_config.num_hidden_layers - 1))
+  if FLAGS.early_exit_training not in ("joint", "distill"):
+    raise ValueError("Unsupported `early_exit_training`: %s" %
+                     FLAGS.early_exit_training)
+
+  distill_options = None
+  if FLAGS.teacher_checkpoint and FLAGS.teacher_probabilities_file:
+    raise ValueError("Only one of `teacher_checkpoint` and "
+                     "`teacher_probabilities_file` can be set.")
+  if FLAGS.teacher_checkpoint or FLAGS.teacher_probabilities_file:
+    if FLAGS.pack_examples_per_row > 1:
+      raise ValueError(
+          "Distillation cannot be combined with `pack_examples_per_row`.")
+    if not 0.0 <= FLAGS.distill_alpha <= 1.0 or FLAGS.distill_temperature <= 0:
+      raise ValueError("`distill_alpha` must be in [0, 1] and "
+                       "`distill_temperature` positive.")
+    teacher_config = None
+    teacher_checkpoint = None
+    if FLAGS.teacher_checkpoint:
+      if not FLAGS.teacher_bert_config_file:
+        raise ValueError(
+            "`teacher_checkpoint` needs `teacher_bert_config_file`.")
+      teacher_config = modeling.BertConfig.from_json_file(
+          FLAGS.teacher_bert_config_file)
+      teacher_checkpoint = FLAGS.teacher_checkpoint
+      if tf.gfile.IsDirectory(teacher_checkpoint):
+        teacher_checkpoint = tf.train.latest_checkpoint(teacher_checkpoint)
+      if not teacher_checkpoint:
+        raise ValueError("No checkpoint found in %s" % FLAGS.teacher_checkpoint)
+    else:
+      if FLAGS.use_feature_store:
+        raise ValueError("`teacher_probabilities_file` is stored in the "
+                         "TFRecord files and cannot be combined with "
+                         "`use_feature_store`.")
+      if FLAGS.distill_hidden_weight:
+        raise ValueError(
+            "`distill_hidden_weight` needs the hidden states of a "
+            "`teacher_checkpoint`.")
+    distill_options = DistillOptions(
+        teacher_config=teacher_config,
+        teacher_checkpoint=teacher_checkpoint,
+        temperature=FLAGS.distill_temperature,
+        alpha=FLAGS.distill_alpha,
+        hidden_weight=FLAGS.distill_hidden_weight)
+
+  if FLAGS.predict_split not in ("test", "train"):
+    raise ValueError("Unsupported `predict_split`: %s" % FLAGS.predict_split)
+
+  if FLAGS.varlen_records and FLAGS.use_tpu:
+    raise ValueError(
+        "`varlen_records` batches have a dynamic sequence length, which is "
+        "not supported on TPU.")
+  bucket_boundaries = [int(x) for x in FLAGS.bucket_boundaries or []]
+
+  pipeline_options = record_io.InputPipelineOptions(
+      shuffle_files=FLAGS.shuffle_record_files,
+      shuffle_buffer_size=FLAGS.shuffle_buffer_size,
+      parse_batched=FLAGS.parse_batched,
+      num_parallel_calls=(FLAGS.input_num_parallel_calls or
+                          multiprocessing.cpu_count()),
+      prefetch_batches=FLAGS.prefetch_batches)
+  tf.logging.info("***** Input pipeline *****")
+  for (name, value) in zip(pipeline_options._fields, pipeline_options):
+    tf.logging.info("  %s = %s", name, value)
+
   tf.gfile.MakeDirs(FLAGS.output_dir)
 
   task_name = FLAGS.task_name.lower()
@@ -918,6 +1307,8 @@ def main(_):
 
   tokenizer = tokenization.FullTokenizer(
       vocab_file=FLAGS.vocab_file, do_lower_case=FLAGS.do_lower_case)
+  featurization.write_run_metadata(FLAGS.output_dir, label_list,
+                                   FLAGS.max_seq_length, tokenizer)
 
   tpu_cluster_resolver = None
   if FLAGS.use_tpu and FLAGS.tpu_name:
@@ -935,13 +1326,51 @@ def main(_):
           num_shards=FLAGS.num_tpu_cores,
           per_host_input_for_training=is_per_host))
 
-  train_examples = None
+  train_manifest = None
+  train_store = None
   num_train_steps = None
   num_warmup_steps = None
   if FLAGS.do_train:
-    train_examples = processor.get_train_examples(FLAGS.data_dir)
-    num_train_steps = int(
-        len(train_examples) / FLAGS.train_batch_size * FLAGS.num_train_epochs)
+    # The train set is streamed from disk into the TFRecord files, and its
+    # size is taken from their manifest rather than from a list in memory.
+    train_examples = processor.get_train_example_stream(FLAGS.data_dir)
+    if FLAGS.use_feature_store:
+      train_store = feature_store.write_feature_store(
+          train_examples, label_list, FLAGS.max_seq_length, tokenizer,
+          os.path.join(FLAGS.output_dir, "train_store"),
+          num_workers=FLAGS.tokenize_num_workers)
+      num_train_examples = len(train_store)
+    else:
+      teacher_probabilities = None
+      if FLAGS.teacher_probabilities_file:
+        with tf.gfile.GFile(FLAGS.teacher_probabilities_file, "r") as reader:
+          teacher_probabilities = np.loadtxt(
+              reader, dtype=np.float32, delimiter="\t", ndmin=2)
+        if teacher_probabilities.shape[1] != len(label_list):
+          raise ValueError(
+              "%s has %d probabilities per line, the task has %d labels." %
+              (FLAGS.teacher_probabilities_file,
+               teacher_probabilities.shape[1], len(label_list)))
+        # Checked before the (long) conversion of the train set.
+        num_examples = sum(1 for _ in train_examples)
+        if len(teacher_probabilities) != num_examples:
+          raise ValueError(
+              "%s has %d lines for %d training examples." %
+              (FLAGS.teacher_probabilities_file, len(teacher_probabilities),
+               num_examples))
+      train_file = os.path.join(FLAGS.output_dir, "train.tf_record")
+      train_manifest = file_based_convert_examples_to_features(
+          train_examples, label_list, FLAGS.max_seq_length, tokenizer,
+          train_file, num_workers=FLAGS.tokenize_num_workers,
+          num_shards=FLAGS.num_record_shards,
+          compression_type=FLAGS.record_compression,
+          reuse_cached=FLAGS.reuse_cached_features,
+          varlen=FLAGS.varlen_records,
+          examples_per_row=FLAGS.pack_examples_per_row,
+          teacher_probabilities=teacher_probabilities)
+      num_train_examples = train_manifest["num_records"]
+    num_train_steps = int(num_train_examples / FLAGS.train_batch_size *
+                          FLAGS.num_train_epochs)
     num_warmup_steps = int(num_train_steps * FLAGS.warmup_proportion)
 
   model_fn = model_fn_builder(
@@ -952,7 +1381,11 @@ def main(_):
       num_train_steps=num_train_steps,
       num_warmup_steps=num_warmup_steps,
       use_tpu=FLAGS.use_tpu,
-      use_one_hot_embeddings=FLAGS.use_tpu)
+      use_one_hot_embeddings=FLAGS.use_tpu,
+      compute_type=compute_type,
+      exit_layers=exit_layers,
+      exit_training=FLAGS.early_exit_training,
+      distill_options=distill_options)
 
   # If TPU is not available, this will fall back to normal Estimator on CPU
   # or GPU.
@@ -965,19 +1398,34 @@ def main(_):
       predict_batch_size=FLAGS.predict_batch_size)
 
   if FLAGS.do_train:
-    train_file = os.path.join(FLAGS.output_dir, "train.tf_record")
-    file_based_convert_examples_to_features(
-        train_examples, label_list, FLAGS.max_seq_length, tokenizer, train_file)
     tf.logging.info("***** Running training *****")
-    tf.logging.info("  Num examples = %d", len(train_examples))
+    tf.logging.info("  Num examples = %d", num_train_examples)
+    if train_manifest is not None and train_manifest["examples_per_row"] > 1:
+      tf.logging.info("  (packed rows of up to %d examples each)",
+                      train_manifest["examples_per_row"])
     tf.logging.info("  Batch size = %d", FLAGS.train_batch_size)
     tf.logging.info("  Num steps = %d", num_train_steps)
-    train_input_fn = file_based_input_fn_builder(
-        input_file=train_file,
-        seq_length=FLAGS.max_seq_length,
-        is_training=True,
-        drop_remainder=True)
+    if train_store is not None:
+      train_input_fn = feature_store_input_fn_builder(
+          train_store, is_training=True, drop_remainder=True)
+    else:
+      if train_manifest["varlen"]:
+        tf.logging.info(
+            "  Bucket boundaries = %s", bucket_boundaries or
+            record_io.default_bucket_boundaries(FLAGS.max_seq_length))
+      train_input_fn = file_based_input_fn_builder(
+          input_file=train_manifest["files"],
+          compression_type=train_manifest["compression_type"],
+          varlen=train_manifest["varlen"],
+          bucket_boundaries=bucket_boundaries,
+          pipeline_options=pipeline_options,
+          examples_per_row=train_manifest["examples_per_row"],
+          num_teacher_labels=train_manifest.get("num_teacher_labels", 0),
+          seq_length=FLAGS.max_seq_length,
+          is_training=True,
+          drop_remainder=True)
     estimator.train(input_fn=train_input_fn, max_steps=num_train_steps)
+    tokenization.set_batch_start_method("spawn")
 
   if FLAGS.do_eval:
     eval_examples = processor.get_dev_examples(FLAGS.data_dir)
@@ -991,10 +1439,6 @@ def main(_):
       while len(eval_examples) % FLAGS.eval_batch_size != 0:
         eval_examples.append(PaddingInputExample())
 
-    eval_file = os.path.join(FLAGS.output_dir, "eval.tf_record")
-    file_based_convert_examples_to_features(
-        eval_examples, label_list, FLAGS.max_seq_length, tokenizer, eval_file)
-
     tf.logging.info("***** Running evaluation *****")
     tf.logging.info("  Num examples = %d (%d actual, %d padding)",
                     len(eval_examples), num_actual_eval_examples,
@@ -1010,13 +1454,34 @@ def main(_):
       eval_steps = int(len(eval_examples) // FLAGS.eval_batch_size)
 
     eval_drop_remainder = True if FLAGS.use_tpu else False
-    eval_input_fn = file_based_input_fn_builder(
-        input_file=eval_file,
-        seq_length=FLAGS.max_seq_length,
-        is_training=False,
-        drop_remainder=eval_drop_remainder)
+    if FLAGS.use_feature_store:
+      eval_store = feature_store.write_feature_store(
+          eval_examples, label_list, FLAGS.max_seq_length, tokenizer,
+          os.path.join(FLAGS.output_dir, "eval_store"),
+          num_workers=FLAGS.tokenize_num_workers)
+      eval_input_fn = feature_store_input_fn_builder(
+          eval_store, is_training=False, drop_remainder=eval_drop_remainder)
+    else:
+      eval_file = os.path.join(FLAGS.output_dir, "eval.tf_record")
+      eval_manifest = file_based_convert_examples_to_features(
+          eval_examples, label_list, FLAGS.max_seq_length, tokenizer,
+          eval_file, num_workers=FLAGS.tokenize_num_workers,
+          num_shards=FLAGS.num_record_shards,
+          compression_type=FLAGS.record_compression,
+          reuse_cached=FLAGS.reuse_cached_features,
+          varlen=FLAGS.varlen_records)
+      eval_input_fn = file_based_input_fn_builder(
+          input_file=eval_manifest["files"],
+          compression_type=eval_manifest["compression_type"],
+          varlen=eval_manifest["varlen"],
+          bucket_boundaries=bucket_boundaries,
+          pipeline_options=pipeline_options,
+          seq_length=FLAGS.max_seq_length,
+          is_training=False,
+          drop_remainder=eval_drop_remainder)
 
     result = estimator.evaluate(input_fn=eval_input_fn, steps=eval_steps)
+    tokenization.set_batch_start_method("spawn")
 
     output_eval_file = os.path.join(FLAGS.output_dir, "eval_results.txt")
     with tf.gfile.GFile(output_eval_file, "w") as writer:
@@ -1026,7 +1491,29 @@ def main(_):
         writer.write("%s = %s\n" % (key, str(result[key])))
 
   if FLAGS.do_predict:
-    predict_examples = processor.get_test_examples(FLAGS.data_dir)
+    if FLAGS.predict_split == "train":
+      # The teacher's probabilities of the training examples, in the order of
+      # the training set, for a student's `teacher_probabilities_file`.
+      predict_examples = processor.get_train_examples(FLAGS.data_dir)
+    else:
+      predict_examples = processor.get_test_examples(FLAGS.data_dir)
+    predict_inverse = None
+    if FLAGS.dedup_predict_examples:
+      num_rows = len(predict_examples)
+      predict_examples, predict_inverse = featurization.dedup_examples(
+          predict_examples, tokenizer)
+      tf.logging.info("***** Dedup of predict examples *****")
+      tf.logging.info("  Num rows = %d", num_rows)
+      tf.logging.info("  Num unique texts = %d", len(predict_examples))
+      tf.logging.info("  Duplicate rows = %d (%.1f%%)",
+                      num_rows - len(predict_examples),
+                      100.0 * (num_rows - len(predict_examples)) /
+                      max(1, num_rows))
+      if num_rows:
+        counts = np.bincount(predict_inverse)
+        tf.logging.info("  Most repeated text = %r (%d rows)",
+                        predict_examples[counts.argmax()].text_a,
+                        counts.max())
     num_actual_predict_examples = len(predict_examples)
     if FLAGS.use_tpu:
       # TPU requires a fixed batch size for all batches, therefore the number
@@ -1036,27 +1523,83 @@ def main(_):
       while len(predict_examples) % FLAGS.predict_batch_size != 0:
         predict_examples.append(PaddingInputExample())
 
-    predict_file = os.path.join(FLAGS.output_dir, "predict.tf_record")
-    file_based_convert_examples_to_features(predict_examples, label_list,
-                                            FLAGS.max_seq_length, tokenizer,
-                                            predict_file)
-
     tf.logging.info("***** Running prediction*****")
     tf.logging.info("  Num examples = %d (%d actual, %d padding)",
                     len(predict_examples), num_actual_predict_examples,
                     len(predict_examples) - num_actual_predict_examples)
-    tf.logging.info("  Batch size = %d", FLAGS.predict_batch_size)
 
     predict_drop_remainder = True if FLAGS.use_tpu else False
-    predict_input_fn = file_based_input_fn_builder(
-        input_file=predict_file,
-        seq_length=FLAGS.max_seq_length,
-        is_training=False,
-        drop_remainder=predict_drop_remainder)
+    predict_order = None
+    if FLAGS.predict_sorted_by_length:
+      predict_arrays = featurization.write_feature_arrays(
+          predict_examples, label_list, FLAGS.max_seq_length, tokenizer,
+          os.path.join(FLAGS.output_dir, "predict_features"),
+          num_workers=FLAGS.tokenize_num_workers)
+      tf.logging.info("  Batch size = %d", FLAGS.bulk_predict_batch_size)
+      predict_input_fn, predict_order = length_sorted_input_fn_builder(
+          predict_arrays, FLAGS.bulk_predict_batch_size)
+    elif FLAGS.use_feature_store:
+      predict_store = feature_store.write_feature_store(
+          predict_examples, label_list, FLAGS.max_seq_length, tokenizer,
+          os.path.join(FLAGS.output_dir, "predict_store"),
+          num_workers=FLAGS.tokenize_num_workers)
+      predict_input_fn = feature_store_input_fn_builder(
+          predict_store, is_training=False,
+          drop_remainder=predict_drop_remainder)
+    elif FLAGS.predict_from_arrays:
+      # Written once and memory-mapped, so the features are neither embedded
+      # in the graph nor all held in memory.
+      predict_arrays = featurization.write_feature_arrays(
+          predict_examples, label_list, FLAGS.max_seq_length, tokenizer,
+          os.path.join(FLAGS.output_dir, "predict_features"),
+          num_workers=FLAGS.tokenize_num_workers)
+      predict_input_fn = input_fn_builder(
+          features=predict_arrays,
+          seq_length=FLAGS.max_seq_length,
+          is_training=False,
+          drop_remainder=predict_drop_remainder)
+    else:
+      predict_file = os.path.join(FLAGS.output_dir, "predict.tf_record")
+      predict_manifest = file_based_convert_examples_to_features(
+          predict_examples, label_list, FLAGS.max_seq_length, tokenizer,
+          predict_file, num_workers=FLAGS.tokenize_num_workers,
+          num_shards=FLAGS.num_record_shards,
+          compression_type=FLAGS.record_compression,
+          reuse_cached=FLAGS.reuse_cached_features,
+          varlen=FLAGS.varlen_records)
+      predict_input_fn = file_based_input_fn_builder(
+          input_file=predict_manifest["files"],
+          compression_type=predict_manifest["compression_type"],
+          varlen=predict_manifest["varlen"],
+          bucket_boundaries=bucket_boundaries,
+          pipeline_options=pipeline_options,
+          seq_length=FLAGS.max_seq_length,
+          is_training=False,
+          drop_remainder=predict_drop_remainder)
+    if predict_order is None:
+      tf.logging.info("  Batch size = %d", FLAGS.predict_batch_size)
 
     result = estimator.predict(input_fn=predict_input_fn)
-
-    output_predict_file = os.path.join(FLAGS.output_dir, "test_results.tsv")
+    if predict_order is not None or predict_inverse is not None:
+      # Collect the predictions in input order; `predict_sorted_by_length`
+      # makes them in length order.
+      if predict_order is None:
+        predict_order = range(num_actual_predict_examples)
+      all_probabilities = np.zeros(
+          [num_actual_predict_examples, len(label_list)], dtype=np.float32)
+      num_predictions = 0
+      for (i, prediction) in zip(predict_order, result):
+        all_probabilities[i] = prediction["probabilities"]
+        num_predictions += 1
+      assert num_predictions == num_actual_predict_examples
+      if predict_inverse is not None:
+        # Every row gets the probabilities of its distinct text.
+        all_probabilities = all_probabilities[predict_inverse]
+        num_actual_predict_examples = len(predict_inverse)
+      result = ({"probabilities": p} for p in all_probabilities)
+
+    output_predict_file = os.path.join(
+        FLAGS.output_dir, "%s_results.tsv" % FLAGS.predict_split)
     with tf.gfile.GFile(output_predict_file, "w") as writer:
       num_written_lines = 0
       tf.logging.info("***** Predict results *****")
@@ -18,15 +18,16 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import collections
 import csv
+import multiprocessing
 import os
+import featurization
 import modeling
 import random
 import optimization
+import record_io
 import tokenization
 import tensorflow as tf
-import pickle
 from sklearn.metrics import classification_report
 flags = tf.flags
 
@@ -119,6 +120,68 @@ flags.DEFINE_integer("iterations_per_loop", 1000,
 
 flags.DEFINE_bool("use_tpu", False, "Whether to use TPU or GPU/CPU.")
 
+flags.DEFINE_bool(
+    "stream_train_examples", False,
+    "Whether to stream the train set from disk into the tf_record files "
+    "instead of loading and shuffling it in memory.")
+
+flags.DEFINE_bool(
+    "reuse_cached_features", True,
+    "Whether to reuse TFRecord files written by an earlier run from the same "
+    "examples, vocab, do_lower_case, max_seq_length and labels instead of "
+    "converting the examples again.")
+
+flags.DEFINE_integer(
+    "num_record_shards", 1,
+    "Number of TFRecord shards the features are written to, each by its own "
+    "worker process. 1 writes a single file in the main process.")
+
+flags.DEFINE_string(
+    "record_compression", "",
+    "Compression of the TFRecord files: empty for none, GZIP or ZLIB.")
+
+flags.DEFINE_bool(
+    "varlen_records", False,
+    "Whether to write the features unpadded and batch them by length: "
+    "training batches are bucketed by sequence length, and every batch is "
+    "only padded to its longest example. Not supported on TPU.")
+
+flags.DEFINE_list(
+    "bucket_boundaries", None,
+    "Comma separated sequence length boundaries of the `varlen_records` "
+    "training buckets. Default: 16,32,64,... below max_seq_length.")
+
+flags.DEFINE_bool(
+    "shuffle_record_files", True,
+    "Whether to shuffle the order of the TFRecord shards in every training "
+    "epoch, on top of shuffling the records.")
+
+flags.DEFINE_integer(
+    "shuffle_buffer_size", 10000,
+    "Number of training records in the record-level shuffle buffer.")
+
+flags.DEFINE_bool(
+    "parse_batched", True,
+    "Whether to decode the records a batch at a time with one "
+    "`tf.parse_example` call instead of one `tf.parse_single_example` per "
+    "record. Bucketed `varlen_records` training batches are always decoded "
+    "per record.")
+
+flags.DEFINE_integer(
+    "input_num_parallel_calls", None,
+    "Number of records or batches decoded in parallel. Default: the number of "
+    "CPU cores.")
+
+flags.DEFINE_integer(
+    "prefetch_batches", 2,
+    "Number of input batches prepared ahead of the model, 0 for none.")
+
+flags.DEFINE_string(
+    "precision", "fp32",
+    "Precision of the Transformer encoder: \"fp32\", \"fp16\" (with dynamic "
+    "loss scaling for training) or \"bf16\". Variables and checkpoints stay "
+    "in float32.")
+
 tf.flags.DEFINE_string(
     "tpu_name", None,
     "The Cloud TPU to use for training. This should be either the name "
@@ -143,54 +206,9 @@ flags.DEFINE_integer(
     "num_tpu_cores", 8,
     "Only used if `use_tpu` is True. Total number of TPU cores to use.")
 
-class InputExample(object):
-  """A single training/test example for simple sequence classification."""
-
-  def __init__(self, guid, text_a, text_b=None, label=None):
-    """Constructs a InputExample.
-
-    Args:
-      guid: Unique id for the example.
-      text_a: string. The untokenized text of the first sequence. For single
-        sequence tasks, only this sequence must be specified.
-      text_b: (Optional) string. The untokenized text of the second sequence.
-        Only must be specified for sequence pair tasks.
-      label: (Optional) string. The label of the example. This should be
-        specified for train and dev examples, but not for test examples.
-    """
-    self.guid = guid
-    self.text_a = text_a
-    self.text_b = text_b
-    self.label = label
-
-
-class PaddingInputExample(object):
-  """Fake example so the num input examples is a multiple of the batch size.
-
-  When running eval/predict on the TPU, we need to pad the number of examples
-  to be a multiple of the batch size, because the TPU requires a fixed batch
-  size. The alternative is to drop the last batch, which is bad because it means
-  the entire output data won't be generated.
-
-  We use this class instead of `None` because treating `None` as padding
-  battches could cause silent errors.
-  """
-
-
-class InputFeatures(object):
-  """A single set of features of data."""
-
-  def __init__(self,
-               input_ids,
-               input_mask,
-               segment_ids,
-               label_id,
-               is_real_example=True):
-    self.input_ids = input_ids
-    self.input_mask = input_mask
-    self.segment_ids = segment_ids
-    self.label_id = label_id
-    self.is_real_example = is_real_example
+InputExample = featurization.InputExample
+PaddingInputExample = featurization.PaddingInputExample
+InputFeatures = featurization.InputFeatures
 
 
 class DataProcessor(object):
@@ -200,6 +218,15 @@ class DataProcessor(object):
     """Gets a collection of `InputExample`s for the train set."""
     raise NotImplementedError()
 
+  def get_train_example_stream(self, data_dir):
+    """Gets the train set as an iterable that can be read more than once.
+
+    Processors of large data sets return a `featurization.ExampleStream`, so
+    that the examples are streamed from disk instead of held in memory. By
+    default this is just `get_train_examples`.
+    """
+    return self.get_train_examples(data_dir)
+
   def get_dev_examples(self, data_dir):
     """Gets a collection of `InputExample`s for the dev set."""
     raise NotImplementedError()
@@ -215,12 +242,19 @@ class DataProcessor(object):
   @classmethod
   def _read_tsv(cls, input_file, quotechar=None):
     """Reads a tab separated value file."""
+    return list(cls._iter_tsv(input_file, quotechar))
+
+  @classmethod
+  def _iter_tsv(cls, input_file, quotechar=None):
+    """Yields the lines of a tab separated value file one at a time."""
     with tf.gfile.Open(input_file, "r") as f:
       reader = csv.reader(f, delimiter="\t", quotechar=quotechar)
-      lines = []
       for line in reader:
-        lines.append(line)
-      return lines
+        yield line
+
+  def _stream_examples(self, input_file, set_type):
+    """Yields the examples of `input_file`, see `get_train_example_stream`."""
+    return self._create_examples(self._iter_tsv(input_file), set_type)
 
 class XnliProcessor(DataProcessor):
   """Processor for the XNLI data set."""
@@ -313,18 +347,23 @@ class MnliProcessor(DataProcessor):
 class SentimentProcessor(DataProcessor):
   def get_train_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, FLAGS.train_file)), "train")
+    return list(self.get_train_example_stream(data_dir))
+
+  def get_train_example_stream(self, data_dir):
+    """See base class."""
+    return featurization.ExampleStream(
+        self._stream_examples, os.path.join(data_dir, FLAGS.train_file),
+        "train")
 
   def get_dev_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, FLAGS.dev_file)), "dev")
+    return list(
+        self._stream_examples(os.path.join(data_dir, FLAGS.dev_file), "dev"))
 
   def get_test_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, FLAGS.test_file)), "test")
+    return list(
+        self._stream_examples(os.path.join(data_dir, FLAGS.test_file), "test"))
 
   def get_labels(self):
     """See base class."""
@@ -337,8 +376,7 @@ class SentimentProcessor(DataProcessor):
     return  ['happy', 'anger', 'lost', 'fear', 'sad', 'other', 'anxiety']
 
   def _create_examples(self, lines, set_type):
-    """Creates examples for the training and dev sets."""
-    examples = []
+    """Yields examples for the training and dev sets."""
     for (i, line) in enumerate(lines):
       guid = "%s-%s" % (set_type, i)
 
@@ -347,42 +385,40 @@ class SentimentProcessor(DataProcessor):
         label = "0"
       else:
         label = tokenization.convert_to_unicode(line[0])
-      examples.append(
-          InputExample(guid=guid, text_a=text_a, label=label))
-
-    return examples
+      yield InputExample(guid=guid, text_a=text_a, label=label)
 
 class CommandProcessor(DataProcessor):
   def get_train_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, FLAGS.train_file)), "train")
+    return list(self.get_train_example_stream(data_dir))
+
+  def get_train_example_stream(self, data_dir):
+    """See base class."""
+    return featurization.ExampleStream(
+        self._stream_examples, os.path.join(data_dir, FLAGS.train_file),
+        "train")
 
   def get_dev_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, FLAGS.dev_file)), "dev")
+    return list(
+        self._stream_examples(os.path.join(data_dir, FLAGS.dev_file), "dev"))
 
   def get_test_examples(self, data_dir):
     """See base class."""
-    return self._create_examples(
-        self._read_tsv(os.path.join(data_dir, FLAGS.test_file)), "test")
+    return list(
+        self._stream_examples(os.path.join(data_dir, FLAGS.test_file), "test"))
 
   def get_labels(self):
     """See base class."""
     return ['ask', 'busy', 'confirm', 'deny', 'linebusy', 'myself', 'unknown']
 
   def _create_examples(self, lines, set_type):
-    """Creates examples for the training and dev sets."""
-    examples = []
+    """Yields examples for the training and dev sets."""
     for (i, line) in enumerate(lines):
       guid = "%s-%s" % (set_type, i)
       text_a = tokenization.convert_to_unicode(line[0])
       label = tokenization.convert_to_unicode(line[1])
-      examples.append(
-            InputExample(guid=guid, text_a=text_a, label=label))
-
-    return examples
+      yield InputExample(guid=guid, text_a=text_a, label=label)
 #-----------------------------------------
 
 class MrpcProcessor(DataProcessor):
@@ -465,219 +501,60 @@ class ColaProcessor(DataProcessor):
           InputExample(guid=guid, text_a=text_a, text_b=None, label=label))
     return examples
 
-##
 def convert_single_example(ex_index, example, label_list, max_seq_length,
                            tokenizer):
   """Converts a single `InputExample` into a single `InputFeatures`."""
-
-  if isinstance(example, PaddingInputExample):
-    return InputFeatures(
-        input_ids=[0] * max_seq_length,
-        input_mask=[0] * max_seq_length,
-        segment_ids=[0] * max_seq_length,
-        label_id=0,
-        is_real_example=False)
-
-  label_map = {}
-  for (i, label) in enumerate(label_list):
-    label_map[label] = i
-  
-  #--- save label2id.pkl ---
-  #在这里输出label2id.pkl , add by stephen 2019-10-12
-  #用于服务端bert-base部署
-  output_label2id_file = os.path.join(FLAGS.output_dir, "label2id.pkl")
-  if not os.path.exists(output_label2id_file):
-    with open(output_label2id_file,'wb') as w:
-      pickle.dump(label_map,w)
-
-  #--- Add end ---
-
-
-  tokens_a = tokenizer.tokenize(example.text_a)
-  tokens_b = None
-  if example.text_b:
-    tokens_b = tokenizer.tokenize(example.text_b)
-
-  if tokens_b:
-    # Modifies `tokens_a` and `tokens_b` in place so that the total
-    # length is less than the specified length.
-    # Account for [CLS], [SEP], [SEP] with "- 3"
-    _truncate_seq_pair(tokens_a, tokens_b, max_seq_length - 3)
-  else:
-    # Account for [CLS] and [SEP] with "- 2"
-    if len(tokens_a) > max_seq_length - 2:
-      tokens_a = tokens_a[0:(max_seq_length - 2)]
-
-  # The convention in BERT is:
-  # (a) For sequence pairs:
-  #  tokens:   [CLS] is this jack ##son ##ville ? [SEP] no it is not . [SEP]
-  #  type_ids: 0     0  0    0    0     0       0 0     1  1  1  1   1 1
-  # (b) For single sequences:
-  #  tokens:   [CLS] the dog is hairy . [SEP]
-  #  type_ids: 0     0   0   0  0     0 0
-  #
-  # Where "type_ids" are used to indicate whether this is the first
-  # sequence or the second sequence. The embedding vectors for `type=0` and
-  # `type=1` were learned during pre-training and are added to the wordpiece
-  # embedding vector (and position vector). This is not *strictly* necessary
-  # since the [SEP] token unambiguously separates the sequences, but it makes
-  # it easier for the model to learn the concept of sequences.
-  #
-  # For classification tasks, the first vector (corresponding to [CLS]) is
-  # used as the "sentence vector". Note that this only makes sense because
-  # the entire model is fine-tuned.
-  tokens = []
-  segment_ids = []
-  tokens.append("[CLS]")
-  segment_ids.append(0)
-  for token in tokens_a:
-    tokens.append(token)
-    segment_ids.append(0)
-  tokens.append("[SEP]")
-  segment_ids.append(0)
-
-  if tokens_b:
-    for token in tokens_b:
-      tokens.append(token)
-      segment_ids.append(1)
-    tokens.append("[SEP]")
-    segment_ids.append(1)
-
-  input_ids = tokenizer.convert_tokens_to_ids(tokens)
-
-  # The mask has 1 for real tokens and 0 for padding tokens. Only real
-  # tokens are attended to.
-  input_mask = [1] * len(input_ids)
-
-  # Zero-pad up to the sequence length.
-  while len(input_ids) < max_seq_length:
-    input_ids.append(0)
-    input_mask.append(0)
-    segment_ids.append(0)
-
-  assert len(input_ids) == max_seq_length
-  assert len(input_mask) == max_seq_length
-  assert len(segment_ids) == max_seq_length
-
-  #debug xmxoxo 2019/3/13
-  #print(ex_index,example.text_a)
-  
-  label_id = label_map[example.label]
-  if ex_index < 5:
-    tf.logging.info("*** Example ***")
-    tf.logging.info("guid: %s" % (example.guid))
-    tf.logging.info("tokens: %s" % " ".join(
-        [tokenization.printable_text(x) for x in tokens]))
-    tf.logging.info("input_ids: %s" % " ".join([str(x) for x in input_ids]))
-    tf.logging.info("input_mask: %s" % " ".join([str(x) for x in input_mask]))
-    tf.logging.info("segment_ids: %s" % " ".join([str(x) for x in segment_ids]))
-    tf.logging.info("label: %s (id = %d)" % (example.label, label_id))
-
-  feature = InputFeatures(
-      input_ids=input_ids,
-      input_mask=input_mask,
-      segment_ids=segment_ids,
-      label_id=label_id,
-      is_real_example=True)
+  feature = featurization.convert_single_example(
+      example, label_list, max_seq_length, tokenizer)
+  if ex_index < 5 and feature.is_real_example:
+    record_io.log_example(example, tokenizer, feature.input_ids,
+                          feature.input_mask, feature.segment_ids,
+                          feature.label_id)
   return feature
 
 
 def file_based_convert_examples_to_features(
-    examples, label_list, max_seq_length, tokenizer, output_file):
-  """Convert a set of `InputExample`s to a TFRecord file."""
-
-  writer = tf.python_io.TFRecordWriter(output_file)
-
-  for (ex_index, example) in enumerate(examples):
-    if ex_index % 10000 == 0:
-      tf.logging.info("Writing example %d of %d" % (ex_index, len(examples)))
-
-    feature = convert_single_example(ex_index, example, label_list,
-                                     max_seq_length, tokenizer)
-
-    def create_int_feature(values):
-      f = tf.train.Feature(int64_list=tf.train.Int64List(value=list(values)))
-      return f
-
-    features = collections.OrderedDict()
-    features["input_ids"] = create_int_feature(feature.input_ids)
-    features["input_mask"] = create_int_feature(feature.input_mask)
-    features["segment_ids"] = create_int_feature(feature.segment_ids)
-    features["label_ids"] = create_int_feature([feature.label_id])
-    features["is_real_example"] = create_int_feature(
-        [int(feature.is_real_example)])
+    examples, label_list, max_seq_length, tokenizer, output_file,
+    num_workers=1, num_shards=1, compression_type="", reuse_cached=True,
+    varlen=False):
+  """Convert a set of `InputExample`s to (sharded) TFRecord files.
 
-    tf_example = tf.train.Example(features=tf.train.Features(feature=features))
-    writer.write(tf_example.SerializeToString())
-  writer.close()
+  Files already written from the same inputs are reused. Returns the manifest
+  of the files, see `record_io.load_manifest`.
+  """
+  return record_io.write_sharded_records(
+      examples, label_list, max_seq_length, tokenizer, output_file,
+      num_shards=num_shards, num_workers=num_workers,
+      compression_type=compression_type, reuse_cached=reuse_cached,
+      varlen=varlen)
 
 
 def file_based_input_fn_builder(input_file, batch_size, seq_length, is_training,
-                                drop_remainder):
-  """Creates an `input_fn` closure to be passed to TPUEstimator."""
-
-  name_to_features = {
-      "input_ids": tf.FixedLenFeature([seq_length], tf.int64),
-      "input_mask": tf.FixedLenFeature([seq_length], tf.int64),
-      "segment_ids": tf.FixedLenFeature([seq_length], tf.int64),
-      "label_ids": tf.FixedLenFeature([], tf.int64),
-      "is_real_example": tf.FixedLenFeature([], tf.int64),
-  }
-
-  def _decode_record(record, name_to_features):
-    """Decodes a record to a TensorFlow example."""
-    example = tf.parse_single_example(record, name_to_features)
-
-    # tf.Example only supports tf.int64, but the TPU only supports tf.int32.
-    # So cast all int64 to int32.
-    for name in list(example.keys()):
-      t = example[name]
-      if t.dtype == tf.int64:
-        t = tf.to_int32(t)
-      example[name] = t
-
-    return example
+                                drop_remainder, compression_type="",
+                                varlen=False, bucket_boundaries=None,
+                                pipeline_options=None):
+  """Creates an `input_fn` closure to be passed to TPUEstimator.
+
+  `input_file` is a TFRecord file or a list of shards. The batches are read by
+  `record_io.input_dataset`, configured by the `record_io.InputPipelineOptions`
+  `pipeline_options`.
+  """
+  input_files = input_file if isinstance(input_file, list) else [input_file]
+  options = pipeline_options or record_io.DEFAULT_INPUT_PIPELINE
 
   def input_fn():
     """The actual input function."""
-
-    # For training, we want a lot of parallel reading and shuffling.
-    # For eval, we want no shuffling and parallel reading doesn't matter.
-    d = tf.data.TFRecordDataset(input_file)
-    if is_training:
-      d = d.repeat()
-      d = d.shuffle(buffer_size=100)
-
-    d = d.apply(
-        tf.contrib.data.map_and_batch(
-            lambda record: _decode_record(record, name_to_features),
-            batch_size=batch_size,
-            drop_remainder=drop_remainder))
-
-    return d
+    return record_io.input_dataset(
+        input_files, seq_length, batch_size, is_training, drop_remainder,
+        compression_type=compression_type, varlen=varlen,
+        bucket_boundaries=bucket_boundaries, options=options)
 
   return input_fn
 
 
-def _truncate_seq_pair(tokens_a, tokens_b, max_length):
-  """Truncates a sequence pair in place to the maximum length."""
-
-  # This is a simple heuristic which will always truncate the longer sequence
-  # one token at a time. This makes more sense than truncating an equal percent
-  # of tokens from each, since if one sequence is very short then each token
-  # that's truncated likely contains more information than a longer sequence.
-  while True:
-    total_length = len(tokens_a) + len(tokens_b)
-    if total_length <= max_length:
-      break
-    if len(tokens_a) > len(tokens_b):
-      tokens_a.pop()
-    else:
-      tokens_b.pop()
-
-
 def create_model(bert_config, is_training, input_ids, input_mask, segment_ids,
-                 labels, num_labels, use_one_hot_embeddings):
+                 labels, num_labels, use_one_hot_embeddings,
+                 compute_type=tf.float32):
   """Creates a classification model."""
   model = modeling.BertModel(
       config=bert_config,
@@ -685,7 +562,8 @@ def create_model(bert_config, is_training, input_ids, input_mask, segment_ids,
       input_ids=input_ids,
       input_mask=input_mask,
       token_type_ids=segment_ids,
-      use_one_hot_embeddings=use_one_hot_embeddings)
+      use_one_hot_embeddings=use_one_hot_embeddings,
+      compute_type=compute_type)
 
   # In the demo, we are doing a simple classification task on the entire
   # segment.
@@ -724,7 +602,7 @@ def create_model(bert_config, is_training, input_ids, input_mask, segment_ids,
 
 def model_fn_builder(bert_config, num_labels, init_checkpoint, learning_rate,
                      num_train_steps, num_warmup_steps, use_tpu,
-                     use_one_hot_embeddings):
+                     use_one_hot_embeddings, compute_type=tf.float32):
   """Returns `model_fn` closure for TPUEstimator."""
 
   def model_fn(features, labels, mode, params):  # pylint: disable=unused-argument
@@ -748,7 +626,7 @@ def model_fn_builder(bert_config, num_labels, init_checkpoint, learning_rate,
 
     (total_loss, per_example_loss, predictions, probabilities) = create_model(
         bert_config, is_training, input_ids, input_mask, segment_ids, label_ids,
-        num_labels, use_one_hot_embeddings)
+        num_labels, use_one_hot_embeddings, compute_type)
 
     tvars = tf.trainable_variables()
     initialized_variable_names = {}
@@ -769,7 +647,8 @@ def model_fn_builder(bert_config, num_labels, init_checkpoint, learning_rate,
     if mode == tf.estimator.ModeKeys.TRAIN:
 
       train_op = optimization.create_optimizer(
-          total_loss, learning_rate, num_train_steps, num_warmup_steps, use_tpu)
+          total_loss, learning_rate, num_train_steps, num_warmup_steps, use_tpu,
+          use_loss_scaling=(compute_type == tf.float16))
 
       output_spec = tf.estimator.EstimatorSpec(
           mode=mode,
@@ -952,6 +831,27 @@ def main(_):
         "was only trained up to sequence length %d" %
         (FLAGS.max_seq_length, bert_config.max_position_embeddings))
 
+  if FLAGS.precision == "fp16" and FLAGS.use_tpu:
+    raise ValueError("`precision=fp16` is not supported on TPU, use bf16.")
+  compute_type = modeling.get_compute_type(FLAGS.precision)
+
+  if FLAGS.varlen_records and FLAGS.use_tpu:
+    raise ValueError(
+        "`varlen_records` batches have a dynamic sequence length, which is "
+        "not supported on TPU.")
+  bucket_boundaries = [int(x) for x in FLAGS.bucket_boundaries or []]
+
+  pipeline_options = record_io.InputPipelineOptions(
+      shuffle_files=FLAGS.shuffle_record_files,
+      shuffle_buffer_size=FLAGS.shuffle_buffer_size,
+      parse_batched=FLAGS.parse_batched,
+      num_parallel_calls=(FLAGS.input_num_parallel_calls or
+                          multiprocessing.cpu_count()),
+      prefetch_batches=FLAGS.prefetch_batches)
+  tf.logging.info("***** Input pipeline *****")
+  for (name, value) in zip(pipeline_options._fields, pipeline_options):
+    tf.logging.info("  %s = %s", name, value)
+
   tf.gfile.MakeDirs(FLAGS.output_dir)
 
   task_name = FLAGS.task_name.lower()
@@ -968,6 +868,8 @@ def main(_):
 
   tokenizer = tokenization.FullTokenizer(
       vocab_file=FLAGS.vocab_file, do_lower_case=FLAGS.do_lower_case)
+  featurization.write_run_metadata(FLAGS.output_dir, label_list,
+                                   FLAGS.max_seq_length, tokenizer)
 
   tpu_cluster_resolver = None
   if FLAGS.use_tpu and FLAGS.tpu_name:
@@ -981,17 +883,30 @@ def main(_):
       save_checkpoints_steps=FLAGS.save_checkpoints_steps,
       keep_checkpoint_max=1)
 
-  train_examples = None
+  train_manifest = None
   num_train_steps = None
   num_warmup_steps = None
   if FLAGS.do_train:
-    train_examples = processor.get_train_examples(FLAGS.data_dir)
-    num_train_steps = int(
-        len(train_examples) / FLAGS.train_batch_size * FLAGS.num_train_epochs)
+    if FLAGS.stream_train_examples:
+      # Streamed from disk into the tf_record files in file order; only the
+      # input pipeline's shuffle buffer mixes the examples.
+      train_examples = processor.get_train_example_stream(FLAGS.data_dir)
+    else:
+      train_examples = processor.get_train_examples(FLAGS.data_dir)
+      # in case of loss not being reduced
+      rng = random.Random(12345)
+      rng.shuffle(train_examples)
+    train_file = os.path.join(FLAGS.output_dir, FLAGS.train_file+"_train.tf_record")
+    # Reuses the tf_record files if they were converted from the same raw text.
+    train_manifest = file_based_convert_examples_to_features(
+        train_examples, label_list, FLAGS.max_seq_length, tokenizer, train_file,
+        num_shards=FLAGS.num_record_shards,
+        compression_type=FLAGS.record_compression,
+        reuse_cached=FLAGS.reuse_cached_features,
+        varlen=FLAGS.varlen_records)
+    num_train_steps = int(train_manifest["num_records"] /
+                          FLAGS.train_batch_size * FLAGS.num_train_epochs)
     num_warmup_steps = int(num_train_steps * FLAGS.warmup_proportion)
-    # in case of loss not being reduced
-    rng = random.Random(12345)
-    rng.shuffle(train_examples)
 
   model_fn = model_fn_builder(
       bert_config=bert_config,
@@ -1001,7 +916,8 @@ def main(_):
       num_train_steps=num_train_steps,
       num_warmup_steps=num_warmup_steps,
       use_tpu=FLAGS.use_tpu,
-      use_one_hot_embeddings=FLAGS.use_tpu)
+      use_one_hot_embeddings=FLAGS.use_tpu,
+      compute_type=compute_type)
 
   # use GPU estimator instead of TPUEstimator to show training process and loss log 
   estimator = tf.estimator.Estimator(
@@ -1019,18 +935,19 @@ def main(_):
                 run_every_steps=FLAGS.save_checkpoints_steps)
 
   if FLAGS.do_train:
-    train_file = os.path.join(FLAGS.output_dir, FLAGS.train_file+"_train.tf_record")
-    train_file_exists=os.path.exists(train_file)
-    print("###train_file_exists:", train_file_exists," ;train_file:", train_file)
-    if not train_file_exists: # if tf_record file not exist, convert from raw text file.
-        file_based_convert_examples_to_features(
-            train_examples, label_list, FLAGS.max_seq_length, tokenizer, train_file)
     tf.logging.info("***** Running training *****")
-    tf.logging.info("  Num examples = %d", len(train_examples))
+    tf.logging.info("  Num examples = %d", train_manifest["num_records"])
     tf.logging.info("  Batch size = %d", FLAGS.train_batch_size)
     tf.logging.info("  Num steps = %d", num_train_steps)
+    if train_manifest["varlen"]:
+      tf.logging.info("  Bucket boundaries = %s", bucket_boundaries or
+                      record_io.default_bucket_boundaries(FLAGS.max_seq_length))
     train_input_fn = file_based_input_fn_builder(
-        input_file=train_file,
+        input_file=train_manifest["files"],
+        compression_type=train_manifest["compression_type"],
+        varlen=train_manifest["varlen"],
+        bucket_boundaries=bucket_boundaries,
+        pipeline_options=pipeline_options,
         batch_size=FLAGS.train_batch_size,
         seq_length=FLAGS.max_seq_length,
         is_training=True,
@@ -1052,11 +969,13 @@ def main(_):
       while len(eval_examples) % FLAGS.eval_batch_size != 0:
         eval_examples.append(PaddingInputExample())
     eval_file = os.path.join(FLAGS.output_dir, FLAGS.dev_file+"_eval.tf_record")
-    eval_file_exists=os.path.exists(eval_file)
-    print("###eval_file_exists:", eval_file_exists," ;eval_file:", eval_file)
-    if not eval_file_exists: # if tf_record file not exist, convert from raw text file.
-        file_based_convert_examples_to_features(
-        eval_examples, label_list, FLAGS.max_seq_length, tokenizer, eval_file)
+    # Reuses the tf_record files if they were converted from the same raw text.
+    eval_manifest = file_based_convert_examples_to_features(
+        eval_examples, label_list, FLAGS.max_seq_length, tokenizer, eval_file,
+        num_shards=FLAGS.num_record_shards,
+        compression_type=FLAGS.record_compression,
+        reuse_cached=FLAGS.reuse_cached_features,
+        varlen=FLAGS.varlen_records)
 
     tf.logging.info("***** Running evaluation *****")
     tf.logging.info("  Num examples = %d (%d actual, %d padding)",
@@ -1074,7 +993,11 @@ def main(_):
 
     eval_drop_remainder = True if FLAGS.use_tpu else False
     eval_input_fn = file_based_input_fn_builder(
-        input_file=eval_file,
+        input_file=eval_manifest["files"],
+        compression_type=eval_manifest["compression_type"],
+        varlen=eval_manifest["varlen"],
+        bucket_boundaries=bucket_boundaries,
+        pipeline_options=pipeline_options,
         batch_size=FLAGS.eval_batch_size,
         seq_length=FLAGS.max_seq_length,
         is_training=False,
@@ -1114,12 +1037,13 @@ def main(_):
 
     prefix = FLAGS.test_file.split('.')[-2]+'_' if '.' in FLAGS.test_file else ''
     predict_file = os.path.join(FLAGS.output_dir, FLAGS.test_file+"_predict.tf_record")
-    predict_file_exists=os.path.exists(predict_file)
-    print("###predict_file_exists:", predict_file_exists," ;predict_file:", predict_file)
-    if not predict_file_exists: # if tf_record file not exist, convert from raw text file.
-        file_based_convert_examples_to_features(predict_examples, label_list,
-                                            FLAGS.max_seq_length, tokenizer,
-                                            predict_file)
+    # Reuses the tf_record files if they were converted from the same raw text.
+    predict_manifest = file_based_convert_examples_to_features(
+        predict_examples, label_list, FLAGS.max_seq_length, tokenizer, predict_file,
+        num_shards=FLAGS.num_record_shards,
+        compression_type=FLAGS.record_compression,
+        reuse_cached=FLAGS.reuse_cached_features,
+        varlen=FLAGS.varlen_records)
 
     tf.logging.info("***** Running prediction*****")
     tf.logging.info("  Num examples = %d (%d actual, %d padding)",
@@ -1129,7 +1053,11 @@ def main(_):
 
     predict_drop_remainder = True if FLAGS.use_tpu else False
     predict_input_fn = file_based_input_fn_builder(
-        input_file=predict_file,
+        input_file=predict_manifest["files"],
+        compression_type=predict_manifest["compression_type"],
+        varlen=predict_manifest["varlen"],
+        bucket_boundaries=bucket_boundaries,
+        pipeline_options=pipeline_options,
         batch_size=FLAGS.predict_batch_size,
         seq_length=FLAGS.max_seq_length,
         is_training=False,
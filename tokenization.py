@@ -18,11 +18,24 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import array
 import collections
+import io
+import mmap
+import multiprocessing
 import re
+import struct
+import sys
+import threading
 import unicodedata
+import zlib
+import numpy as np
 import six
-import tensorflow as tf
+
+try:
+  from collections.abc import Mapping
+except ImportError:  # Python 2
+  from collections import Mapping
 
 
 def validate_case_matches_checkpoint(do_lower_case, init_checkpoint):
@@ -75,6 +88,20 @@ def validate_case_matches_checkpoint(do_lower_case, init_checkpoint):
                                           model_name, case_name, opposite_flag))
 
 
+def open_file(path, mode="r"):
+  """Opens a local file, or a remote one (e.g. "gs://...") through `tf.gfile`.
+
+  TensorFlow is only imported for remote paths, so that clients which just
+  tokenize text don't pay for loading it.
+  """
+  if "://" in path:
+    import tensorflow as tf  # pylint: disable=g-import-not-at-top
+    return tf.gfile.GFile(path, mode)
+  if "b" in mode:
+    return io.open(path, mode)
+  return io.open(path, mode, encoding="utf-8")
+
+
 def convert_to_unicode(text):
   """Converts `text` to Unicode (if it's not already), assuming utf-8 input."""
   if six.PY3:
@@ -119,10 +146,16 @@ def printable_text(text):
 
 
 def load_vocab(vocab_file):
-  """Loads a vocabulary file into a dictionary."""
+  """Loads a vocabulary file into a dictionary.
+
+  A vocab compiled with `convert_vocab_to_binary` is memory-mapped instead and
+  returned as a read-only `BinaryVocab` mapping.
+  """
+  if is_binary_vocab(vocab_file):
+    return BinaryVocab(vocab_file)
   vocab = collections.OrderedDict()
   index = 0
-  with tf.gfile.GFile(vocab_file, "r") as reader:
+  with open_file(vocab_file, "r") as reader:
     while True:
       token = convert_to_unicode(reader.readline())
       if not token:
@@ -133,6 +166,181 @@ def load_vocab(vocab_file):
   return vocab
 
 
+def invert_vocab(vocab):
+  """Returns the id to token mapping of `vocab`."""
+  if isinstance(vocab, BinaryVocab):
+    return vocab.inverse()
+  return {v: k for k, v in vocab.items()}
+
+
+# Layout of a compiled vocab file, all integers little-endian uint32:
+#   magic, num_tokens, num_keys, num_slots,
+#   offsets[num_tokens + 1]  byte offsets of each token in the string blob,
+#   slots[num_slots]         open addressing hash table of id + 1 (0 = empty),
+#   blob                     the utf-8 encoded tokens, in id order.
+_BINARY_VOCAB_MAGIC = b"BERTVOC1"
+_BINARY_VOCAB_HEADER = struct.Struct("<8sIII")
+
+
+def _vocab_slot(token_bytes, mask):
+  return zlib.crc32(token_bytes) & mask
+
+
+def is_binary_vocab(vocab_file):
+  """Returns True if `vocab_file` is a vocab compiled to the binary format."""
+  try:
+    with open(vocab_file, "rb") as reader:
+      return reader.read(len(_BINARY_VOCAB_MAGIC)) == _BINARY_VOCAB_MAGIC
+  except (IOError, OSError):
+    # Not a local file, e.g. a GCS path. Compiled vocabs are local only.
+    return False
+
+
+def convert_vocab_to_binary(vocab_file, output_file):
+  """Compiles a text vocab file into the memory-mappable binary format."""
+  tokens = []
+  with open_file(vocab_file, "r") as reader:
+    while True:
+      token = convert_to_unicode(reader.readline())
+      if not token:
+        break
+      tokens.append(token.strip().encode("utf-8"))
+
+  # As in `load_vocab`, a repeated token maps to its last id.
+  token_ids = {}
+  for (index, token) in enumerate(tokens):
+    token_ids[token] = index
+
+  num_slots = 1
+  while num_slots < 2 * len(token_ids):
+    num_slots *= 2
+  mask = num_slots - 1
+  slots = array.array("I", [0] * num_slots)
+  for token, index in token_ids.items():
+    slot = _vocab_slot(token, mask)
+    while slots[slot]:
+      slot = (slot + 1) & mask
+    slots[slot] = index + 1
+
+  offsets = array.array("I", [0])
+  for token in tokens:
+    offsets.append(offsets[-1] + len(token))
+  if sys.byteorder != "little":
+    slots.byteswap()
+    offsets.byteswap()
+
+  with open(output_file, "wb") as writer:
+    writer.write(_BINARY_VOCAB_HEADER.pack(
+        _BINARY_VOCAB_MAGIC, len(tokens), len(token_ids), num_slots))
+    writer.write(offsets.tobytes())
+    writer.write(slots.tobytes())
+    writer.write(b"".join(tokens))
+
+
+class BinaryVocab(Mapping):
+  """A read-only token to id mapping backed by a memory-mapped vocab file.
+
+  The file is mapped read-only, so its pages are shared by every process that
+  loads the same vocab and nothing is parsed at load time. Lookups hash the
+  token into the table stored in the file.
+  """
+
+  def __init__(self, vocab_file):
+    self.vocab_file = vocab_file
+    with open(vocab_file, "rb") as reader:
+      self._mmap = mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ)
+    (magic, self._num_tokens, self._num_keys,
+     num_slots) = _BINARY_VOCAB_HEADER.unpack_from(self._mmap, 0)
+    if magic != _BINARY_VOCAB_MAGIC:
+      raise ValueError("%s is not a compiled vocab file" % vocab_file)
+    self._mask = num_slots - 1
+
+    data = memoryview(self._mmap)
+    start = _BINARY_VOCAB_HEADER.size
+    end = start + 4 * (self._num_tokens + 1)
+    self._offsets = self._uint32_array(data[start:end])
+    start, end = end, end + 4 * num_slots
+    self._slots = self._uint32_array(data[start:end])
+    self._blob = data[end:]
+
+  @staticmethod
+  def _uint32_array(data):
+    if sys.byteorder == "little":
+      return data.cast("I")
+    # Big-endian hosts get a private, byte swapped copy.
+    values = array.array("I", data.tobytes())
+    values.byteswap()
+    return values
+
+  def _token_bytes(self, index):
+    return self._blob[self._offsets[index]:self._offsets[index + 1]]
+
+  def token(self, index):
+    """Returns the token with id `index`."""
+    if not 0 <= index < self._num_tokens:
+      raise KeyError(index)
+    return self._token_bytes(index).tobytes().decode("utf-8")
+
+  def _lookup(self, token):
+    if not isinstance(token, six.text_type):
+      return None
+    token_bytes = token.encode("utf-8")
+    slot = _vocab_slot(token_bytes, self._mask)
+    while True:
+      index = self._slots[slot]
+      if not index:
+        return None
+      if self._token_bytes(index - 1) == token_bytes:
+        return index - 1
+      slot = (slot + 1) & self._mask
+
+  def __getitem__(self, token):
+    index = self._lookup(token)
+    if index is None:
+      raise KeyError(token)
+    return index
+
+  def __contains__(self, token):
+    return self._lookup(token) is not None
+
+  def __iter__(self):
+    for index in range(self._num_tokens):
+      token = self.token(index)
+      # Skip earlier ids of repeated tokens, which map to their last id.
+      if self._num_keys == self._num_tokens or self._lookup(token) == index:
+        yield token
+
+  def __len__(self):
+    return self._num_keys
+
+  def inverse(self):
+    """Returns the id to token mapping of this vocab."""
+    return _BinaryInvVocab(self)
+
+  def __getstate__(self):
+    # The memory map can't be pickled, so worker processes map the file again.
+    return {"vocab_file": self.vocab_file}
+
+  def __setstate__(self, state):
+    self.__init__(state["vocab_file"])
+
+
+class _BinaryInvVocab(Mapping):
+  """The id to token view of a `BinaryVocab`."""
+
+  def __init__(self, vocab):
+    self._vocab = vocab
+
+  def __getitem__(self, index):
+    return self._vocab.token(index)
+
+  def __iter__(self):
+    return iter(range(self._vocab._num_tokens))
+
+  def __len__(self):
+    return self._vocab._num_tokens
+
+
 def convert_by_vocab(vocab, items):
   """Converts a sequence of [tokens|ids] using the vocab."""
   output = []
@@ -149,6 +357,76 @@ def convert_ids_to_tokens(inv_vocab, ids):
   return convert_by_vocab(inv_vocab, ids)
 
 
+def build_input_arrays(all_ids_a, all_ids_b, max_seq_length, cls_id, sep_id):
+  """Packs token ids into zero-padded BERT input arrays.
+
+  Args:
+    all_ids_a: A list with the ids of the first sequence of every example, or
+      None for an all-zero (padding) row.
+    all_ids_b: Optional list with the ids of the second sequences. None or
+      empty entries make single sequence examples.
+    max_seq_length: Length of the rows, including "[CLS]" and "[SEP]".
+    cls_id: Id of "[CLS]".
+    sep_id: Id of "[SEP]".
+
+  Returns:
+    A tuple (input_ids, input_mask, segment_ids) of `np.int32` arrays of
+    shape [len(all_ids_a), max_seq_length].
+  """
+  num_examples = len(all_ids_a)
+  input_ids = np.zeros((num_examples, max_seq_length), dtype=np.int32)
+  input_mask = np.zeros((num_examples, max_seq_length), dtype=np.int32)
+  segment_ids = np.zeros((num_examples, max_seq_length), dtype=np.int32)
+
+  for (i, ids_a) in enumerate(all_ids_a):
+    if ids_a is None:
+      continue
+    ids_b = all_ids_b[i] if all_ids_b is not None else None
+    if ids_b:
+      # Account for [CLS], [SEP], [SEP] with "- 3"
+      len_a, len_b = truncate_seq_pair_lengths(
+          len(ids_a), len(ids_b), max_seq_length - 3)
+    else:
+      # Account for [CLS] and [SEP] with "- 2"
+      len_a, len_b = min(len(ids_a), max_seq_length - 2), 0
+
+    row = input_ids[i]
+    row[0] = cls_id
+    row[1:len_a + 1] = ids_a[:len_a]
+    row[len_a + 1] = sep_id
+    length = len_a + 2
+    if ids_b:
+      row[length:length + len_b] = ids_b[:len_b]
+      row[length + len_b] = sep_id
+      segment_ids[i, length:length + len_b + 1] = 1
+      length += len_b + 1
+    input_mask[i, :length] = 1
+  return input_ids, input_mask, segment_ids
+
+
+def truncate_seq_pair_lengths(len_a, len_b, max_length):
+  """Returns the lengths `_truncate_seq_pair` would truncate a pair to.
+
+  The longer sequence loses one token at a time (the second one on ties)
+  until the total length fits into `max_length`.
+  """
+  excess = len_a + len_b - max_length
+  if excess <= 0:
+    return len_a, len_b
+  # First cut the longer sequence down to the length of the shorter one,
+  # then alternate, which is what popping one token at a time amounts to.
+  if len_a > len_b:
+    cut = min(excess, len_a - len_b)
+    len_a -= cut
+  else:
+    cut = min(excess, len_b - len_a)
+    len_b -= cut
+  excess -= cut
+  len_b -= (excess + 1) // 2
+  len_a -= excess // 2
+  return len_a, len_b
+
+
 def whitespace_tokenize(text):
   """Runs basic whitespace cleaning and splitting on a piece of text."""
   text = text.strip()
@@ -161,13 +439,46 @@ def whitespace_tokenize(text):
 class FullTokenizer(object):
   """Runs end-to-end tokenziation."""
 
-  def __init__(self, vocab_file, do_lower_case=True):
+  def __init__(self, vocab_file, do_lower_case=True, use_trie=False,
+               cache_size=0, cache_max_bytes=None, wordpiece_cache_size=0):
+    """Constructs a FullTokenizer.
+
+    Args:
+      vocab_file: Path to the WordPiece vocabulary file, either the plain text
+        `vocab.txt` or a vocab compiled with `convert_vocab_to_binary`.
+      do_lower_case: Whether to lower case the input.
+      use_trie: If True, WordPiece matching is done with a prefix trie built
+        once from the vocab (`TrieWordpieceTokenizer`) instead of probing the
+        vocab with every candidate substring. The output is identical.
+      cache_size: Maximum number of texts whose tokens are memoized by
+        `tokenize`. 0 disables the cache.
+      cache_max_bytes: Optional approximate memory budget of that cache.
+      wordpiece_cache_size: Maximum number of words whose word pieces are
+        memoized by the `WordpieceTokenizer`. 0 disables the cache.
+    """
     self.vocab = load_vocab(vocab_file)
-    self.inv_vocab = {v: k for k, v in self.vocab.items()}
+    self.inv_vocab = invert_vocab(self.vocab)
     self.basic_tokenizer = BasicTokenizer(do_lower_case=do_lower_case)
-    self.wordpiece_tokenizer = WordpieceTokenizer(vocab=self.vocab)
+    if use_trie:
+      wordpiece_class = TrieWordpieceTokenizer
+    else:
+      wordpiece_class = WordpieceTokenizer
+    self.wordpiece_tokenizer = wordpiece_class(
+        vocab=self.vocab, cache_size=wordpiece_cache_size)
+    self.cache = None
+    if cache_size > 0:
+      self.cache = LRUCache(cache_size, max_bytes=cache_max_bytes)
 
   def tokenize(self, text):
+    if self.cache is not None:
+      tokens = self.cache.get(text)
+      if tokens is None:
+        tokens = tuple(self._tokenize(text))
+        self.cache.put(text, tokens)
+      return list(tokens)
+    return self._tokenize(text)
+
+  def _tokenize(self, text):
     split_tokens = []
     for token in self.basic_tokenizer.tokenize(text):
       for sub_token in self.wordpiece_tokenizer.tokenize(token):
@@ -175,12 +486,191 @@ class FullTokenizer(object):
 
     return split_tokens
 
+  def cache_stats(self):
+    """Returns the statistics of the text and word piece caches.
+
+    Returns:
+      A dict with the `LRUCache.stats` of the "tokenize" and "wordpiece"
+      caches, or None for a cache that is disabled.
+    """
+    wordpiece_cache = self.wordpiece_tokenizer.cache
+    return {
+        "tokenize": self.cache.stats() if self.cache is not None else None,
+        "wordpiece": (wordpiece_cache.stats()
+                      if wordpiece_cache is not None else None),
+    }
+
   def convert_tokens_to_ids(self, tokens):
     return convert_by_vocab(self.vocab, tokens)
 
   def convert_ids_to_tokens(self, ids):
     return convert_by_vocab(self.inv_vocab, ids)
 
+  def encode(self, text):
+    """Tokenizes `text` and converts the tokens to vocab ids."""
+    if self.cache is not None:
+      return self.convert_tokens_to_ids(self.tokenize(text))
+    ids = []
+    for token in self.basic_tokenizer.tokenize(text):
+      ids.extend(self.wordpiece_tokenizer.encode(token))
+    return ids
+
+  def encode_to_arrays(self, texts_a, max_seq_length, texts_b=None,
+                       num_workers=1, pool=None):
+    """Encodes a batch of texts straight into BERT input arrays.
+
+    Builds the same `input_ids`, `input_mask` and `segment_ids` as
+    `featurization.convert_examples_to_arrays`, but from plain texts, for
+    inference callers that have no examples or labels.
+
+    Args:
+      texts_a: A sequence of texts.
+      max_seq_length: Length of the rows, including "[CLS]" and "[SEP]".
+      texts_b: Optional sequence of second texts for sentence pair tasks, with
+        the same length as `texts_a`. Empty entries are treated as absent.
+      num_workers: Number of processes used to encode the texts, see
+        `encode_batch`.
+      pool: Optional pool for `encode_batch`.
+
+    Returns:
+      A tuple (input_ids, input_mask, segment_ids) of `np.int32` arrays of
+      shape [len(texts_a), max_seq_length].
+    """
+    texts = list(texts_a)
+    num_a = len(texts)
+    pair_indices = []
+    if texts_b is not None:
+      for (i, text) in enumerate(texts_b):
+        if text:
+          pair_indices.append(i)
+          texts.append(text)
+    all_ids = self.encode_batch(texts, num_workers=num_workers, pool=pool)
+    all_ids_b = None
+    if pair_indices:
+      all_ids_b = [None] * num_a
+      for (i, ids) in zip(pair_indices, all_ids[num_a:]):
+        all_ids_b[i] = ids
+    return build_input_arrays(all_ids[:num_a], all_ids_b, max_seq_length,
+                              self.vocab["[CLS]"], self.vocab["[SEP]"])
+
+  def tokenize_batch(self, texts, num_workers=None,
+                     min_texts_per_worker=1000, pool=None):
+    """Tokenizes a list of texts, optionally across a pool of processes.
+
+    Args:
+      texts: A sequence of texts.
+      num_workers: Number of worker processes. Defaults to the number of CPUs.
+        With 1 (or fewer), everything runs in the calling process.
+      min_texts_per_worker: Batches smaller than `num_workers *
+        min_texts_per_worker` are tokenized in-process, since starting the
+        pool would cost more than it saves.
+      pool: Optional pool of `num_workers` processes from `create_batch_pool`
+        for this tokenizer, used instead of starting a new one. Otherwise a
+        pool is started for this call, see `create_batch_pool` for how.
+
+    Returns:
+      A list with the tokens of each text, in the same order as `texts`.
+    """
+    return _run_batch(self, "tokenize", texts, num_workers,
+                      min_texts_per_worker, pool)
+
+  def encode_batch(self, texts, num_workers=None, min_texts_per_worker=1000,
+                   pool=None):
+    """Like `tokenize_batch`, but returns the vocab ids of each text."""
+    return _run_batch(self, "encode", texts, num_workers,
+                      min_texts_per_worker, pool)
+
+
+# The tokenizer used by batch worker processes, set by the pool initializer.
+_batch_tokenizer = None
+
+# The start method of batch worker pools, see `set_batch_start_method`.
+_batch_start_method = None
+
+
+def set_batch_start_method(method):
+  """Sets how the worker processes of `create_batch_pool` are started.
+
+  Args:
+    method: "fork", "spawn", or None for the default: "fork" unless
+      TensorFlow has been imported. "fork" falls back to "spawn" where it is
+      not available.
+
+  A process that imports TensorFlow but has not run a session yet (like the
+  runners while converting the train set) can still fork safely, and should
+  switch to "spawn" once sessions have started their threads.
+  """
+  global _batch_start_method
+  _batch_start_method = method
+
+
+def _init_batch_worker(tokenizer):
+  global _batch_tokenizer
+  _batch_tokenizer = tokenizer
+
+
+def _batch_worker(args):
+  method, texts = args
+  fn = getattr(_batch_tokenizer, method)
+  return [fn(text) for text in texts]
+
+
+def create_batch_pool(tokenizer, num_workers):
+  """Starts a process pool for the batch methods of `tokenizer`.
+
+  Passing it as the `pool` of several `tokenize_batch`/`encode_batch` calls
+  starts the workers, and sends them the tokenizer, only once. The caller
+  closes and joins the pool.
+
+  Forked workers inherit the tokenizer, so its vocab is shared copy-on-write
+  and they start almost instantly. But a child forked from a process whose
+  TensorFlow sessions have started their thread pools can deadlock on a lock
+  held by one of those threads. Spawned workers are safe there, at a price:
+  each one gets its own pickled copy of the tokenizer (vocab, trie and
+  caches), so memory grows with `num_workers`, and each one re-imports the
+  `__main__` module, e.g. TensorFlow for the runners. See
+  `set_batch_start_method` for which one is used.
+  """
+  method = _batch_start_method
+  if method is None:
+    method = "spawn" if "tensorflow" in sys.modules else "fork"
+  if method not in multiprocessing.get_all_start_methods():
+    method = "spawn"
+  return multiprocessing.get_context(method).Pool(
+      num_workers, initializer=_init_batch_worker, initargs=(tokenizer,))
+
+
+def _run_batch(tokenizer, method, texts, num_workers, min_texts_per_worker,
+               pool=None):
+  """Runs `tokenizer.<method>` over `texts`, in a process pool if worthwhile."""
+  texts = list(texts)
+  if num_workers is None:
+    num_workers = multiprocessing.cpu_count()
+  if num_workers <= 1 or len(texts) < num_workers * min_texts_per_worker:
+    fn = getattr(tokenizer, method)
+    return [fn(text) for text in texts]
+
+  # A few chunks per worker keeps the pool busy when texts vary in length.
+  num_chunks = num_workers * 4
+  chunk_size = (len(texts) + num_chunks - 1) // num_chunks
+  chunks = [(method, texts[i:i + chunk_size])
+            for i in range(0, len(texts), chunk_size)]
+
+  if pool is not None:
+    results = pool.map(_batch_worker, chunks)
+  else:
+    pool = create_batch_pool(tokenizer, num_workers)
+    try:
+      results = pool.map(_batch_worker, chunks)
+    finally:
+      pool.close()
+      pool.join()
+
+  output = []
+  for result in results:
+    output.extend(result)
+  return output
+
 
 class BasicTokenizer(object):
   """Runs basic tokenization (punctuation splitting, lower casing, etc.)."""
@@ -194,29 +684,87 @@ class BasicTokenizer(object):
     self.do_lower_case = do_lower_case
 
   def tokenize(self, text):
-    """Tokenizes a piece of text."""
-    text = convert_to_unicode(text)
-    text = self._clean_text(text)
+    """Tokenizes a piece of text.
 
-    # This was added on November 1st, 2018 for the multilingual and Chinese
-    # models. This is also applied to the English models now, but it doesn't
-    # matter since the English models were not trained on any Chinese data
-    # and generally don't have any Chinese data in them (there are Chinese
-    # characters in the vocabulary because Wikipedia does have some Chinese
-    # words in the English Wikipedia.).
-    text = self._tokenize_chinese_chars(text)
-
-    orig_tokens = whitespace_tokenize(text)
-    split_tokens = []
-    for token in orig_tokens:
-      if self.do_lower_case:
-        token = token.lower()
-        token = self._run_strip_accents(token)
-      split_tokens.extend(self._run_split_on_punc(token))
+    This does text cleanup, CJK spacing, lower casing, accent stripping and
+    punctuation splitting in a single sweep over `text`, looking up the class
+    of every character in a precomputed table (see `_get_char_table`). The
+    output is the same as running `_clean_text`, `_tokenize_chinese_chars`,
+    `_run_strip_accents` and `_run_split_on_punc` one after the other.
+    """
+    text = convert_to_unicode(text)
+    char_classes, replacements = _get_char_table(self.do_lower_case)
+    table_size = len(char_classes)
 
-    output_tokens = whitespace_tokenize(" ".join(split_tokens))
+    output_tokens = []
+    # Normalized characters of the current word, i.e. the current token up to
+    # the next punctuation character.
+    word = []
+    # Raw characters of the current whitespace delimited token. Only needed if
+    # it contains a character that cannot be normalized on its own, in which
+    # case the whole token is redone with `_normalize_token`.
+    segment = []
+    segment_start = 0
+    is_complex = False
+    for char in text:
+      cp = ord(char)
+      if cp < table_size:
+        char_class = char_classes[cp]
+        if char_class == _CHAR_UNKNOWN:
+          char_class = _fill_char_block(char_classes, replacements,
+                                        self.do_lower_case, cp)
+      else:
+        char_class = _classify_char_cached(char, self.do_lower_case)
+
+      if char_class == _CHAR_PLAIN:
+        segment.append(char)
+        word.append(replacements.get(char, char))
+      elif char_class == _CHAR_PUNCT:
+        segment.append(char)
+        if word:
+          token = "".join(word)
+          if token:
+            output_tokens.append(token)
+          word = []
+        output_tokens.append(replacements.get(char, char))
+      elif char_class == _CHAR_COMPLEX:
+        segment.append(char)
+        is_complex = True
+      elif char_class != _CHAR_DROP:
+        # Whitespace and CJK characters both end the current token.
+        if segment:
+          if is_complex:
+            del output_tokens[segment_start:]
+            output_tokens.extend(self._normalize_token("".join(segment)))
+            is_complex = False
+          elif word:
+            token = "".join(word)
+            if token:
+              output_tokens.append(token)
+          word = []
+          segment = []
+        if char_class == _CHAR_CJK:
+          output_tokens.append(replacements.get(char, char))
+        elif char_class == _CHAR_CJK_COMPLEX:
+          output_tokens.extend(self._normalize_token(char))
+        segment_start = len(output_tokens)
+
+    if is_complex:
+      del output_tokens[segment_start:]
+      output_tokens.extend(self._normalize_token("".join(segment)))
+    elif word:
+      token = "".join(word)
+      if token:
+        output_tokens.append(token)
     return output_tokens
 
+  def _normalize_token(self, token):
+    """Lower cases, strips accents and splits punctuation of a single token."""
+    if self.do_lower_case:
+      token = token.lower()
+      token = self._run_strip_accents(token)
+    return whitespace_tokenize(" ".join(self._run_split_on_punc(token)))
+
   def _run_strip_accents(self, text):
     """Strips accents from a piece of text."""
     text = unicodedata.normalize("NFD", text)
@@ -263,25 +811,7 @@ class BasicTokenizer(object):
 
   def _is_chinese_char(self, cp):
     """Checks whether CP is the codepoint of a CJK character."""
-    # This defines a "chinese character" as anything in the CJK Unicode block:
-    #   https://en.wikipedia.org/wiki/CJK_Unified_Ideographs_(Unicode_block)
-    #
-    # Note that the CJK Unicode block is NOT all Japanese and Korean characters,
-    # despite its name. The modern Korean Hangul alphabet is a different block,
-    # as is Japanese Hiragana and Katakana. Those alphabets are used to write
-    # space-separated words, so they are not treated specially and handled
-    # like the all of the other languages.
-    if ((cp >= 0x4E00 and cp <= 0x9FFF) or  #
-        (cp >= 0x3400 and cp <= 0x4DBF) or  #
-        (cp >= 0x20000 and cp <= 0x2A6DF) or  #
-        (cp >= 0x2A700 and cp <= 0x2B73F) or  #
-        (cp >= 0x2B740 and cp <= 0x2B81F) or  #
-        (cp >= 0x2B820 and cp <= 0x2CEAF) or
-        (cp >= 0xF900 and cp <= 0xFAFF) or  #
-        (cp >= 0x2F800 and cp <= 0x2FA1F)):  #
-      return True
-
-    return False
+    return _is_chinese_char(cp)
 
   def _clean_text(self, text):
     """Performs invalid character removal and whitespace cleanup on text."""
@@ -300,10 +830,14 @@ class BasicTokenizer(object):
 class WordpieceTokenizer(object):
   """Runs WordPiece tokenziation."""
 
-  def __init__(self, vocab, unk_token="[UNK]", max_input_chars_per_word=200):
+  def __init__(self, vocab, unk_token="[UNK]", max_input_chars_per_word=200,
+               cache_size=0, cache_max_bytes=None):
     self.vocab = vocab
     self.unk_token = unk_token
     self.max_input_chars_per_word = max_input_chars_per_word
+    self.cache = None
+    if cache_size > 0:
+      self.cache = LRUCache(cache_size, max_bytes=cache_max_bytes)
 
   def tokenize(self, text):
     """Tokenizes a piece of text into its word pieces.
@@ -327,36 +861,235 @@ class WordpieceTokenizer(object):
 
     output_tokens = []
     for token in whitespace_tokenize(text):
-      chars = list(token)
-      if len(chars) > self.max_input_chars_per_word:
-        output_tokens.append(self.unk_token)
-        continue
+      if self.cache is not None:
+        sub_tokens = self.cache.get(token)
+        if sub_tokens is None:
+          sub_tokens = tuple(self._tokenize_word(token))
+          self.cache.put(token, sub_tokens)
+      else:
+        sub_tokens = self._tokenize_word(token)
+      output_tokens.extend(sub_tokens)
+    return output_tokens
 
-      is_bad = False
-      start = 0
-      sub_tokens = []
-      while start < len(chars):
-        end = len(chars)
-        cur_substr = None
-        while start < end:
-          substr = "".join(chars[start:end])
-          if start > 0:
-            substr = "##" + substr
-          if substr in self.vocab:
-            cur_substr = substr
-            break
-          end -= 1
-        if cur_substr is None:
-          is_bad = True
-          break
-        sub_tokens.append(cur_substr)
-        start = end
+  def encode(self, text):
+    """Like `tokenize`, but returns the vocab ids of the word pieces."""
+    text = convert_to_unicode(text)
 
-      if is_bad:
-        output_tokens.append(self.unk_token)
+    output_ids = []
+    for token in whitespace_tokenize(text):
+      if self.cache is not None:
+        output_ids.extend(convert_by_vocab(self.vocab, self.tokenize(token)))
       else:
-        output_tokens.extend(sub_tokens)
-    return output_tokens
+        output_ids.extend(self._encode_word(token))
+    return output_ids
+
+  def _encode_word(self, token):
+    """Returns the word piece ids of a single whitespace free token."""
+    return convert_by_vocab(self.vocab, self._tokenize_word(token))
+
+  def _tokenize_word(self, token):
+    """Returns the word pieces of a single whitespace free token."""
+    chars = list(token)
+    if len(chars) > self.max_input_chars_per_word:
+      return [self.unk_token]
+
+    start = 0
+    sub_tokens = []
+    while start < len(chars):
+      end = len(chars)
+      cur_substr = None
+      while start < end:
+        substr = "".join(chars[start:end])
+        if start > 0:
+          substr = "##" + substr
+        if substr in self.vocab:
+          cur_substr = substr
+          break
+        end -= 1
+      if cur_substr is None:
+        return [self.unk_token]
+      sub_tokens.append(cur_substr)
+      start = end
+    return sub_tokens
+
+
+class TrieWordpieceTokenizer(WordpieceTokenizer):
+  """Runs WordPiece tokenization with a prefix trie over the vocab.
+
+  The greedy longest-match-first search of `WordpieceTokenizer` rebuilds and
+  looks up every candidate substring, which is quadratic in the word length.
+  Here the vocab is compiled once into two character tries, one for word-initial
+  pieces and one for "##" continuation pieces, so that the longest match at a
+  given position is found in a single forward walk. The produced tokens are
+  exactly the same as with `WordpieceTokenizer`.
+  """
+
+  def __init__(self, vocab, unk_token="[UNK]", max_input_chars_per_word=200,
+               cache_size=0, cache_max_bytes=None):
+    super(TrieWordpieceTokenizer, self).__init__(
+        vocab, unk_token=unk_token,
+        max_input_chars_per_word=max_input_chars_per_word,
+        cache_size=cache_size, cache_max_bytes=cache_max_bytes)
+    self._prefix_trie = {}
+    self._suffix_trie = {}
+    for (piece, index) in vocab.items():
+      if piece.startswith("##"):
+        self._add_to_trie(self._suffix_trie, piece[2:], (piece, index))
+      # A "##foo" entry is also a legal word-initial piece "##foo", exactly as
+      # a plain vocab lookup would treat it.
+      self._add_to_trie(self._prefix_trie, piece, (piece, index))
+
+  @staticmethod
+  def _add_to_trie(trie, key, piece):
+    """Inserts `key` into `trie`, storing the (piece, id) `piece` at its end."""
+    if not key:
+      return
+    node = trie
+    for char in key:
+      child = node.get(char)
+      if child is None:
+        child = {}
+        node[char] = child
+      node = child
+    # The empty string can never be a character, so it marks a terminal node.
+    node[""] = piece
+
+  def _match_word(self, token):
+    """Returns the (piece, id) matches of `token`, or None if it is unknown."""
+    num_chars = len(token)
+    if num_chars > self.max_input_chars_per_word:
+      return None
+
+    start = 0
+    matches = []
+    trie = self._prefix_trie
+    while start < num_chars:
+      node = trie
+      cur_match = None
+      end = start
+      pos = start
+      while pos < num_chars:
+        node = node.get(token[pos])
+        if node is None:
+          break
+        pos += 1
+        match = node.get("")
+        if match is not None:
+          cur_match = match
+          end = pos
+      if cur_match is None:
+        return None
+      matches.append(cur_match)
+      start = end
+      trie = self._suffix_trie
+    return matches
+
+  def _tokenize_word(self, token):
+    """Returns the word pieces of a single whitespace free token."""
+    matches = self._match_word(token)
+    if matches is None:
+      return [self.unk_token]
+    return [piece for (piece, _) in matches]
+
+  def _encode_word(self, token):
+    """Returns the word piece ids of a single whitespace free token."""
+    matches = self._match_word(token)
+    if matches is None:
+      return [self.vocab[self.unk_token]]
+    return [index for (_, index) in matches]
+
+
+class LRUCache(object):
+  """A thread safe, size bounded least-recently-used cache.
+
+  Used to memoize tokenization results. Values should be immutable (e.g.
+  tuples) since they are handed out to every caller that hits the same key.
+  """
+
+  def __init__(self, max_entries, max_bytes=None):
+    """Constructs a LRUCache.
+
+    Args:
+      max_entries: Maximum number of cached entries.
+      max_bytes: Optional maximum approximate size of the cached keys and
+        values, as measured by `sys.getsizeof`.
+    """
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+    self._bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  @staticmethod
+  def _sizeof(key, value):
+    return (sys.getsizeof(key) + sys.getsizeof(value) +
+            sum(sys.getsizeof(item) for item in value))
+
+  def get(self, key):
+    """Returns the value cached for `key`, or None."""
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None:
+        self.misses += 1
+        return None
+      self._entries.move_to_end(key)
+      self.hits += 1
+      return entry[0]
+
+  def put(self, key, value):
+    """Caches `value` for `key`, evicting the least recently used entries."""
+    size = self._sizeof(key, value)
+    if self.max_bytes is not None and size > self.max_bytes:
+      return
+    with self._lock:
+      old_entry = self._entries.pop(key, None)
+      if old_entry is not None:
+        self._bytes -= old_entry[1]
+      self._entries[key] = (value, size)
+      self._bytes += size
+      while (len(self._entries) > self.max_entries or
+             (self.max_bytes is not None and self._bytes > self.max_bytes)):
+        _, (_, evicted_size) = self._entries.popitem(last=False)
+        self._bytes -= evicted_size
+        self.evictions += 1
+
+  def clear(self):
+    """Removes all entries and resets the statistics."""
+    with self._lock:
+      self._entries.clear()
+      self._bytes = 0
+      self.hits = 0
+      self.misses = 0
+      self.evictions = 0
+
+  def stats(self):
+    """Returns a dict with the size, budget and hit/miss counts."""
+    with self._lock:
+      lookups = self.hits + self.misses
+      return {
+          "entries": len(self._entries),
+          "max_entries": self.max_entries,
+          "bytes": self._bytes,
+          "max_bytes": self.max_bytes,
+          "hits": self.hits,
+          "misses": self.misses,
+          "evictions": self.evictions,
+          "hit_rate": float(self.hits) / lookups if lookups else 0.0,
+      }
+
+  def __getstate__(self):
+    # Locks can't be pickled, e.g. when a tokenizer is sent to a worker
+    # process by `tokenize_batch`.
+    state = self.__dict__.copy()
+    del state["_lock"]
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._lock = threading.Lock()
 
 
 def _is_whitespace(char):
@@ -397,3 +1130,135 @@ def _is_punctuation(char):
   if cat.startswith("P"):
     return True
   return False
+
+
+def _is_chinese_char(cp):
+  """Checks whether CP is the codepoint of a CJK character."""
+  # This defines a "chinese character" as anything in the CJK Unicode block:
+  #   https://en.wikipedia.org/wiki/CJK_Unified_Ideographs_(Unicode_block)
+  #
+  # Note that the CJK Unicode block is NOT all Japanese and Korean characters,
+  # despite its name. The modern Korean Hangul alphabet is a different block,
+  # as is Japanese Hiragana and Katakana. Those alphabets are used to write
+  # space-separated words, so they are not treated specially and handled
+  # like the all of the other languages.
+  if ((cp >= 0x4E00 and cp <= 0x9FFF) or  #
+      (cp >= 0x3400 and cp <= 0x4DBF) or  #
+      (cp >= 0x20000 and cp <= 0x2A6DF) or  #
+      (cp >= 0x2A700 and cp <= 0x2B73F) or  #
+      (cp >= 0x2B740 and cp <= 0x2B81F) or  #
+      (cp >= 0x2B820 and cp <= 0x2CEAF) or
+      (cp >= 0xF900 and cp <= 0xFAFF) or  #
+      (cp >= 0x2F800 and cp <= 0x2FA1F)):  #
+    return True
+
+  return False
+
+
+# Character classes used by `BasicTokenizer.tokenize`.
+_CHAR_PLAIN = 0  # Part of a word.
+_CHAR_PUNCT = 1  # A token on its own.
+_CHAR_DROP = 2  # Removed by `_clean_text`.
+_CHAR_SPACE = 3  # Splits tokens.
+_CHAR_CJK = 4  # A token on its own.
+# Characters whose normalized form depends on their neighbours (e.g. the Greek
+# final sigma, or combining marks that get reordered by NFD), or which expand
+# into punctuation or whitespace. Tokens containing them take the slow path.
+_CHAR_COMPLEX = 5
+_CHAR_CJK_COMPLEX = 6
+
+# Not classified yet. The tables are filled lazily, a block at a time.
+_CHAR_UNKNOWN = 255
+
+# The lookup tables cover the BMP and the supplementary ideographic plane,
+# which holds the CJK extension blocks. Anything above is classified on demand.
+_CHAR_TABLE_SIZE = 0x30000
+_CHAR_BLOCK_SIZE = 256
+
+_char_tables = {}
+_char_class_cache = {}
+
+
+def _classify_char(char, do_lower_case):
+  """Returns the `_CHAR_*` class and the normalized form of `char`."""
+  cp = ord(char)
+  if cp == 0 or cp == 0xfffd or _is_control(char):
+    return _CHAR_DROP, char
+  # `whitespace_tokenize` splits on everything `str.split` considers space.
+  if _is_whitespace(char) or char.isspace():
+    return _CHAR_SPACE, char
+
+  is_cjk = _is_chinese_char(cp)
+  normalized = char
+  if do_lower_case:
+    # `str.lower` is context dependent for the capital sigma only.
+    if cp == 0x3a3 or unicodedata.combining(char):
+      return _CHAR_CJK_COMPLEX if is_cjk else _CHAR_COMPLEX, char
+    decomposed = unicodedata.normalize("NFD", char.lower())
+    if decomposed and unicodedata.combining(decomposed[0]):
+      return _CHAR_CJK_COMPLEX if is_cjk else _CHAR_COMPLEX, char
+    normalized = "".join(
+        c for c in decomposed if unicodedata.category(c) != "Mn")
+
+  if any(_is_whitespace(c) or c.isspace() for c in normalized):
+    return _CHAR_CJK_COMPLEX if is_cjk else _CHAR_COMPLEX, char
+  num_punct = sum(1 for c in normalized if _is_punctuation(c))
+  if is_cjk:
+    if num_punct or not normalized:
+      return _CHAR_CJK_COMPLEX, char
+    return _CHAR_CJK, normalized
+  if not num_punct:
+    return _CHAR_PLAIN, normalized
+  if len(normalized) == 1:
+    return _CHAR_PUNCT, normalized
+  return _CHAR_COMPLEX, char
+
+
+def _classify_char_cached(char, do_lower_case):
+  """Returns the `_CHAR_*` class of a character outside the lookup table.
+
+  There are no replacements for these characters, so any that would need one
+  is classified as complex and normalized by `_normalize_token` instead.
+  """
+  key = (char, do_lower_case)
+  char_class = _char_class_cache.get(key)
+  if char_class is None:
+    char_class, normalized = _classify_char(char, do_lower_case)
+    if normalized != char:
+      if char_class == _CHAR_CJK:
+        char_class = _CHAR_CJK_COMPLEX
+      elif char_class in (_CHAR_PLAIN, _CHAR_PUNCT):
+        char_class = _CHAR_COMPLEX
+    _char_class_cache[key] = char_class
+  return char_class
+
+
+def _get_char_table(do_lower_case):
+  """Returns the character class table and replacements.
+
+  The class table is a `bytearray` indexed by codepoint, holding
+  `_CHAR_UNKNOWN` for blocks that `_fill_char_block` has not classified yet.
+  The replacements map the characters whose normalized form differs from the
+  character itself.
+  """
+  table = _char_tables.get(do_lower_case)
+  if table is None:
+    # `setdefault` is atomic, so threads racing here all get the same table.
+    table = _char_tables.setdefault(
+        do_lower_case, (bytearray([_CHAR_UNKNOWN]) * _CHAR_TABLE_SIZE, {}))
+  return table
+
+
+def _fill_char_block(char_classes, replacements, do_lower_case, cp):
+  """Classifies the table block containing `cp`, returning the class of `cp`.
+
+  Filling is idempotent, so threads racing on the same block are harmless.
+  """
+  start = cp - cp % _CHAR_BLOCK_SIZE
+  for block_cp in range(start, start + _CHAR_BLOCK_SIZE):
+    char = six.unichr(block_cp)
+    char_class, normalized = _classify_char(char, do_lower_case)
+    if normalized != char:
+      replacements[char] = normalized
+    char_classes[block_cp] = char_class
+  return char_classes[cp]